@@ -6,11 +6,17 @@ Copyright (c) 2019 - present AppSeed.us
 from django.contrib import admin
 
 # Register your models here.
-from .models import Product, Process, Order, OrderProduct, Device, Raw
+from .models import Product, Process, Order, OrderProduct, Device, Raw, ScheduleRun, DurationStat, ScheduleVersion, \
+    DashboardAggregate, OrderEta
 
 admin.site.register(Product)
 admin.site.register(Process)
 admin.site.register(Order)
 admin.site.register(OrderProduct)
 admin.site.register(Device)
-admin.site.register(Raw)
\ No newline at end of file
+admin.site.register(Raw)
+admin.site.register(ScheduleRun)
+admin.site.register(DurationStat)
+admin.site.register(ScheduleVersion)
+admin.site.register(DashboardAggregate)
+admin.site.register(OrderEta)
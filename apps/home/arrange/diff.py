@@ -0,0 +1,154 @@
+import json
+import logging
+import zlib
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from ..models import ScheduleVersion, Task
+
+logger = logging.getLogger(__name__)
+
+# 每个版本保存的任务列，时间存为 UTC 秒
+VERSION_FIELDS = ('order_code', 'product_code', 'process_i', 'device_name', 'task_start_time', 'task_end_time',
+                  'product_num')
+# 只保留最近这么多个版本
+VERSIONS_KEPT = 10
+DIFF_LIMIT = 200
+
+
+def _timestamp(value):
+    return value.timestamp() if value else None
+
+
+def _time(seconds):
+    return datetime.fromtimestamp(seconds, dt_timezone.utc).isoformat() if seconds is not None else None
+
+
+def current_schedule():
+    """一条查询读出 Task 表，按开始时间排序的列式数据"""
+    columns = {field: [] for field in VERSION_FIELDS}
+    rows = Task.objects.order_by('task_start_time', 'id').values_list(*VERSION_FIELDS)
+    for row in rows:
+        for field, value in zip(VERSION_FIELDS, row):
+            columns[field].append(value)
+    columns['task_start_time'] = [_timestamp(value) for value in columns['task_start_time']]
+    columns['task_end_time'] = [_timestamp(value) for value in columns['task_end_time']]
+    return columns
+
+
+def archive_schedule(source):
+    """把当前 Task 表存为一个版本（压缩的列式 JSON），Task 表为空时不存"""
+    columns = current_schedule()
+    count = len(columns['order_code'])
+    if not count:
+        return None
+    version = ScheduleVersion.objects.create(
+        source=source, task_count=count, tasks=zlib.compress(json.dumps(columns).encode('utf-8')))
+    stale = ScheduleVersion.objects.order_by('-id').values_list('id', flat=True)[VERSIONS_KEPT:]
+    ScheduleVersion.objects.filter(id__in=list(stale)).delete()
+    logger.info(f"Archived schedule version {version.id} with {count} tasks")
+    return version
+
+
+def load_version(version):
+    return json.loads(zlib.decompress(bytes(version.tasks)).decode('utf-8'))
+
+
+def _keys(columns):
+    """
+    每个任务的匹配键 (订单号, 商品编码, 工序号, 批次)，批次为同一工序按开始时间的序号。
+    列已按开始时间排好序，一遍计数即可。
+    """
+    counters = defaultdict(int)
+    keys = []
+    for key in zip(columns['order_code'], columns['product_code'], columns['process_i']):
+        batch = counters[key]
+        counters[key] = batch + 1
+        keys.append(key + (batch,))
+    return keys
+
+
+def _etas(columns):
+    """订单号 -> 最晚完工（UTC 秒）"""
+    etas = {}
+    for order_code, end in zip(columns['order_code'], columns['task_end_time']):
+        if end is not None and (order_code not in etas or end > etas[order_code]):
+            etas[order_code] = end
+    return etas
+
+
+def _task(columns, i):
+    return {
+        'device_name': columns['device_name'][i],
+        'task_start_time': _time(columns['task_start_time'][i]),
+        'task_end_time': _time(columns['task_end_time'][i]),
+        'product_num': columns['product_num'][i],
+    }
+
+
+def _record(key):
+    return {'order_code': key[0], 'product_code': key[1], 'process_i': key[2], 'batch': key[3]}
+
+
+def diff_schedules(base, target, limit=DIFF_LIMIT):
+    """
+    比较两份列式排产结果，按 (订单号, 商品编码, 工序号, 批次) 的哈希表配对，O(n)。
+    换了设备的记为 reassigned，同一设备上开始时间变化的记为 moved，只在一边出现的记为 added/removed；
+    订单预计完工（最晚完工的任务）的变化记在 eta，单位分钟，按变化幅度排序。
+    明细每类最多 limit 条，summary 中是完整计数。
+    """
+    index = {key: i for i, key in enumerate(_keys(base))}
+    # 先只记下标，明细只为前 limit 条生成
+    moved = []
+    reassigned = []
+    added = []
+    unchanged = 0
+    base_starts = base['task_start_time']
+    base_devices = base['device_name']
+    target_starts = target['task_start_time']
+    target_devices = target['device_name']
+    for j, key in enumerate(_keys(target)):
+        i = index.pop(key, None)
+        if i is None:
+            added.append((key, j))
+        elif base_devices[i] != target_devices[j]:
+            reassigned.append((key, i, j))
+        elif base_starts[i] != target_starts[j]:
+            moved.append((key, i, j))
+        else:
+            unchanged += 1
+    removed = list(index.items())
+
+    def changed(key, i, j):
+        return dict(_record(key), old=_task(base, i), new=_task(target, j),
+                    shift_minutes=(target_starts[j] - base_starts[i]) / 60)
+
+    old_etas = _etas(base)
+    new_etas = _etas(target)
+    eta = []
+    for order_code in old_etas.keys() | new_etas.keys():
+        old = old_etas.get(order_code)
+        new = new_etas.get(order_code)
+        if old == new:
+            continue
+        eta.append({'order_code': order_code, 'old': _time(old), 'new': _time(new),
+                    'delta_minutes': (new - old) / 60 if old is not None and new is not None else None})
+    eta.sort(key=lambda item: -abs(item['delta_minutes']) if item['delta_minutes'] is not None else -float('inf'))
+
+    return {
+        'summary': {
+            'base_tasks': len(base['order_code']),
+            'target_tasks': len(target['order_code']),
+            'unchanged': unchanged,
+            'moved': len(moved),
+            'reassigned': len(reassigned),
+            'added': len(added),
+            'removed': len(removed),
+            'eta_changed': len(eta),
+        },
+        'moved': [changed(*item) for item in moved[:limit]],
+        'reassigned': [changed(*item) for item in reassigned[:limit]],
+        'added': [dict(_record(key), new=_task(target, j)) for key, j in added[:limit]],
+        'removed': [dict(_record(key), old=_task(base, i)) for key, i in removed[:limit]],
+        'eta': eta[:limit],
+    }
@@ -0,0 +1,133 @@
+import json
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .shop_calendar import SHOP_CALENDAR
+from ..models import Device, DurationStat
+
+# 跟踪的分位数；排产可以用其中之一或平均值代替 Process.process_duration
+QUANTILES = (0.5, 0.9)
+DURATION_STATS = ('mean', 'p50', 'p90')
+# 样本数少于这个值的统计不参与排产
+MIN_SAMPLES = 5
+# 实际时长超过计划时长这么多倍的样本（中途停机、忘了报工）不记录
+MAX_OVERRUN = 3
+
+
+class P2Quantile:
+    """
+    P² 算法（Jain & Chlamtac）在线估计分位数：只保存 5 个标记的高度和位置，每个样本 O(1) 更新，不保留历史。
+    前 5 个样本直接保存，之后切换为标记。
+    """
+
+    def __init__(self, p, heights=None, positions=None):
+        self.p = p
+        self.heights = list(heights or [])
+        self.positions = list(positions or [])
+
+    def _desired(self, count):
+        p = self.p
+        return [1 + (count - 1) * f for f in (0, p / 2, p, (1 + p) / 2, 1)]
+
+    def add(self, x):
+        q = self.heights
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            if len(q) == 5:
+                self.positions = [1, 2, 3, 4, 5]
+            return
+        n = self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if q[i] <= x < q[i + 1])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        desired = self._desired(n[4])
+        for i in (1, 2, 3):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # 抛物线插值，越界时退回线性插值
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def value(self):
+        q = self.heights
+        if not q:
+            return None
+        if len(q) < 5:
+            return q[min(len(q) - 1, int(self.p * len(q)))]
+        return q[2]
+
+
+def _key(p):
+    return f'p{round(p * 100)}'
+
+
+def record_duration(product_code, process_i, device_name, minutes):
+    """记录一个实际加工时长（工作分钟/批）：Welford 更新均值和方差，P² 更新分位数"""
+    with transaction.atomic():
+        stat, _ = DurationStat.objects.select_for_update().get_or_create(
+            product_code=product_code, process_i=process_i, device_name=device_name)
+        stat.count += 1
+        delta = minutes - stat.mean
+        stat.mean += delta / stat.count
+        stat.m2 += delta * (minutes - stat.mean)
+
+        markers = json.loads(stat.quantiles or '{}')
+        for p in QUANTILES:
+            state = markers.get(_key(p), {})
+            estimator = P2Quantile(p, state.get('heights'), state.get('positions'))
+            estimator.add(minutes)
+            markers[_key(p)] = {'heights': estimator.heights, 'positions': estimator.positions,
+                                'value': estimator.value()}
+        stat.quantiles = json.dumps(markers)
+        stat.save()
+    return stat
+
+
+def record_completion(task, finished_at=None, calendar=SHOP_CALENDAR):
+    """
+    任务报完工时记录实际时长。任务没有记录实际开工时间，按计划开始时间和同一设备上一次报完工时刻中较晚的一个
+    到完工时刻之间的工作分钟计（前一个任务拖后时，这个任务不可能按计划开工）。
+    完工不晚于开工（提前做完）或超过计划时长 MAX_OVERRUN 倍时没有可信的时长，不记录。
+    """
+    finished_at = finished_at or timezone.now()
+    devices = Device.objects.filter(device_name=task.device_name)
+    previous = devices.values_list('last_completed_at', flat=True).first()
+    devices.filter(Q(last_completed_at__isnull=True) | Q(last_completed_at__lt=finished_at)).update(
+        last_completed_at=finished_at)
+
+    started_at = max(task.task_start_time, previous) if previous else task.task_start_time
+    minutes = calendar.offset_of(finished_at) - calendar.offset_of(started_at)
+    planned = calendar.offset_of(task.task_end_time) - calendar.offset_of(task.task_start_time)
+    if minutes <= 0 or (planned > 0 and minutes > MAX_OVERRUN * planned):
+        return None
+    return record_duration(task.product_code, task.process_i, task.device_name, float(minutes))
+
+
+def load_learned_durations(stat='p50', min_samples=MIN_SAMPLES):
+    """一条查询读出整张统计表：(商品编码, 工序号, 设备名称) -> 学到的时长（工作分钟/批）"""
+    if stat not in DURATION_STATS:
+        raise ValueError(f"Unknown duration statistic: {stat}")
+    learned = {}
+    rows = DurationStat.objects.filter(count__gte=min_samples).values_list(
+        'product_code', 'process_i', 'device_name', 'mean', 'quantiles')
+    for product_code, process_i, device_name, mean, quantiles in rows:
+        value = mean if stat == 'mean' else json.loads(quantiles or '{}').get(stat, {}).get('value')
+        if value and value > 0:
+            learned[product_code, process_i, device_name] = value
+    return learned
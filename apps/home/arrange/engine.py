@@ -0,0 +1,259 @@
+import math
+from collections import defaultdict, namedtuple
+from heapq import heappop, heappush
+
+from django.utils import timezone
+
+from .intake import LineIntake
+from .ledger import RawLedger
+from .rules import compile_rule
+from .shop_calendar import SHOP_CALENDAR
+from ..common.dates import to_date
+
+# planned: 参与本次排产的订单行数；unscheduled: 没能排完的订单行 id；raw_shortage: 毛坯编码 -> 缺料数量
+ROWS_CHUNK_SIZE = 5000
+
+ScheduleResult = namedtuple('ScheduleResult', ['rows', 'planned', 'unscheduled', 'skipped_steps', 'raw_shortage',
+                                               'rule', 'start_date'])
+
+
+def _to_rows(placed, devices, calendar):
+    starts = calendar.times_of([item[3] for item in placed]).to_pydatetime()
+    ends = calendar.times_of([item[4] for item in placed], end=True).to_pydatetime()
+    return [{
+        'task_start_time': start_time,
+        'task_end_time': end_time,
+        'order_code': line.order_code,
+        'product_code': line.product_code,
+        'process_i': step.process_i,
+        'process_name': step.process_name,
+        'device_name': devices[d].name,
+        'product_num': quantity,
+        'is_changeover': int(is_changeover),
+    } for (line, step, d, _, _, is_changeover, quantity), start_time, end_time in zip(placed, starts, ends)]
+
+
+def run_schedule(snapshot, start_date, rule='edd', until=None, calendar=SHOP_CALENDAR, on_progress=None,
+                 window=None, on_rows=None, now=None):
+    """
+    在快照上做贪心排产，不访问数据库。
+
+    时间推进到下一个设备空闲或订单行就绪的时刻；每台空闲设备按派工规则（见 rules.py）挑一批可做的工序，
+    优先挑与设备当前毛坯相同的订单行（免换型），没有时再挑需要换型的。
+    就绪订单行按设备、按（设备, 毛坯）分别放在堆里，每次挑选和入队都是 O(log n)。
+    同一订单行上一道工序的所有批次完工后，下一道工序才能开始。
+    尚未开工的订单行在毛坯库存（含后续入库）够用时才就绪，并在就绪时预留整行所需毛坯；
+    入库全部到齐仍不够的订单行不排，缺料数量记在 raw_shortage 中。
+    until 为工作分钟偏移，到达后停止排产。
+
+    window 为工作分钟：给定时只接入交期早于“当前时间 + window”的订单行，snapshot.lines 应按交期排序
+    （load_snapshot(stream_from=...)）。每批接入的订单行单独编译派工规则，先接入的批次优先；
+    排完的订单行随即释放，内存占用取决于视野内的订单行数，与订单总数无关。
+    给定 on_rows 时排产结果每 ROWS_CHUNK_SIZE 行交给它一次（例如分块写库），返回的 rows 为空。
+    给定 now 时不早于该时刻开始排（当天重排）。
+    订单行第一道待排工序可能已有部分批次在做（line.started），只排剩下的数量。
+    工序带有学到的设备时长（step.durations）时按所选设备的时长排。
+    """
+    origin = calendar.offset_of(calendar.day_start(start_date))
+    if now is not None:
+        origin = max(origin, calendar.offset_of(now))
+    if timezone.is_aware(start_date):
+        start_date = timezone.localtime(start_date, calendar.get_tz())
+    start_day = to_date(start_date)
+
+    devices = snapshot.devices
+    known = {device.name for device in devices}
+    usable = [i for i, device in enumerate(devices) if not device.is_fault]
+    device_index = {devices[i].name: i for i in usable}
+    changeover = [device.changeover for device in devices]
+    dev_raw = [device.raw for device in devices]
+    dev_free = [origin] * len(devices)
+    for i, device in enumerate(devices):
+        if device.end_time:
+            dev_free[i] = max(origin, calendar.offset_of(device.end_time))
+
+    intake = LineIntake(snapshot.lines, calendar)
+    ledger = RawLedger(snapshot.receipts, origin, calendar)
+
+    # 在排订单行的状态，以接入顺序编号；订单行排完或缺料后即删除
+    lines = {}
+    steps = {}
+    keys = {}
+    pos = {}
+    remaining = {}
+    cur_end = {}
+    needs_raw = {}
+    blocked = []
+    starved = []
+    skipped_steps = 0
+    planned = 0
+    batches = 0
+
+    # 堆元素为 (排序键, 订单行, 工序位置)；订单行已换到下一道工序的元素视为过期，取堆顶时丢弃
+    by_device = defaultdict(list)
+    by_device_raw = defaultdict(list)
+    # 同一时刻就绪的订单行按排序键依次预留毛坯
+    waiting = []
+
+    def admit(horizon):
+        """接入交期不晚于 horizon 的订单行"""
+        nonlocal skipped_steps, planned, batches
+        batch_lines = []
+        batch_steps = []
+        for line in intake.take(horizon):
+            if (line.order_start_date and line.order_start_date > start_day) or line.todo - line.started <= 0:
+                continue
+            route = []
+            for step in snapshot.routes.get(line.product_code, ()):
+                if step.process_i <= line.cur_process_i:
+                    continue
+                if step.is_outside or not known.intersection(step.devices):
+                    # 外协工序或没有对应设备的工序不占用车间设备，直接跳过
+                    skipped_steps += 1
+                    continue
+                candidates = tuple(device_index[name] for name in step.devices if name in device_index)
+                if not candidates:
+                    # 可用设备都在故障中，该订单行只能排到这道工序之前
+                    blocked.append(line.id)
+                    break
+                if step.durations:
+                    step = step._replace(durations={device_index[name]: minutes
+                                                    for name, minutes in step.durations.items()
+                                                    if name in device_index})
+                route.append(step._replace(devices=candidates))
+            if route:
+                batch_lines.append(line)
+                batch_steps.append(route)
+        if not batch_lines:
+            return
+
+        batch_keys = compile_rule(rule, batch_lines, batch_steps, origin, calendar).tolist()
+        for line, route, key in zip(batch_lines, batch_steps, batch_keys):
+            k = planned
+            planned += 1
+            ready = origin
+            if line.end_time:
+                ready = max(origin, calendar.offset_of(line.end_time))
+            lines[k] = line
+            steps[k] = route
+            keys[k] = (batches, key)
+            pos[k] = 0
+            remaining[k] = line.todo - line.started
+            cur_end[k] = ready
+            needs_raw[k] = line.cur_process_i == 0 and ledger.tracks(line.raw)
+            heappush(waiting, (ready, keys[k], k))
+        batches += 1
+
+    def retire(k):
+        for state in (lines, steps, keys, pos, remaining, cur_end, needs_raw):
+            del state[k]
+
+    def release(now):
+        """把就绪时间已到的订单行放入其当前工序可用设备的就绪堆"""
+        while waiting and waiting[0][0] <= now:
+            _, _, k = heappop(waiting)
+            line = lines[k]
+            if needs_raw[k]:
+                need = line.todo - line.started
+                if not ledger.reserve(line.raw, need, now):
+                    arrival = ledger.next_available(line.raw, need)
+                    if arrival is None:
+                        starved.append(line)
+                        retire(k)
+                    else:
+                        heappush(waiting, (arrival, keys[k], k))
+                    continue
+                needs_raw[k] = False
+            entry = (keys[k], k, pos[k])
+            for d in steps[k][pos[k]].devices:
+                heappush(by_device[d], entry)
+                heappush(by_device_raw[d, line.raw], entry)
+
+    def top(heap):
+        while heap:
+            _, k, p = heap[0]
+            if pos.get(k) == p:
+                return k
+            heappop(heap)
+        return None
+
+    def pick(d):
+        k = top(by_device_raw[d, dev_raw[d]])
+        if k is None:
+            k = top(by_device[d])
+        return k
+
+    placed = []
+    now = origin
+    events = 0
+    while True:
+        if window is None:
+            admit(math.inf)
+        elif not lines:
+            # 视野内已经排空，直接接入下一批
+            while not lines and intake.next_due() is not None:
+                admit(max(now + window, intake.next_due()))
+        else:
+            admit(now + window)
+        if not lines:
+            break
+        if until is not None and now >= until:
+            break
+        release(now)
+        progressed = False
+        for d in usable:
+            if dev_free[d] > now:
+                continue
+            k = pick(d)
+            if k is None:
+                continue
+            line = lines[k]
+            step = steps[k][pos[k]]
+            is_changeover = dev_raw[d] != line.raw
+            duration = step.durations.get(d, step.duration) if step.durations else step.duration
+            end = now + duration + (changeover[d] if is_changeover else 0)
+            quantity = min(step.capacity, remaining[k])
+            placed.append((line, step, d, now, end, is_changeover, quantity))
+            dev_free[d] = end
+            dev_raw[d] = line.raw
+            remaining[k] -= quantity
+            if end > cur_end[k]:
+                cur_end[k] = end
+            if remaining[k] <= 0:
+                # 这道工序的批次已全部排出，全部完工后进入下一道
+                pos[k] += 1
+                if pos[k] == len(steps[k]):
+                    retire(k)
+                else:
+                    remaining[k] = line.todo
+                    heappush(waiting, (cur_end[k], keys[k], k))
+            progressed = True
+        if on_rows and len(placed) >= ROWS_CHUNK_SIZE:
+            on_rows(_to_rows(placed, devices, calendar))
+            placed = []
+
+        events += 1
+        if on_progress and events % 256 == 0:
+            on_progress((planned - len(lines)) / planned)
+        if progressed:
+            continue
+        future = [dev_free[d] for d in usable if dev_free[d] > now]
+        if waiting:
+            future.append(waiting[0][0])
+        if window is not None and intake.next_due() is not None:
+            future.append(intake.next_due() - window)
+        future = [moment for moment in future if moment > now]
+        if not future:
+            break
+        now = min(future)
+
+    rows = _to_rows(placed, devices, calendar)
+    if on_rows:
+        on_rows(rows)
+        rows = []
+    unscheduled = sorted(set(blocked).union(line.id for line in starved).union(line.id for line in lines.values()))
+    demand = defaultdict(int)
+    for line in starved:
+        demand[line.raw] += line.todo - line.started
+    raw_shortage = {raw: ledger.shortage(raw, quantity) for raw, quantity in demand.items()}
+    return ScheduleResult(rows, planned, unscheduled, skipped_steps, raw_shortage, rule, start_date)
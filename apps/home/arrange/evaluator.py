@@ -0,0 +1,183 @@
+from collections import namedtuple
+
+# 一道待排工序（一批）。时间全部使用工作分钟偏移，见 shop_calendar.ShopCalendar
+# line: 订单行编号；devices: 可选设备编号；due: 交期偏移（None 表示无交期）；
+# weight: 拖期权重，只有订单行最后一道工序的批次非 0；
+# durations: 设备编号 -> 该设备上的时长（学到的设备时长，见 durations.py），缺省都用 duration
+Operation = namedtuple('Operation', ['line', 'process_i', 'duration', 'raw', 'devices', 'due', 'weight',
+                                     'durations'], defaults=(None,))
+
+# 排产方案。order 为工序执行的全局顺序（ops 下标），assign 为每道工序分配的设备编号
+Plan = namedtuple('Plan', ['ops', 'order', 'assign', 'changeover', 'device_raw', 'device_free', 'line_ready',
+                           'origin'])
+
+DEFAULT_WEIGHTS = {
+    'tardiness': 1.0,
+    'changeover': 1.0,
+    'makespan': 0.1,
+}
+
+
+class PlanEvaluator:
+    """
+    排产方案评估器。
+
+    按 order 的顺序逐道工序解码：开工时间取设备空闲时间与同一订单行上一道工序完工时间的较大者，
+    原料与设备上一件不同时计入换型时间。序列按固定长度分段，每段开头保存一次解码状态；
+    局部改动只需从改动所在段重新解码，一旦某个段边界的状态与改动前一致，后面各段直接复用。
+    """
+
+    def __init__(self, plan, order=None, assign=None, weights=None, segment_size=None):
+        self.plan = plan
+        self.ops = plan.ops
+        self.order = list(plan.order if order is None else order)
+        self.assign = list(plan.assign if assign is None else assign)
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.segment_size = segment_size or max(256, -(-len(self.order) // 64))
+        self._pending = None
+        self.rebuild()
+
+    def _decode(self, pos_from, pos_to, dev_free, dev_raw, lines, base, record=None):
+        """解码 [pos_from, pos_to) 区间，原地更新状态，返回该段的 (换型次数, 换型分钟, 最晚完工, 拖期)"""
+        ops = self.ops
+        order = self.order
+        assign = self.assign
+        changeover = self.plan.changeover
+        line_ready = self.plan.line_ready
+        origin = self.plan.origin
+
+        co_count = 0
+        co_minutes = 0.0
+        max_end = origin
+        tardiness = 0.0
+        for pos in range(pos_from, pos_to):
+            k = order[pos]
+            op = ops[k]
+            d = assign[k]
+
+            state = lines.get(op.line)
+            if state is None:
+                state = base.get(op.line)
+            if state is None:
+                ready = line_ready.get(op.line, origin)
+                cur_end = ready
+            else:
+                cur, ready, cur_end = state
+                if op.process_i != cur:
+                    # 上一道工序的所有批次完工后才能开始下一道
+                    ready = cur_end
+
+            start = dev_free[d] if dev_free[d] > ready else ready
+            end = start + (op.duration if op.durations is None else op.durations.get(d, op.duration))
+            is_changeover = dev_raw[d] != op.raw
+            if is_changeover:
+                end += changeover[d]
+                co_count += 1
+                co_minutes += changeover[d]
+            dev_free[d] = end
+            dev_raw[d] = op.raw
+            if end > cur_end:
+                cur_end = end
+            lines[op.line] = (op.process_i, ready, cur_end)
+
+            if end > max_end:
+                max_end = end
+            if op.weight and op.due is not None and end > op.due:
+                tardiness += (end - op.due) * op.weight
+            if record is not None:
+                record[k] = (start, end, is_changeover)
+        return co_count, co_minutes, max_end, tardiness
+
+    def _score(self, sums):
+        co_minutes = sum(s[1] for s in sums)
+        makespan = max(s[2] for s in sums) - self.plan.origin if sums else 0.0
+        tardiness = sum(s[3] for s in sums)
+        return (self.weights['tardiness'] * tardiness +
+                self.weights['changeover'] * co_minutes +
+                self.weights['makespan'] * makespan)
+
+    def rebuild(self):
+        """完整解码一次，重建各段的起始状态"""
+        size = self.segment_size
+        n = len(self.order)
+        dev_free = list(self.plan.device_free)
+        dev_raw = list(self.plan.device_raw)
+        lines = {}
+        self.checkpoints = []
+        self.sums = []
+        for pos in range(0, n, size):
+            self.checkpoints.append((list(dev_free), list(dev_raw), dict(lines)))
+            self.sums.append(self._decode(pos, min(pos + size, n), dev_free, dev_raw, lines, {}))
+        self.score = self._score(self.sums)
+        self._pending = None
+
+    def propose(self, lo, hi):
+        """
+        调用方已改动 order/assign 的 [lo, hi] 区间，计算改动后的得分。
+        之后必须调用 accept() 或 reject()（reject 前由调用方自行还原改动）。
+        """
+        size = self.segment_size
+        n = len(self.order)
+        first = lo // size
+        dev_free, dev_raw, base = self.checkpoints[first]
+        dev_free = list(dev_free)
+        dev_raw = list(dev_raw)
+        overlay = {}
+
+        boundaries = []
+        sums = []
+        seg = first
+        while seg < len(self.sums):
+            pos = seg * size
+            sums.append(self._decode(pos, min(pos + size, n), dev_free, dev_raw, overlay, base))
+            seg += 1
+            if seg >= len(self.sums):
+                break
+            if seg * size > hi:
+                cp_free, cp_raw, cp_lines = self.checkpoints[seg]
+                if cp_free == dev_free and cp_raw == dev_raw and all(
+                        cp_lines.get(line) == state for line, state in overlay.items()):
+                    break
+                boundaries.append((seg, list(dev_free), list(dev_raw), dict(overlay), False))
+            else:
+                # 边界落在改动区间内，改动前后该段包含的工序不同，只能保存完整状态
+                full = dict(base)
+                full.update(overlay)
+                boundaries.append((seg, list(dev_free), list(dev_raw), full, True))
+
+        new_sums = self.sums[:first] + sums + self.sums[first + len(sums):]
+        score = self._score(new_sums)
+        self._pending = (score, new_sums, boundaries)
+        return score
+
+    def accept(self):
+        score, sums, boundaries = self._pending
+        for seg, dev_free, dev_raw, lines, full in boundaries:
+            if full:
+                self.checkpoints[seg] = (dev_free, dev_raw, lines)
+            else:
+                cp_lines = self.checkpoints[seg][2]
+                cp_lines.update(lines)
+                self.checkpoints[seg] = (dev_free, dev_raw, cp_lines)
+        self.sums = sums
+        self.score = score
+        self._pending = None
+
+    def reject(self):
+        self._pending = None
+
+    def schedule(self):
+        """返回每道工序（ops 下标）的 (开工偏移, 完工偏移, 是否换型)"""
+        record = [None] * len(self.ops)
+        self._decode(0, len(self.order), list(self.plan.device_free), list(self.plan.device_raw), {}, {}, record)
+        return record
+
+    def totals(self):
+        """汇总指标：换型次数、换型分钟、完工跨度、加权拖期"""
+        return {
+            'changeover_count': sum(s[0] for s in self.sums),
+            'changeover_minutes': sum(s[1] for s in self.sums),
+            'makespan': max(s[2] for s in self.sums) - self.plan.origin if self.sums else 0.0,
+            'tardiness': sum(s[3] for s in self.sums),
+            'score': self.score,
+        }
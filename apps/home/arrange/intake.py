@@ -0,0 +1,49 @@
+import math
+from collections import deque
+from itertools import islice
+
+from .kpi import due_offsets
+from .shop_calendar import SHOP_CALENDAR
+
+INTAKE_CHUNK_SIZE = 2000
+
+
+class LineIntake:
+    """
+    订单行入口：从列表或按交期排序的迭代器里分块取订单行，只缓冲一块。
+    交期无法解析的订单行视为马上需要，随取随放行。
+    """
+
+    def __init__(self, lines, calendar=SHOP_CALENDAR, chunk_size=INTAKE_CHUNK_SIZE):
+        self.lines = iter(lines)
+        self.calendar = calendar
+        self.chunk_size = chunk_size
+        self.buffer = deque()
+        self.exhausted = False
+
+    def _fill(self):
+        if self.buffer or self.exhausted:
+            return
+        chunk = list(islice(self.lines, self.chunk_size))
+        if not chunk:
+            self.exhausted = True
+            return
+        dues = due_offsets([line.due_date for line in chunk], self.calendar)
+        self.buffer.extend(zip(dues.tolist(), chunk))
+
+    def next_due(self):
+        """下一条订单行的交期偏移（未知为 -inf），没有了返回 None"""
+        self._fill()
+        if not self.buffer:
+            return None
+        due = self.buffer[0][0]
+        return -math.inf if due == math.inf else due
+
+    def take(self, horizon):
+        """取出交期不晚于 horizon 的订单行"""
+        taken = []
+        while True:
+            due = self.next_due()
+            if due is None or due > horizon:
+                return taken
+            taken.append(self.buffer.popleft()[1])
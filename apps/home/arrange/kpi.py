@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+from .shop_calendar import SHOP_CALENDAR
+from ..common.frames import queryset_frame
+from ..models import Device, Order, Task
+
+TASK_FIELDS = ('id', 'task_start_time', 'task_end_time', 'is_changeover', 'order_code', 'product_code',
+               'process_i', 'device_name', 'product_num')
+TASK_DATETIME_FIELDS = ('task_start_time', 'task_end_time')
+
+# Task.is_changeover 历史上存过 'Yes'/'No' 和 0/1 两种写法
+CHANGEOVER_FLAGS = ('1', 'Yes', 'yes', 'True', 'true')
+
+# 在制曲线最多的点数：跨度过长（例如误录了很远的日期）时按天、再按多天取点，返回的数据量有上限
+MAX_WIP_POINTS = 500
+DAY_MINUTES = 24 * 60
+
+
+def load_tasks(queryset=None):
+    """一条查询读出排产结果"""
+    if queryset is None:
+        queryset = Task.objects.all()
+    return queryset_frame(queryset, TASK_FIELDS, TASK_DATETIME_FIELDS)
+
+
+def due_minutes(order_end_dates, calendar=SHOP_CALENDAR):
+    """交货日期（date）当天结束时的挂钟分钟，没有交货日期的为 NaN"""
+    days = pd.to_datetime(pd.Series(order_end_dates, dtype=object), errors='coerce')
+    minutes = (days + pd.Timedelta(days=1) - pd.Timestamp('1970-01-01')) // pd.Timedelta(minutes=1)
+    return minutes.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def due_offsets(order_end_dates, calendar=SHOP_CALENDAR):
+    """交货日期当天结束时的工作分钟偏移，没有交货日期的为 +inf"""
+    minutes = due_minutes(order_end_dates, calendar)
+    due = np.full(len(minutes), np.inf)
+    known = ~np.isnan(minutes)
+    due[known] = calendar.working_offsets(minutes[known].astype(np.int64))
+    return due
+
+
+def schedule_kpis(tasks=None, due_dates=None, changeover_times=None, wip_step=60, calendar=SHOP_CALENDAR):
+    """
+    排产指标：完工跨度、订单拖期、换型次数和时长、设备利用率、在制订单行数随时间的变化。
+    完工跨度、拖期都是工作分钟（按车间日历去掉休息时间），与排产和优化的目标函数同一口径。
+    在制曲线每 wip_step 分钟一个点，点数超过 MAX_WIP_POINTS 时改为按天（或按多天）取点。
+
+    tasks 为 load_tasks() 格式的 DataFrame，缺省时读取当前 Task 表；
+    due_dates（订单号 -> 交货日期）与 changeover_times（设备名 -> 换型分钟）缺省时各查一次数据库。
+    所有计算按列向量完成。
+    """
+    if tasks is None:
+        tasks = load_tasks()
+    if tasks.empty:
+        return {
+            'task_count': 0,
+            'start': None,
+            'end': None,
+            'makespan_minutes': 0,
+            'changeover_count': 0,
+            'changeover_minutes': 0.0,
+            'late_orders': 0,
+            'total_tardiness_minutes': 0.0,
+            'order_tardiness': {},
+            'device_utilisation': {},
+            'wip_times': [],
+            'wip_counts': [],
+        }
+    if due_dates is None:
+        due_dates = dict(Order.objects.values_list('order_code', 'order_end_date'))
+    if changeover_times is None:
+        changeover_times = dict(Device.objects.values_list('device_name', 'changeover_time'))
+
+    start = calendar.to_minutes(tasks['task_start_time'])
+    end = calendar.to_minutes(tasks['task_end_time'])
+    work_start = calendar.working_offsets(start)
+    work_end = calendar.working_offsets(end)
+    horizon = int(work_end.max() - work_start.min())
+
+    # 换型
+    is_changeover = tasks['is_changeover'].astype(str).isin(CHANGEOVER_FLAGS).to_numpy()
+    changeover_per_task = pd.to_numeric(tasks['device_name'].map(changeover_times), errors='coerce').fillna(0.0)
+    changeover_minutes = float(changeover_per_task.to_numpy()[is_changeover].sum())
+
+    # 设备利用率：设备占用的工作分钟 / 排产跨度内的工作分钟
+    busy = pd.Series(work_end - work_start).groupby(tasks['device_name'].to_numpy()).sum()
+    utilisation = (busy / horizon).round(4) if horizon > 0 else busy * 0.0
+
+    # 订单拖期：订单最后一道任务的完工时间与交货日期当天结束比较，都换算为工作分钟
+    completion = pd.Series(work_end).groupby(tasks['order_code'].to_numpy()).max()
+    due = due_offsets([due_dates.get(code) for code in completion.index], calendar)
+    tardiness = pd.Series(np.clip(completion.to_numpy() - due, 0, None), index=completion.index)
+    late = tardiness[tardiness > 0]
+
+    # 在制：订单行第一道任务开工到最后一道任务完工之间视为在制
+    lines = pd.DataFrame({'order_code': tasks['order_code'].to_numpy(),
+                          'product_code': tasks['product_code'].to_numpy(),
+                          'start': start, 'end': end})
+    lines = lines.groupby(['order_code', 'product_code']).agg(start=('start', 'min'), end=('end', 'max'))
+    step, time_format = wip_step, '%m-%d %H:%M'
+    if (end.max() - start.min()) / step > MAX_WIP_POINTS:
+        days = max(1, int(np.ceil((end.max() - start.min()) / DAY_MINUTES / MAX_WIP_POINTS)))
+        step, time_format = days * DAY_MINUTES, '%Y-%m-%d'
+    grid = np.arange(start.min() // step * step, end.max() + step, step)
+    wip = (np.searchsorted(np.sort(lines['start'].to_numpy()), grid, side='right') -
+           np.searchsorted(np.sort(lines['end'].to_numpy()), grid, side='right'))
+    wip_times = (pd.Timestamp('1970-01-01') + pd.to_timedelta(grid, unit='m')).strftime(time_format)
+
+    return {
+        'task_count': int(len(tasks)),
+        'start': tasks['task_start_time'].min(),
+        'end': tasks['task_end_time'].max(),
+        'makespan_minutes': horizon,
+        'changeover_count': int(is_changeover.sum()),
+        'changeover_minutes': changeover_minutes,
+        'late_orders': int(len(late)),
+        'total_tardiness_minutes': float(late.sum()),
+        'order_tardiness': {code: float(minutes) for code, minutes in late.items()},
+        'device_utilisation': {name: float(value) for name, value in utilisation.items()},
+        'wip_times': list(wip_times),
+        'wip_counts': wip.tolist(),
+    }
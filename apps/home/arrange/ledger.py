@@ -0,0 +1,85 @@
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import accumulate
+
+import pandas as pd
+
+from .shop_calendar import SHOP_CALENDAR
+
+
+class RawLedger:
+    """
+    毛坯库存台账：期初库存 + 按到货时间排序的入库。
+
+    入库日期不晚于排产开始日（或日期无法解析）的计入期初库存，之后的按到货当天第一个班次开始时入库。
+    排产时间只会向前推进，查询和预留都是 O(1)（入库指针均摊推进）。
+    Raw 表里没有记录的毛坯视为没有库存数据，不受约束。
+    """
+
+    def __init__(self, receipts, origin, calendar=SHOP_CALENDAR):
+        stock = {}
+        future = defaultdict(list)
+        for raw_code, date_add, num in receipts:
+            stock.setdefault(raw_code, 0)
+            day = pd.to_datetime(date_add, errors='coerce') if date_add else pd.NaT
+            arrival = origin if pd.isna(day) else calendar.offset_of(calendar.day_start(day.to_pydatetime()))
+            if arrival <= origin:
+                stock[raw_code] += num
+            else:
+                future[raw_code].append((arrival, num))
+
+        self.available = dict(stock)
+        self.arrivals = {}
+        self.cumulative = {}
+        self.pointer = {}
+        for raw_code, items in future.items():
+            items.sort()
+            self.arrivals[raw_code] = [arrival for arrival, _ in items]
+            self.cumulative[raw_code] = list(accumulate(num for _, num in items))
+            self.pointer[raw_code] = 0
+
+    def tracks(self, raw_code):
+        return raw_code in self.available
+
+    def _received(self, raw_code, i):
+        return self.cumulative[raw_code][i - 1] if i else 0
+
+    def _advance(self, raw_code, now):
+        """把到货时间不晚于 now 的入库计入可用量"""
+        arrivals = self.arrivals.get(raw_code)
+        if not arrivals:
+            return
+        i = self.pointer[raw_code]
+        j = i
+        while j < len(arrivals) and arrivals[j] <= now:
+            j += 1
+        if j != i:
+            self.available[raw_code] += self._received(raw_code, j) - self._received(raw_code, i)
+            self.pointer[raw_code] = j
+
+    def reserve(self, raw_code, quantity, now):
+        """库存够用时预留并返回 True，否则不做改动返回 False"""
+        if not self.tracks(raw_code):
+            return True
+        self._advance(raw_code, now)
+        if self.available[raw_code] < quantity:
+            return False
+        self.available[raw_code] -= quantity
+        return True
+
+    def next_available(self, raw_code, quantity):
+        """可用量（含后续入库）最早够 quantity 的到货时间；入库全部到齐仍不够时返回 None"""
+        arrivals = self.arrivals.get(raw_code)
+        if not arrivals:
+            return None
+        i = self.pointer[raw_code]
+        need = quantity - self.available[raw_code] + self._received(raw_code, i)
+        j = bisect_left(self.cumulative[raw_code], need, lo=i)
+        return arrivals[j] if j < len(arrivals) else None
+
+    def shortage(self, raw_code, quantity):
+        """入库全部到齐后仍缺的数量"""
+        arrivals = self.arrivals.get(raw_code)
+        pending = self._received(raw_code, len(arrivals)) - self._received(raw_code, self.pointer[raw_code]) \
+            if arrivals else 0
+        return max(0, quantity - self.available[raw_code] - pending)
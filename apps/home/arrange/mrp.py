@@ -0,0 +1,109 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from django.db.models import Min
+from django.utils import timezone
+
+from .shop_calendar import SHOP_CALENDAR
+from ..common.frames import queryset_frame
+from ..models import OrderProduct, Product, Raw, Task
+
+# 毛坯需求计划。raws 为 Raw 表中有记录的毛坯编码，dates 为按天的时间桶（第一个是今天）；
+# opening/receipts/demand/projected/shortage 都是 (毛坯, 日期) 的数组：期初库存、当天入库、当天需求、
+# 当天结束时的预计库存和缺口（预计库存为负的部分）。
+# lines 按订单行 id 索引：毛坯编码、需用日期、需求数量、按需用日期依次分配后该毛坯的预计结余（未跟踪的毛坯为 NaN）
+MrpResult = namedtuple('MrpResult', ['raws', 'names', 'dates', 'opening', 'receipts', 'demand', 'projected',
+                                     'shortage', 'lines'])
+
+
+def _dates(values):
+    return pd.to_datetime(pd.Series(values, dtype=object), errors='coerce').dt.normalize()
+
+
+def load_demand(today, raw_codes):
+    """
+    还没开始第一道工序的未完成订单行所需的毛坯。
+    需用日期取该订单行排产结果中最早任务的开始日期，没有排上时取下单日期；早于今天的按今天算。
+    """
+    lines = queryset_frame(
+        OrderProduct.objects.filter(is_done=False, order__is_done=False, cur_process_i=0),
+        ('id', 'order__order_code', 'order__order_start_date', 'order__order_end_date', 'product_code',
+         'product_num_todo', 'product_num_done'))
+    starts = queryset_frame(
+        Task.objects.values('order_code', 'product_code').annotate(start=Min('task_start_time')),
+        ('order_code', 'product_code', 'start'), ('start',))
+    if not starts.empty:
+        starts['start'] = starts['start'].dt.tz_convert(SHOP_CALENDAR.get_tz()).dt.tz_localize(None).dt.normalize()
+    lines = lines.merge(starts, how='left', left_on=['order__order_code', 'product_code'],
+                        right_on=['order_code', 'product_code'])
+
+    need = lines['start'] if 'start' in lines else pd.Series(pd.NaT, index=lines.index)
+    need = need.fillna(_dates(lines['order__order_start_date'])).fillna(today).clip(lower=today)
+    return pd.DataFrame({
+        'id': lines['id'].to_numpy(),
+        'raw': lines['product_code'].map(raw_codes).to_numpy(),
+        'need_date': need.to_numpy(),
+        'due_date': _dates(lines['order__order_end_date']).to_numpy(),
+        'quantity': (lines['product_num_todo'] - lines['product_num_done']).clip(lower=0).to_numpy(),
+    })
+
+
+def run_mrp(calendar=SHOP_CALENDAR):
+    """
+    把未完成订单行展开为按天的毛坯需求，与 Raw 表的库存和后续入库做净需求计算，共四条查询，其余按数组计算。
+    入库日期不晚于今天（或无法解析）的计入期初库存，与排产的毛坯台账（ledger.py）一致。
+    """
+    today = pd.Timestamp(timezone.localtime(timezone.now(), calendar.get_tz()).date())
+    raw_codes = dict(Product.objects.exclude(raw_code=None).exclude(raw_code='').values_list(
+        'product_code', 'raw_code'))
+    receipts = queryset_frame(Raw.objects.exclude(raw_code=None), ('raw_code', 'raw_name', 'raw_date_add', 'raw_num'))
+    demand = load_demand(today, raw_codes)
+
+    raws = sorted(receipts['raw_code'].unique())
+    names = receipts.drop_duplicates('raw_code').set_index('raw_code')['raw_name'].reindex(raws).tolist()
+    arrival = _dates(receipts['raw_date_add'])
+    future = arrival > today
+    tracked = demand['raw'].isin(raws).to_numpy()
+    dates = pd.DatetimeIndex(sorted({today} | set(arrival[future]) | set(demand['need_date'][tracked])))
+
+    raw_index = pd.Index(raws)
+    opening = np.zeros(len(raws))
+    np.add.at(opening, raw_index.get_indexer(receipts['raw_code'][~future]), receipts['raw_num'][~future])
+    received = np.zeros((len(raws), len(dates)))
+    np.add.at(received, (raw_index.get_indexer(receipts['raw_code'][future]), dates.get_indexer(arrival[future])),
+              receipts['raw_num'][future])
+    needed = np.zeros((len(raws), len(dates)))
+    r = raw_index.get_indexer(demand['raw'][tracked])
+    d = dates.get_indexer(demand['need_date'][tracked])
+    np.add.at(needed, (r, d), demand['quantity'][tracked])
+    available = opening[:, None] + np.cumsum(received, axis=1)
+    projected = available - np.cumsum(needed, axis=1)
+
+    # 订单行逐行分配：同一毛坯按需用日期、交期先后依次扣减，结余 = 需用日期前的可用量 - 累计需求
+    lines = demand.assign(remaining=np.nan)
+    order = lines[tracked].sort_values(['raw', 'need_date', 'due_date', 'id'], na_position='last')
+    cumulative = order.groupby('raw')['quantity'].cumsum().to_numpy()
+    lines.loc[order.index, 'remaining'] = available[raw_index.get_indexer(order['raw']),
+                                                    dates.get_indexer(order['need_date'])] - cumulative
+
+    return MrpResult(raws, names, dates, opening, received, needed, projected, np.clip(-projected, 0, None),
+                     lines.set_index('id'))
+
+
+def raw_summary(result):
+    """每种毛坯：期初库存、后续入库、需求合计、最终结余、最大缺口和开始缺料的日期"""
+    summary = []
+    for i, raw_code in enumerate(result.raws):
+        short = np.flatnonzero(result.shortage[i] > 0)
+        summary.append({
+            'raw_code': raw_code,
+            'raw_name': result.names[i],
+            'on_hand': float(result.opening[i]),
+            'receipts': float(result.receipts[i].sum()),
+            'demand': float(result.demand[i].sum()),
+            'remaining_quantity': float(result.projected[i, -1]) if len(result.dates) else float(result.opening[i]),
+            'shortage': float(result.shortage[i].max()) if len(result.dates) else 0.0,
+            'shortage_date': result.dates[short[0]].date().isoformat() if len(short) else None,
+        })
+    return summary
@@ -0,0 +1,158 @@
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from django.db import transaction
+
+from .diff import archive_schedule
+from .evaluator import Operation, Plan, PlanEvaluator
+from .reschedule import freeze
+from .search import run_restarts
+from .shop_calendar import SHOP_CALENDAR
+from .snapshot import load_snapshot
+from .validator import check_schedule
+from ..common.dates import to_date
+from ..common.relations import resolve_relations
+from ..models import Task
+from ..reports.dashboard import refresh_dashboard, sections_for
+from ..reports.eta import refresh_order_etas
+
+logger = logging.getLogger(__name__)
+
+# 优化只改动这些列，其余列（订单、工序、数量、报工进度）原样保留
+TASK_UPDATE_FIELDS = ('task_start_time', 'task_end_time', 'device_name', 'is_changeover')
+
+# 网页上发起的限时优化最多跑这么多秒（请求线程和单飞锁都要等它结束）
+MAX_OPTIMIZE_SECONDS = 300
+
+
+def due_offset(order_end_date, calendar=SHOP_CALENDAR):
+    """交货日期当天结束时的工作分钟偏移，没有交货日期的为 None"""
+    if order_end_date is None:
+        return None
+    day = datetime.combine(order_end_date, datetime.min.time())
+    return calendar.working_offset(calendar.to_minute(day + timedelta(days=1)))
+
+
+def load_plan(start_date, now=None, durations=None, calendar=SHOP_CALENDAR):
+    """
+    把 Task 表中的当前排产结果（贪心结果）读成 Plan，初始状态与贪心排产相同：同一份快照（load_snapshot，
+    durations 含义相同）里的设备可用时间、设备当前毛坯、订单行就绪时间和各设备上的工序时长。
+    已开工、已报工或已质检的任务（reschedule.is_frozen，now 缺省为 start_date）不参与优化，
+    只用来推迟设备和订单行的可用时间（reschedule.freeze）。
+    返回 (plan, task_ids, device_names)，task_ids[k] 为第 k 道工序对应的 Task id。
+    """
+    snapshot, _, movable = freeze(load_snapshot(durations=durations), list(Task.objects.all()), now or start_date)
+    movable.sort(key=lambda task: (task.task_start_time, task.id))
+    origin = calendar.offset_of(start_date)
+
+    devices = snapshot.devices
+    device_index = {device.name: i for i, device in enumerate(devices)}
+    usable = {device.name for device in devices if not device.is_fault}
+    routes = {(product_code, step.process_i): step
+              for product_code, steps in snapshot.routes.items() for step in steps}
+
+    # 订单行 (订单号, 商品编码) -> 就绪时间、毛坯和交期，与 run_schedule 的取法一致
+    line_index = {}
+    line_ready = {}
+    raws = {}
+    dues = {}
+    for line in snapshot.lines:
+        key = (line.order_code, line.product_code)
+        k = line_index.setdefault(key, len(line_index))
+        ready = max(origin, calendar.offset_of(line.end_time)) if line.end_time else origin
+        line_ready[k] = max(line_ready.get(k, origin), ready)
+        raws[k] = line.raw
+        dues[k] = due_offset(to_date(line.due_date), calendar)
+
+    final_process = {}
+    for task in movable:
+        k = line_index[task.order_code, task.product_code]
+        final_process[k] = max(final_process.get(k, 0), task.process_i)
+    final_batches = Counter(line_index[task.order_code, task.product_code] for task in movable
+                            if task.process_i == final_process[line_index[task.order_code, task.product_code]])
+
+    ops = []
+    assign = []
+    for task in movable:
+        k = line_index[task.order_code, task.product_code]
+        step = routes.get((task.product_code, task.process_i))
+        names = [name for name in (step.devices if step else ()) if name in usable]
+        if task.device_name not in names:
+            names.append(task.device_name)
+        step_durations = step.durations if step and step.durations else {}
+        ops.append(Operation(
+            line=k,
+            process_i=task.process_i,
+            duration=step.duration if step else 0.0,
+            raw=raws[k],
+            devices=tuple(device_index[name] for name in names if name in device_index),
+            due=dues[k],
+            weight=1.0 / final_batches[k] if task.process_i == final_process[k] else 0.0,
+            durations={device_index[name]: minutes for name, minutes in step_durations.items()
+                       if name in device_index} or None,
+        ))
+        assign.append(device_index[task.device_name])
+
+    plan = Plan(
+        ops=ops,
+        order=list(range(len(ops))),
+        assign=assign,
+        changeover=[device.changeover for device in devices],
+        device_raw=[device.raw for device in devices],
+        device_free=[max(origin, calendar.offset_of(device.end_time)) if device.end_time else origin
+                     for device in devices],
+        line_ready=line_ready,
+        origin=origin,
+    )
+    return plan, [task.id for task in movable], [device.name for device in devices]
+
+
+def save_plan(evaluator, task_ids, device_names, calendar=SHOP_CALENDAR):
+    """用评估器解码出的时间和设备更新参与优化的 Task 行（冻结的任务不动），更新前把原来的结果存为一个版本"""
+    record = evaluator.schedule()
+    starts = calendar.times_of([record[k][0] for k in evaluator.order]).to_pydatetime()
+    ends = calendar.times_of([record[k][1] for k in evaluator.order], end=True).to_pydatetime()
+    tasks = [Task(id=task_ids[k], task_start_time=start_time, task_end_time=end_time,
+                  device_name=device_names[evaluator.assign[k]], is_changeover=int(record[k][2]))
+             for k, start_time, end_time in zip(evaluator.order, starts, ends)]
+    with transaction.atomic():
+        archive_schedule('optimisation')
+        Task.objects.bulk_update(tasks, TASK_UPDATE_FIELDS, batch_size=1000)
+        # 换了设备的行重新解析 Task.device
+        resolve_relations(Task, Task.objects.filter(id__in=task_ids))
+    check_schedule('optimisation')
+    refresh_dashboard(sections_for(Task))
+    refresh_order_etas()
+
+
+def optimize_schedule(start_date, time_budget, restarts=None, workers=None, weights=None, now=None,
+                      durations=None):
+    """
+    以 Task 表中的贪心排产为初始解做局部搜索，time_budget 秒内返回。
+    只有找到更好的方案时才更新 Task 表，返回优化前后的指标。now、durations 见 load_plan。
+    """
+    started = time.time()
+    plan, task_ids, device_names = load_plan(start_date, now=now, durations=durations)
+    if not plan.ops:
+        return None
+
+    initial = PlanEvaluator(plan, weights=weights).totals()
+    remaining = time_budget - (time.time() - started)
+    best = run_restarts(plan, max(remaining, 0.0), restarts=restarts, workers=workers, weights=weights)
+
+    evaluator = PlanEvaluator(plan, best['order'], best['assign'], weights)
+    improved = evaluator.score < initial['score']
+    if improved:
+        save_plan(evaluator, task_ids, device_names)
+    summary = {
+        'initial': initial,
+        'best': evaluator.totals(),
+        'improved': improved,
+        'seed': best['seed'],
+        'iterations': best['iterations'],
+        'seconds': round(time.time() - started, 2),
+    }
+    logger.info(f"optimize_schedule: {summary}")
+    return summary
@@ -0,0 +1,45 @@
+import logging
+from contextlib import contextmanager
+
+from django.db import transaction
+
+from .diff import archive_schedule
+from .validator import check_schedule
+from ..common.relations import resolve_relations
+from ..models import Task
+from ..reports.dashboard import refresh_dashboard, sections_for
+from ..reports.eta import refresh_order_etas
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def task_writer():
+    """
+    分块替换 Task 表：进入时清空，返回的函数每次写入一批排产结果行，全部写完才提交。
+    用于流式排产，不需要先把整份结果放在内存里。
+    清空前把原来的结果存为一个版本，便于比较差异；写完后刷新首页看板中依赖 Task 的部分。
+    """
+    written = 0
+
+    def write(rows):
+        nonlocal written
+        Task.objects.bulk_create((Task(**row) for row in rows), batch_size=1000)
+        written += len(rows)
+
+    with transaction.atomic():
+        archive_schedule('publish')
+        Task.objects.all().delete()
+        yield write
+        # bulk_create 不发信号，写完后按编码统一解析外键
+        resolve_relations(Task)
+    logger.info(f"Published schedule with {written} tasks")
+    check_schedule('publish')
+    refresh_dashboard(sections_for(Task))
+    refresh_order_etas()
+
+
+def publish_schedule(rows):
+    """用一次排产结果整体替换 Task 表"""
+    with task_writer() as write:
+        write(rows)
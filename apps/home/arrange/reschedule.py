@@ -0,0 +1,159 @@
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from .diff import archive_schedule
+from .engine import run_schedule
+from .shop_calendar import SHOP_CALENDAR
+from .snapshot import load_snapshot
+from .validator import check_schedule
+from ..common.relations import resolve_relations
+from ..models import Task
+from ..reports.dashboard import refresh_dashboard, sections_for
+from ..reports.eta import refresh_order_etas
+
+logger = logging.getLogger(__name__)
+
+# 重排时比较和更新的字段
+TASK_UPDATE_FIELDS = ('task_start_time', 'task_end_time', 'device_name', 'process_name', 'product_num',
+                      'is_changeover')
+
+
+def is_frozen(task, now):
+    """已开工（开始时间已过或已报工）或已完工、已质检的任务不再移动"""
+    return bool(task.completed or task.inspected or task.product_num_completed or task.task_start_time <= now)
+
+
+def freeze(snapshot, tasks, now):
+    """
+    用冻结的任务调整快照：设备从冻结任务的最晚完工开始可用，订单行从冻结到的工序之后继续排。
+    不属于任何在排订单行的任务（例如紧急插单）一律保留。
+    返回 (调整后的快照, 冻结任务, 可重排的旧任务)。
+    """
+    raws = {line.product_code: line.raw for line in snapshot.lines}
+    planned = {(line.order_code, line.product_code) for line in snapshot.lines}
+    frozen = []
+    movable = []
+    for task in tasks:
+        if (task.order_code, task.product_code) in planned and not is_frozen(task, now):
+            movable.append(task)
+        else:
+            frozen.append(task)
+
+    # 设备：最晚的冻结任务决定可用时间和当前毛坯
+    last = {}
+    for task in frozen:
+        if task.device_name not in last or task.task_end_time > last[task.device_name].task_end_time:
+            last[task.device_name] = task
+    devices = []
+    for device in snapshot.devices:
+        task = last.get(device.name)
+        if task and (device.end_time is None or task.task_end_time > device.end_time):
+            device = device._replace(end_time=task.task_end_time, raw=raws.get(task.product_code, device.raw))
+        devices.append(device)
+
+    # 订单行：每道工序已冻结的数量和最晚完工
+    quantities = defaultdict(lambda: defaultdict(int))
+    ends = defaultdict(dict)
+    for task in frozen:
+        key = (task.order_code, task.product_code)
+        if key not in planned:
+            continue
+        quantities[key][task.process_i] += task.product_num or 0
+        ends[key][task.process_i] = max(ends[key].get(task.process_i, task.task_end_time), task.task_end_time)
+
+    tracked = {receipt[0] for receipt in snapshot.receipts}
+    receipts = list(snapshot.receipts)
+    lines = []
+    for line in snapshot.lines:
+        key = (line.order_code, line.product_code)
+        by_process = quantities.get(key)
+        if not by_process:
+            lines.append(line)
+            continue
+        latest = max(by_process)
+        if by_process[latest] >= line.todo:
+            cursor, started = latest, 0
+            ready = max(ends[key].values())
+        else:
+            # 这道工序只冻结了一部分批次，剩下的批次在前面工序完工后就能开始
+            cursor, started = latest - 1, by_process[latest]
+            ready = max((end for process_i, end in ends[key].items() if process_i < latest), default=None)
+        if line.cur_process_i == 0 and line.raw in tracked:
+            # 冻结的第一道工序已经用掉了毛坯
+            steps = snapshot.routes.get(line.product_code)
+            if steps:
+                receipts.append((line.raw, None, -by_process.get(steps[0].process_i, 0)))
+        if cursor < line.cur_process_i:
+            cursor, started = line.cur_process_i, 0
+        end_time = line.end_time
+        if ready and (end_time is None or ready > end_time):
+            end_time = ready
+        lines.append(line._replace(cur_process_i=cursor, started=started, end_time=end_time))
+
+    return snapshot._replace(lines=lines, devices=devices, receipts=receipts), frozen, movable
+
+
+def apply_changes(rows, movable):
+    """
+    把重排结果和可重排的旧任务按 (订单号, 商品编码, 工序号) 逐批配对，只更新变化的行，多删少补。
+    返回 (更新数, 新建数, 删除数, 有改动的订单号集合)。
+    """
+    existing = defaultdict(list)
+    for task in sorted(movable, key=lambda task: (task.task_start_time, task.id)):
+        existing[task.order_code, task.product_code, task.process_i].append(task)
+    planned = defaultdict(list)
+    for row in sorted(rows, key=lambda row: row['task_start_time']):
+        planned[row['order_code'], row['product_code'], row['process_i']].append(row)
+
+    updates = []
+    creates = []
+    deletes = []
+    orders = set()
+    for key in set(existing) | set(planned):
+        olds = existing.get(key, [])
+        news = planned.get(key, [])
+        for task, row in zip(olds, news):
+            row = dict(row, is_changeover=str(row['is_changeover']))
+            if any(getattr(task, field) != row[field] for field in TASK_UPDATE_FIELDS):
+                for field in TASK_UPDATE_FIELDS:
+                    setattr(task, field, row[field])
+                updates.append(task)
+                orders.add(key[0])
+        if len(olds) != len(news):
+            orders.add(key[0])
+        deletes.extend(task.id for task in olds[len(news):])
+        creates.extend(Task(**row) for row in news[len(olds):])
+
+    with transaction.atomic():
+        if updates or creates or deletes:
+            archive_schedule('reschedule')
+        Task.objects.filter(id__in=deletes).delete()
+        Task.objects.bulk_update(updates, TASK_UPDATE_FIELDS, batch_size=1000)
+        Task.objects.bulk_create(creates, batch_size=1000)
+        if updates or creates:
+            # bulk 写入不发信号，新建的行和换了设备的行按编码解析外键
+            resolve_relations(Task)
+    return len(updates), len(creates), len(deletes), orders
+
+
+def reschedule(now=None, rule='edd', calendar=SHOP_CALENDAR):
+    """
+    当天重排：冻结已开工和已完工的任务，从 now 起只排剩下的工序，只改动有变化的 Task 行。
+    返回 (排产结果, 改动统计)。
+    """
+    now = now or timezone.now()
+    tasks = list(Task.objects.all())
+    snapshot, frozen, movable = freeze(load_snapshot(), tasks, now)
+    result = run_schedule(snapshot, now, rule=rule, calendar=calendar, now=now)
+    updated, created, deleted, orders = apply_changes(result.rows, movable)
+    changes = {'frozen': len(frozen), 'updated': updated, 'created': created, 'deleted': deleted,
+               'unchanged': len(movable) - updated - deleted}
+    logger.info(f"Rescheduled from {now}: {changes}")
+    check_schedule('reschedule')
+    if orders:
+        refresh_dashboard(sections_for(Task))
+        refresh_order_etas(orders)
+    return result, changes
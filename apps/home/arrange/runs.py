@@ -0,0 +1,98 @@
+import json
+import logging
+import time
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from ..models import ScheduleRun
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = 'schedule'
+# 运行超过这么久还没结束的视为进程已经退出，锁可以被接管
+STALE_AFTER = timedelta(hours=6)
+WAIT_TIMEOUT = 30 * 60
+POLL_INTERVAL = 0.5
+
+
+class ScheduleBusy(Exception):
+    """已经有参数不同的排产在运行"""
+
+    def __init__(self, run):
+        super().__init__(f"Schedule run {run.id} is in progress")
+        self.run = run
+
+
+def schedule_summary(result):
+    """ScheduleResult 的摘要，存入 ScheduleRun.summary"""
+    return {
+        'rule': result.rule,
+        'planned': result.planned,
+        'unscheduled': len(result.unscheduled),
+        'raw_shortage': result.raw_shortage,
+    }
+
+
+def _acquire(params):
+    """抢锁：成功返回新的运行记录，否则返回正在运行的记录"""
+    while True:
+        try:
+            with transaction.atomic():
+                return ScheduleRun.objects.create(lock=LOCK_NAME, params=params), True
+        except IntegrityError:
+            pass
+        running = ScheduleRun.objects.filter(lock=LOCK_NAME).first()
+        if running is None:
+            # 刚好结束，重新抢
+            continue
+        if timezone.now() - running.started_at > STALE_AFTER:
+            logger.warning(f"Taking over stale schedule run {running.id}")
+            ScheduleRun.objects.filter(id=running.id, lock=LOCK_NAME).update(
+                lock=None, status=ScheduleRun.FAILED, finished_at=timezone.now(), summary='stale')
+            continue
+        return running, False
+
+
+def _wait(run, timeout=WAIT_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        run.refresh_from_db()
+        if run.status != ScheduleRun.RUNNING:
+            return run
+        time.sleep(POLL_INTERVAL)
+    return run
+
+
+def single_flight(params, func, summarise=None):
+    """
+    同一时间只允许一次排产。
+    没有排产在运行时执行 func()，运行记录写入 ScheduleRun；参数相同的并发请求等待正在运行的那次并共用其结果，
+    参数不同的请求立即抛出 ScheduleBusy。
+    返回 (运行记录, 是否为附加到已有运行)。
+    """
+    params = json.dumps(params, sort_keys=True, default=str)
+    run, acquired = _acquire(params)
+    if not acquired:
+        if run.params != params:
+            raise ScheduleBusy(run)
+        logger.info(f"Attaching to schedule run {run.id}")
+        return _wait(run), True
+
+    try:
+        result = func()
+        run.status = ScheduleRun.DONE
+        run.summary = json.dumps(summarise(result) if summarise else {}, default=str)
+    except Exception as e:
+        run.status = ScheduleRun.FAILED
+        run.summary = json.dumps({'error': str(e)})
+        raise
+    finally:
+        # 只在仍持有锁时写回：运行超过 STALE_AFTER 被其他请求接管后，保留接管时记下的 FAILED，也不释放新运行的锁
+        finished = ScheduleRun.objects.filter(id=run.id, lock=LOCK_NAME).update(
+            lock=None, status=run.status, summary=run.summary, finished_at=timezone.now())
+        if not finished:
+            logger.warning(f"Schedule run {run.id} was taken over before it finished")
+        run.refresh_from_db()
+    return run, False
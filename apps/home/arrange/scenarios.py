@@ -0,0 +1,79 @@
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from .engine import run_schedule
+from .evaluator import DEFAULT_WEIGHTS
+from .kpi import schedule_kpis
+from .publish import publish_schedule
+from .snapshot import load_snapshot
+
+logger = logging.getLogger(__name__)
+
+Scenario = namedtuple('Scenario', ['rule', 'start_date'])
+
+# 快照中有一个订单行没排完（开始日期前还没下单、缺料或设备故障）按拖期这么多分钟计入得分，
+# 这样不同开始日期的方案在同一批订单行上比较
+UNSCHEDULED_PENALTY_MINUTES = 7 * 24 * 60
+
+
+def kpi_score(kpis, weights=None, missing=0):
+    """与优化器一致的加权得分，越小越好；missing 个没排完的订单行各按 UNSCHEDULED_PENALTY_MINUTES 的拖期计"""
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    return (weights['tardiness'] * (kpis['total_tardiness_minutes'] + missing * UNSCHEDULED_PENALTY_MINUTES) +
+            weights['changeover'] * kpis['changeover_minutes'] +
+            weights['makespan'] * kpis['makespan_minutes'])
+
+
+def evaluate_scenario(snapshot, scenario, weights=None, until=None):
+    """在快照上跑一个方案并计算指标，可在子进程中执行"""
+    started = time.time()
+    result = run_schedule(snapshot, scenario.start_date, rule=scenario.rule, until=until)
+    due_dates = {line.order_code: line.due_date for line in snapshot.lines}
+    changeover_times = {device.name: device.changeover for device in snapshot.devices}
+    tasks = pd.DataFrame(result.rows, columns=['task_start_time', 'task_end_time', 'order_code', 'product_code',
+                                               'process_i', 'process_name', 'device_name', 'product_num',
+                                               'is_changeover'])
+    kpis = schedule_kpis(tasks, due_dates, changeover_times)
+    # 快照里待生产的订单行中没排完的：开始日期前还没下单的，加上排产中没能排完的
+    missing = sum(1 for line in snapshot.lines if line.todo - line.started > 0) - result.planned \
+        + len(result.unscheduled)
+    return {
+        'scenario': scenario,
+        'kpis': kpis,
+        'score': kpi_score(kpis, weights, missing),
+        'planned': result.planned,
+        'unscheduled': len(result.unscheduled),
+        'missing': missing,
+        'seconds': round(time.time() - started, 2),
+        'rows': result.rows,
+    }
+
+
+def run_scenarios(scenarios, workers=None, weights=None, publish=True, snapshot=None, until=None, keep_rows=False):
+    """
+    在进程池中并行跑多个排产方案（不同规则、不同开始日期），所有方案共用同一份只读快照。
+    按加权得分比较，快照中没排完的订单行计为罚分（见 kpi_score），各方案在同一批订单行上比较；
+    publish=True 时把最好的方案写入 Task 表。
+    返回排好序的结果列表，keep_rows=False 时不含任务明细。
+    """
+    snapshot = snapshot or load_snapshot()
+    workers = min(workers or os.cpu_count() or 1, len(scenarios))
+    if workers <= 1:
+        results = [evaluate_scenario(snapshot, scenario, weights, until) for scenario in scenarios]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(evaluate_scenario, snapshot, scenario, weights, until) for scenario in scenarios]
+            results = [future.result() for future in futures]
+
+    results.sort(key=lambda result: result['score'])
+    if publish and results:
+        publish_schedule(results[0]['rows'])
+        logger.info(f"Published best scenario {results[0]['scenario']} with score {results[0]['score']:.1f}")
+    if keep_rows:
+        return results
+    return [{key: value for key, value in result.items() if key != 'rows'} for result in results]
@@ -0,0 +1,217 @@
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .evaluator import PlanEvaluator
+
+# 移动操作在序列中的搜索窗口（位置数）
+MOVE_WINDOW = 200
+
+
+def _can_cross(ops, order, k, lo, hi):
+    """工序 k 跨过 order[lo..hi] 时，不能越过同一订单行不同工序号的批次"""
+    op = ops[k]
+    for pos in range(lo, hi + 1):
+        other = ops[order[pos]]
+        if other.line == op.line and other.process_i != op.process_i:
+            return False
+    return True
+
+
+def _move(order, i, j):
+    order.insert(j, order.pop(i))
+
+
+class _Neighbourhood:
+    """
+    邻域移动：同设备内交换、插入到同原料工序之后（可换到备选设备）、改派备选设备。
+    每个移动返回 (lo, hi, undo)，undo 用于被拒绝时还原。
+    """
+
+    def __init__(self, evaluator, rng, window=MOVE_WINDOW):
+        self.ev = evaluator
+        self.rng = rng
+        self.window = window
+
+    def random_move(self):
+        rng = self.rng
+        r = rng.random()
+        if r < 0.4:
+            return self.swap_on_device()
+        if r < 0.8:
+            return self.reinsert_by_raw()
+        return self.reassign()
+
+    def swap_on_device(self):
+        ops, order, assign = self.ev.ops, self.ev.order, self.ev.assign
+        n = len(order)
+        i = self.rng.randrange(n)
+        d = assign[order[i]]
+        same = [pos for pos in range(i + 1, min(n, i + self.window)) if assign[order[pos]] == d]
+        if not same:
+            return None
+        j = self.rng.choice(same)
+        a, b = order[i], order[j]
+        if ops[a].line == ops[b].line and ops[a].process_i == ops[b].process_i:
+            return None
+        if not _can_cross(ops, order, a, i + 1, j) or not _can_cross(ops, order, b, i, j - 1):
+            return None
+        order[i], order[j] = b, a
+
+        def undo():
+            order[i], order[j] = a, b
+
+        return i, j, undo
+
+    def reinsert_by_raw(self):
+        ops, order, assign = self.ev.ops, self.ev.order, self.ev.assign
+        n = len(order)
+        i = self.rng.randrange(n)
+        k = order[i]
+        op = ops[k]
+        for _ in range(8):
+            j = self.rng.randrange(max(0, i - self.window), min(n, i + self.window))
+            target = order[j]
+            if j == i or ops[target].raw != op.raw or assign[target] not in op.devices:
+                continue
+            # 插到目标工序之后
+            dest = j if j > i else j + 1
+            lo, hi = min(i, dest), max(i, dest)
+            if not _can_cross(ops, order, k, lo, hi):
+                continue
+            old_device = assign[k]
+            _move(order, i, dest)
+            assign[k] = assign[target]
+
+            def undo():
+                _move(order, dest, i)
+                assign[k] = old_device
+
+            return lo, hi, undo
+        return None
+
+    def reassign(self):
+        ops, order, assign = self.ev.ops, self.ev.order, self.ev.assign
+        i = self.rng.randrange(len(order))
+        k = order[i]
+        devices = ops[k].devices
+        if len(devices) < 2:
+            return None
+        old_device = assign[k]
+        new_device = self.rng.choice(devices)
+        if new_device == old_device:
+            return None
+        assign[k] = new_device
+
+        def undo():
+            assign[k] = old_device
+
+        return i, i, undo
+
+
+def _initial_temperature(evaluator, moves, samples=30):
+    """取若干随机上坡移动的平均增量，使初始接受概率约为一半"""
+    ups = []
+    for _ in range(samples * 5):
+        move = moves.random_move()
+        if move is None:
+            continue
+        lo, hi, undo = move
+        delta = evaluator.propose(lo, hi) - evaluator.score
+        evaluator.reject()
+        undo()
+        if delta > 0:
+            ups.append(delta)
+        if len(ups) >= samples:
+            break
+    if not ups:
+        return 1.0
+    return sum(ups) / len(ups) / math.log(2)
+
+
+def anneal(plan, time_budget, seed=0, weights=None, deadline=None, perturb=None):
+    """
+    从 plan 出发做模拟退火，在 time_budget 秒（且不晚于 deadline）内返回找到的最好方案。
+    seed 不为 0 时先随机扰动一定步数，使多次重启从不同的起点出发。
+    """
+    started = time.time()
+    end_at = started + time_budget
+    if deadline is not None:
+        end_at = min(end_at, deadline)
+
+    rng = random.Random(seed)
+    evaluator = PlanEvaluator(plan, weights=weights)
+    moves = _Neighbourhood(evaluator, rng)
+    n = len(evaluator.order)
+    if n < 2:
+        return {'seed': seed, 'score': evaluator.score, 'order': evaluator.order, 'assign': evaluator.assign,
+                'iterations': 0, 'accepted': 0}
+
+    if seed:
+        steps = perturb if perturb is not None else max(1, n // 20)
+        for _ in range(steps):
+            moves.random_move()
+        evaluator.rebuild()
+
+    best_score = evaluator.score
+    best_order = list(evaluator.order)
+    best_assign = list(evaluator.assign)
+
+    t_start = _initial_temperature(evaluator, moves)
+    t_end = t_start * 1e-3
+    temperature = t_start
+    span = max(end_at - time.time(), 1e-6)
+    anneal_start = time.time()
+
+    iterations = 0
+    accepted = 0
+    while True:
+        if iterations % 64 == 0:
+            now = time.time()
+            if now >= end_at:
+                break
+            temperature = t_start * (t_end / t_start) ** min(1.0, (now - anneal_start) / span)
+        iterations += 1
+
+        move = moves.random_move()
+        if move is None:
+            continue
+        lo, hi, undo = move
+        delta = evaluator.propose(lo, hi) - evaluator.score
+        if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+            evaluator.accept()
+            accepted += 1
+            if evaluator.score < best_score - 1e-9:
+                best_score = evaluator.score
+                best_order = list(evaluator.order)
+                best_assign = list(evaluator.assign)
+        else:
+            evaluator.reject()
+            undo()
+
+    return {'seed': seed, 'score': best_score, 'order': best_order, 'assign': best_assign,
+            'iterations': iterations, 'accepted': accepted}
+
+
+def run_restarts(plan, time_budget, restarts=None, workers=None, weights=None):
+    """
+    在进程池中并行做多次独立重启，所有重启在 time_budget 秒内结束，返回得分最好的结果。
+    重启 0 直接从 plan 出发，其余重启先做随机扰动。
+    """
+    deadline = time.time() + time_budget
+    workers = workers or os.cpu_count() or 1
+    restarts = restarts or workers
+    workers = min(workers, restarts)
+    # 预留一成时间给进程启动和结果回传
+    rounds = -(-restarts // workers)
+    budget = time_budget * 0.9 / rounds
+
+    if workers == 1:
+        results = [anneal(plan, budget, seed, weights, deadline) for seed in range(restarts)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(anneal, plan, budget, seed, weights, deadline) for seed in range(restarts)]
+            results = [future.result() for future in futures]
+    return min(results, key=lambda result: result['score'])
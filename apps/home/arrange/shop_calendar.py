@@ -0,0 +1,237 @@
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from django.utils import timezone
+
+# 车间班次（当天 0 点起的分钟数），结束时间超过 1440 表示跨过零点
+# 早班 07:30-11:30，白班 12:00-17:00，夜班 17:00-次日 02:00
+DEFAULT_SHIFTS = ((450, 690), (720, 1020), (1020, 1560))
+
+DAY_MINUTES = 1440
+EPOCH = datetime(1970, 1, 1)
+
+# 标量换算缓存的最大条目数；同一次排产里工序时长只有少数几种，(开始, 时长) 大量重复
+CACHE_SIZE = 65536
+
+# configure() 的缺省参数：不修改该项（tz=None 表示改回默认时区）
+UNCHANGED = object()
+
+
+class LRUCache:
+    """容量有限的 LRU 缓存，带命中/未命中计数；SHOP_CALENDAR 由各请求线程共用，读写都加锁，计算在锁外做"""
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+
+class ShopCalendar:
+    """
+    车间日历。
+
+    “挂钟分钟”是本地时间自 1970-01-01 起的分钟数，“工作分钟偏移”是同一起点起累计的工作分钟数。
+    在工作分钟坐标下，跳过非工作时间的加法退化为普通加法，排产评估可以只做数值运算。
+    标量换算按（整数分钟, 时长, 日历）缓存，带秒的时间不多见，直接计算不进缓存；
+    修改班次或时区请调用 configure()，缓存随之清空。
+    """
+
+    def __init__(self, shifts=DEFAULT_SHIFTS, tz=None, cache_size=CACHE_SIZE):
+        self.cache = LRUCache(cache_size)
+        self.configure(shifts, tz)
+
+    def configure(self, shifts=UNCHANGED, tz=UNCHANGED):
+        """设置班次和时区（tz=None 改回 Django 的默认时区），重新计算工作时段；没传的参数保持不变"""
+        if shifts is not UNCHANGED:
+            self.shifts = tuple(tuple(shift) for shift in shifts)
+        if tz is not UNCHANGED:
+            self.tz = tz
+
+        # 把跨零点的班次拆开，并合并相邻或重叠的时段
+        pieces = []
+        for start, end in self.shifts:
+            if end > DAY_MINUTES:
+                pieces.append((start, DAY_MINUTES))
+                pieces.append((0, end - DAY_MINUTES))
+            else:
+                pieces.append((start, end))
+        segments = []
+        for start, end in sorted(pieces):
+            if segments and start <= segments[-1][1]:
+                segments[-1] = (segments[-1][0], max(segments[-1][1], end))
+            else:
+                segments.append((start, end))
+
+        self.segments = segments
+        self.segment_starts = [start for start, _ in segments]
+        self.segment_offsets = []
+        total = 0
+        for start, end in segments:
+            self.segment_offsets.append(total)
+            total += end - start
+        self.day_minutes = total
+        self.key = (self.shifts, self.tz)
+        self.cache.clear()
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def _cached(self, kind, values, compute):
+        # 缓存键用整数分钟：带小数的浮点键会因为舍入差异而重复或错失
+        if all(float(value).is_integer() for value in values):
+            return self.cache.get((kind, *(int(value) for value in values), self.key), compute)
+        return compute()
+
+    def get_tz(self):
+        return self.tz or timezone.get_default_timezone()
+
+    def to_minute(self, dt):
+        """时间 -> 挂钟分钟"""
+        if timezone.is_aware(dt):
+            dt = timezone.localtime(dt, self.get_tz()).replace(tzinfo=None)
+        return round((dt - EPOCH).total_seconds() / 60, 6)
+
+    def from_minute(self, minute):
+        """挂钟分钟 -> 带时区的时间"""
+        return timezone.make_aware(EPOCH + timedelta(minutes=minute), self.get_tz())
+
+    def working_offset(self, minute):
+        """挂钟分钟 -> 工作分钟偏移，非工作时间取下一个工作时段的起点"""
+        day, minute_of_day = divmod(minute, DAY_MINUTES)
+        i = bisect_right(self.segment_starts, minute_of_day) - 1
+        if i < 0:
+            return day * self.day_minutes
+        start, end = self.segments[i]
+        return day * self.day_minutes + self.segment_offsets[i] + min(minute_of_day, end) - start
+
+    def minute_at(self, offset, end=False):
+        """
+        工作分钟偏移 -> 挂钟分钟。
+        偏移恰好落在两个时段交界处时，end=True 取前一时段的结束，否则取后一时段的开始。
+        """
+        day, rest = divmod(offset, self.day_minutes)
+        if end:
+            i = bisect_left(self.segment_offsets, rest) - 1
+            if i < 0:
+                day -= 1
+                rest += self.day_minutes
+                i = len(self.segments) - 1
+        else:
+            i = bisect_right(self.segment_offsets, rest) - 1
+        minute = day * DAY_MINUTES + self.segment_starts[i] + rest - self.segment_offsets[i]
+        return round(minute, 6)
+
+    def offset_of(self, dt):
+        """时间 -> 工作分钟偏移"""
+        minute = self.to_minute(dt)
+        return self._cached('offset', (minute,), lambda: self.working_offset(minute))
+
+    def time_of(self, offset, end=False):
+        """工作分钟偏移 -> 带时区的时间"""
+        return self._cached(('time', end), (offset,), lambda: self.from_minute(self.minute_at(offset, end)))
+
+    def day_start(self, day):
+        """某天第一个班次的开始时间"""
+        if isinstance(day, datetime):
+            if timezone.is_aware(day):
+                day = timezone.localtime(day, self.get_tz())
+            day = day.date()
+        first_shift = min(start for start, _ in self.shifts)
+        return self.from_minute(self.to_minute(datetime.combine(day, datetime.min.time())) + first_shift)
+
+    def to_minutes(self, values, exact=False):
+        """
+        批量：时间列（带时区按本地时间换算）-> 挂钟分钟数组。
+        默认向下取整为 int64；exact=True 时保留秒，返回与 to_minute 一致的 float64。
+        """
+        values = pd.DatetimeIndex(values)
+        if values.tz is not None:
+            values = values.tz_convert(self.get_tz()).tz_localize(None)
+        delta = values - pd.Timestamp(EPOCH)
+        if exact:
+            return np.round(np.asarray(delta / pd.Timedelta(minutes=1), dtype=np.float64), 6)
+        return np.asarray(delta // pd.Timedelta(minutes=1), dtype=np.int64)
+
+    def working_offsets(self, minutes):
+        """批量：挂钟分钟数组 -> 工作分钟偏移数组"""
+        day, minute_of_day = np.divmod(np.asarray(minutes), DAY_MINUTES)
+        offsets = day * self.day_minutes
+        for start, end in self.segments:
+            offsets = offsets + np.clip(minute_of_day - start, 0, end - start)
+        return offsets
+
+    def minutes_at(self, offsets, end=False):
+        """批量：工作分钟偏移数组 -> 挂钟分钟数组，交界处的取法同 minute_at"""
+        segment_starts = np.asarray(self.segment_starts, dtype=np.float64)
+        segment_offsets = np.asarray(self.segment_offsets, dtype=np.float64)
+        day, rest = np.divmod(np.asarray(offsets, dtype=np.float64), self.day_minutes)
+        if end:
+            i = np.searchsorted(segment_offsets, rest, side='left') - 1
+            wrap = i < 0
+            day = np.where(wrap, day - 1, day)
+            rest = np.where(wrap, rest + self.day_minutes, rest)
+            i = np.where(wrap, len(self.segments) - 1, i)
+        else:
+            i = np.searchsorted(segment_offsets, rest, side='right') - 1
+        return np.round(day * DAY_MINUTES + segment_starts[i] + rest - segment_offsets[i], 6)
+
+    def from_minutes(self, minutes):
+        """批量：挂钟分钟数组 -> 带时区的 DatetimeIndex"""
+        microseconds = np.round(np.asarray(minutes, dtype=np.float64) * 60e6).astype(np.int64)
+        return (pd.Timestamp(EPOCH) + pd.to_timedelta(microseconds, unit='us')).tz_localize(self.get_tz())
+
+    def times_of(self, offsets, end=False):
+        """批量：工作分钟偏移数组 -> 带时区的 DatetimeIndex"""
+        return self.from_minutes(self.minutes_at(offsets, end))
+
+    def overlap_minutes(self, starts, ends, window_start, window_end):
+        """批量：每个 [开始, 结束) 与窗口 [window_start, window_end) 重叠的工作分钟数，参数都是挂钟分钟"""
+        low = self.working_offsets(np.maximum(starts, window_start))
+        high = self.working_offsets(np.minimum(ends, window_end))
+        return np.clip(high - low, 0, None)
+
+    def is_working(self, minutes, end=False):
+        """批量：挂钟分钟是否落在班次内；end=True 时时段结束点算在内、起点不算（用于检查完工时间）"""
+        minute_of_day = np.asarray(minutes) % DAY_MINUTES
+        if end:
+            minute_of_day = np.where(minute_of_day == 0, DAY_MINUTES, minute_of_day)
+        working = np.zeros(minute_of_day.shape, dtype=bool)
+        for start, stop in self.segments:
+            if end:
+                working |= (minute_of_day > start) & (minute_of_day <= stop)
+            else:
+                working |= (minute_of_day >= start) & (minute_of_day < stop)
+        return working
+
+
+SHOP_CALENDAR = ShopCalendar()
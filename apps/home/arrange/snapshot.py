@@ -0,0 +1,115 @@
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .durations import load_learned_durations
+from ..models import Device, OrderProduct, Process, Product, Raw
+
+# 排产输入快照：只包含基本类型，可以直接传给进程池中的子进程，各次排产共享只读
+# started: 下一道工序已经冻结（已开工或已完工）的数量，只在重排时非零
+Line = namedtuple('Line', ['id', 'order_code', 'order_start_date', 'due_date', 'customer', 'product_code', 'raw',
+                           'todo', 'cur_process_i', 'end_time', 'started'], defaults=(0,))
+# durations: 设备名称 -> 学到的实际时长，只在启用学习时长时给出，缺省用 duration
+Step = namedtuple('Step', ['process_i', 'process_name', 'duration', 'capacity', 'devices', 'is_outside', 'durations'],
+                  defaults=(None,))
+DeviceInfo = namedtuple('DeviceInfo', ['name', 'changeover', 'raw', 'end_time', 'is_fault'])
+# receipts: 毛坯入库记录 (毛坯编码, 入库日期, 数量)
+Snapshot = namedtuple('Snapshot', ['lines', 'routes', 'devices', 'receipts', 'taken_at'])
+
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def load_routes(learned=None):
+    """
+    商品编码 -> 按工序号排序的工序列表。
+    learned 为 load_learned_durations() 的结果时，每道工序带上各设备学到的时长。
+    """
+    routes = defaultdict(list)
+    processes = Process.objects.order_by('product_code', 'process_i').values_list(
+        'product_code', 'process_i', 'process_name', 'process_duration', 'process_capacity', 'device_name',
+        'is_outside')
+    for product_code, process_i, process_name, duration, capacity, device_name, is_outside in processes:
+        devices = tuple(name.strip() for name in (device_name or '').split('/') if name.strip())
+        durations = None
+        if learned:
+            durations = {name: learned[product_code, process_i, name] for name in devices
+                         if (product_code, process_i, name) in learned} or None
+        routes[product_code].append(
+            Step(process_i, process_name, _float(duration), capacity or 1, devices, is_outside, durations))
+    return dict(routes)
+
+
+def load_devices():
+    devices = Device.objects.order_by('id').values_list('device_name', 'changeover_time', 'raw', 'end_time',
+                                                        'is_fault')
+    return [DeviceInfo(name, _float(changeover), raw, end_time, is_fault)
+            for name, changeover, raw, end_time, is_fault in devices]
+
+
+LINE_FIELDS = ('id', 'order__order_code', 'order__order_start_date', 'order__order_end_date',
+               'order__order_custom_name', 'product_code', 'product_num_todo', 'product_num_done', 'cur_process_i',
+               'end_time')
+STREAM_CHUNK_SIZE = 2000
+
+
+def _open_lines():
+    return OrderProduct.objects.filter(is_done=False, order__is_done=False)
+
+
+def _to_lines(rows, raw_codes):
+    for (line_id, order_code, start_date, end_date, customer, product_code, num_todo, num_done, cur_process_i,
+         end_time) in rows:
+        raw = raw_codes.get(product_code)
+        yield Line(
+            id=line_id,
+            order_code=order_code,
+            order_start_date=start_date,
+            due_date=end_date,
+            customer=customer,
+            product_code=product_code,
+            raw=raw if raw != "Null" else None,
+            todo=num_todo - num_done,
+            cur_process_i=cur_process_i,
+            end_time=end_time,
+        )
+
+
+def iter_lines(start_day, raw_codes, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    按交货日期顺序流式读取 start_day 当天及以前下单（或没有下单日期）、还有待生产数量的订单行。
+    使用服务端游标分块读取，不会一次把整个订单簿读进内存。
+    """
+    rows = _open_lines().filter(
+        Q(order__order_start_date__lte=start_day) | Q(order__order_start_date=None),
+        product_num_todo__gt=F('product_num_done'),
+    ).order_by(F('order__order_end_date').asc(nulls_first=True), 'id').values_list(
+        *LINE_FIELDS).iterator(chunk_size=chunk_size)
+    return _to_lines(rows, raw_codes)
+
+
+def load_snapshot(stream_from=None, durations=None):
+    """
+    读取所有未完成订单行、工艺路线、设备和毛坯库存，共五条查询。
+    stream_from 为开始日期（YYYY-MM-DD）时，订单行改为按交期排序的迭代器（见 iter_lines），
+    这样的快照只能使用一次，也不能传给子进程。
+    durations 为 'mean'/'p50'/'p90' 时多一条查询，用完工记录学到的时长代替 Process.process_duration
+    （见 durations.py）；缺省取 settings.LEARNED_DURATIONS，'static' 表示不用。
+    """
+    if durations is None:
+        durations = getattr(settings, 'LEARNED_DURATIONS', None)
+    learned = load_learned_durations(durations) if durations and durations != 'static' else None
+    raw_codes = dict(Product.objects.values_list('product_code', 'raw_code'))
+    if stream_from is None:
+        lines = list(_to_lines(_open_lines().order_by('id').values_list(*LINE_FIELDS), raw_codes))
+    else:
+        lines = iter_lines(stream_from, raw_codes)
+    receipts = list(Raw.objects.exclude(raw_code=None).values_list('raw_code', 'raw_date_add', 'raw_num'))
+    return Snapshot(lines=lines, routes=load_routes(learned), devices=load_devices(), receipts=receipts,
+                    taken_at=timezone.now())
@@ -0,0 +1,166 @@
+import logging
+from bisect import bisect_right
+from collections import defaultdict
+
+from django.db import transaction
+
+from .diff import archive_schedule
+from .shop_calendar import SHOP_CALENDAR
+from .validator import check_schedule
+from ..models import Task
+from ..reports.dashboard import mark_dirty
+from ..reports.eta import refresh_order_etas
+
+logger = logging.getLogger(__name__)
+
+TIMELINE_FIELDS = ('id', 'task_start_time', 'task_end_time', 'device_name', 'order_code', 'product_code',
+                   'process_i')
+
+
+class DeviceTimeline:
+    """一台设备上按开始时间排序的任务（工作分钟偏移），相邻任务互不重叠时顺延不会改变先后顺序"""
+
+    def __init__(self):
+        self.ids = []
+        self.starts = []
+        self.ends = []
+        self.position = {}
+
+    def append(self, task_id, start, end):
+        self.position[task_id] = len(self.ids)
+        self.ids.append(task_id)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def slot(self, earliest):
+        """
+        在 earliest 之后插入任务的位置和开始时间。
+        earliest 时刻正在加工的任务不打断，紧急任务排在它之后；后面的任务由 push 顺延。
+        """
+        i = bisect_right(self.starts, earliest)
+        start = earliest
+        if i and self.ends[i - 1] > earliest:
+            start = self.ends[i - 1]
+        return i, start
+
+    def insert(self, i, task_id, start, end):
+        self.ids.insert(i, task_id)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        for j in range(i, len(self.ids)):
+            self.position[self.ids[j]] = j
+
+    def push(self, i, earliest):
+        """第 i 个任务最早从 earliest 开始，并顺延后面重叠的任务；返回被移动的下标"""
+        moved = []
+        while i < len(self.ids) and self.starts[i] < earliest:
+            duration = self.ends[i] - self.starts[i]
+            self.starts[i] = earliest
+            self.ends[i] = earliest + duration
+            moved.append(i)
+            earliest = self.ends[i]
+            i += 1
+        return moved
+
+
+class Timeline:
+    """
+    未完成任务的设备时间线索引，时间统一为工作分钟偏移，顺延时跳过非工作时间只需做加法。
+    插入紧急任务后，同设备上被挤到的任务向后顺延；同一订单行后续工序早于前一道工序完工的，也跟着顺延。
+    """
+
+    def __init__(self, tasks, calendar=SHOP_CALENDAR):
+        self.calendar = calendar
+        self.devices = defaultdict(DeviceTimeline)
+        # 订单行 (订单号, 商品编码) -> 工序号 -> [任务 id]
+        self.lines = defaultdict(lambda: defaultdict(list))
+        self.info = {}
+        tasks = sorted(tasks, key=lambda task: task[1])
+        starts = calendar.working_offsets(calendar.to_minutes([task[1] for task in tasks], exact=True))
+        ends = calendar.working_offsets(calendar.to_minutes([task[2] for task in tasks], exact=True))
+        for (task_id, _, _, device_name, order_code, product_code, process_i), start, end in zip(
+                tasks, starts.tolist(), ends.tolist()):
+            self.devices[device_name].append(task_id, start, end)
+            self.lines[order_code, product_code][process_i].append(task_id)
+            self.info[task_id] = (device_name, (order_code, product_code), process_i)
+        self.moved = set()
+
+    @classmethod
+    def load(cls, calendar=SHOP_CALENDAR):
+        tasks = Task.objects.filter(completed=False).values_list(*TIMELINE_FIELDS)
+        return cls(tasks, calendar)
+
+    def _index(self, task_id):
+        timeline = self.devices[self.info[task_id][0]]
+        return timeline, timeline.position[task_id]
+
+    def _end(self, task_id):
+        timeline, i = self._index(task_id)
+        return timeline.ends[i]
+
+    def _propagate(self, task_ids):
+        """顺延后检查同一订单行的下一道工序，必要时继续顺延"""
+        pending = list(task_ids)
+        while pending:
+            device_name, line, process_i = self.info[pending.pop()]
+            steps = self.lines[line]
+            later = [i for i in steps if i > process_i]
+            if not later:
+                continue
+            ready = max(self._end(task_id) for task_id in steps[process_i])
+            for task_id in steps[min(later)]:
+                timeline, i = self._index(task_id)
+                for j in timeline.push(i, ready):
+                    self.moved.add(timeline.ids[j])
+                    pending.append(timeline.ids[j])
+
+    def insert(self, task_id, device_name, earliest, duration):
+        """在设备上插入一段不属于已排订单行的任务，返回其开始和结束偏移"""
+        timeline = self.devices[device_name]
+        i, start = timeline.slot(earliest)
+        timeline.insert(i, task_id, start, start + duration)
+        self.info[task_id] = (device_name, None, None)
+        moved = [timeline.ids[j] for j in timeline.push(i + 1, start + duration)]
+        self.moved.update(moved)
+        self._propagate(moved)
+        return start, start + duration
+
+    def changed_tasks(self):
+        """被顺延的任务（只含 id 和新的起止时间），可直接 bulk_update"""
+        task_ids = sorted(self.moved)
+        positions = [self._index(task_id) for task_id in task_ids]
+        starts = self.calendar.times_of([timeline.starts[i] for timeline, i in positions])
+        ends = self.calendar.times_of([timeline.ends[i] for timeline, i in positions], end=True)
+        return [Task(id=task_id, task_start_time=start, task_end_time=end)
+                for task_id, start, end in zip(task_ids, starts.to_pydatetime(), ends.to_pydatetime())]
+
+
+def insert_urgent_task(device_name, earliest_start, duration, calendar=SHOP_CALENDAR, **fields):
+    """
+    插入紧急任务：在 earliest_start 之后找到设备上的位置，顺延受影响的任务，只更新被顺延的行。
+    duration 为工作分钟。返回 (新任务, 被顺延的任务数)。
+    """
+    with transaction.atomic():
+        timeline = Timeline.load(calendar)
+        earliest = calendar.offset_of(earliest_start)
+        start, end = timeline.insert(None, device_name, earliest, duration)
+        changed = timeline.changed_tasks()
+        # 插单前的排产存为一个版本，便于查看插单顺延了哪些任务
+        archive_schedule('urgent')
+        Task.objects.bulk_update(changed, ['task_start_time', 'task_end_time'], batch_size=1000)
+        task = Task.objects.create(
+            task_start_time=calendar.time_of(start),
+            task_end_time=calendar.time_of(end, end=duration > 0),
+            device_name=device_name,
+            completed=False,
+            inspected=False,
+            **fields
+        )
+    logger.info(f"Inserted urgent task {task.id} on {device_name}, shifted {len(changed)} tasks")
+    check_schedule('urgent insert')
+    mark_dirty(Task)
+    # 只有新任务和被顺延任务所在的订单预计完工会变
+    orders = set(Task.objects.filter(id__in=[changed_task.id for changed_task in changed]).values_list(
+        'order_code', flat=True))
+    refresh_order_etas(orders | {task.order_code})
+    return task, len(changed)
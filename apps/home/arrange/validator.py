@@ -0,0 +1,82 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .kpi import load_tasks
+from .shop_calendar import SHOP_CALENDAR
+from ..models import Process
+
+logger = logging.getLogger(__name__)
+
+# 违规类型：设备上任务重叠、同一订单行工序顺序颠倒、开工或完工不在班次内、单批数量超过工序产能
+VIOLATION_KINDS = ('device_overlap', 'precedence', 'off_shift', 'capacity')
+
+
+def _records(frame, columns):
+    return frame[list(columns)].to_dict('records')
+
+
+def validate_schedule(tasks=None, capacities=None, calendar=SHOP_CALENDAR):
+    """
+    检查排产结果的可行性，返回 违规类型 -> 违规记录列表。
+
+    tasks 为 load_tasks() 格式的 DataFrame，缺省时读取当前 Task 表；
+    capacities（(商品编码, 工序号) -> 单批产能）缺省时查一次 Process 表。
+    按设备、按订单行各排序一次，全部检查都是列运算。
+    """
+    if tasks is None:
+        tasks = load_tasks()
+    report = {kind: [] for kind in VIOLATION_KINDS}
+    if tasks.empty:
+        return report
+    if capacities is None:
+        capacities = {(product_code, process_i): capacity for product_code, process_i, capacity in
+                      Process.objects.values_list('product_code', 'process_i', 'process_capacity')}
+
+    frame = tasks.copy()
+    frame['start'] = calendar.to_minutes(frame['task_start_time'])
+    frame['end'] = calendar.to_minutes(frame['task_end_time'])
+
+    # 设备重叠：按设备、开始时间排序后，开工早于同设备前面任务的最晚完工
+    by_device = frame.sort_values(['device_name', 'start', 'end'], kind='mergesort')
+    busy_until = by_device.groupby('device_name', sort=False)['end'].cummax().groupby(
+        by_device['device_name'], sort=False).shift()
+    overlap = by_device[by_device['start'].to_numpy() < busy_until.to_numpy()]
+    report['device_overlap'] = _records(overlap, ('id', 'device_name', 'task_start_time', 'task_end_time'))
+
+    # 工序顺序：同一订单行每道工序的最早开工不能早于前面工序的最晚完工
+    steps = frame.groupby(['order_code', 'product_code', 'process_i'], sort=True).agg(
+        start=('start', 'min'), end=('end', 'max'), first_id=('id', 'min')).reset_index()
+    line_keys = ['order_code', 'product_code']
+    previous_end = steps.groupby(line_keys, sort=False)['end'].cummax().groupby(
+        [steps[key] for key in line_keys], sort=False).shift()
+    precedence = steps[steps['start'].to_numpy() < previous_end.to_numpy()]
+    report['precedence'] = _records(precedence.rename(columns={'first_id': 'id'}),
+                                    ('id', 'order_code', 'product_code', 'process_i'))
+
+    # 班次：开工在班次内，完工在班次内或恰好是班次结束
+    off_shift = frame[~calendar.is_working(frame['start'].to_numpy()) |
+                      ~calendar.is_working(frame['end'].to_numpy(), end=True)]
+    report['off_shift'] = _records(off_shift, ('id', 'device_name', 'task_start_time', 'task_end_time'))
+
+    # 产能：单个任务的数量不超过工序单批产能。产能没填（0 或空，模型的缺省值）的工序不检查，
+    # 排产引擎对这种工序按单批 1 件排（snapshot.load_routes），其他来源的任务数量无从判断
+    keys = pd.MultiIndex.from_arrays([frame['product_code'], frame['process_i']])
+    capacity = pd.Series(capacities, dtype=np.float64).reindex(keys).to_numpy() if capacities else \
+        np.full(len(frame), np.nan)
+    capacity = np.where(capacity > 0, capacity, np.nan)
+    over = frame[pd.to_numeric(frame['product_num'], errors='coerce').to_numpy() > capacity]
+    report['capacity'] = _records(over, ('id', 'product_code', 'process_i', 'product_num'))
+    return report
+
+
+def check_schedule(context, tasks=None, calendar=SHOP_CALENDAR):
+    """排产、重排、插单之后自动调用：校验 Task 表并把违规写入日志"""
+    report = validate_schedule(tasks, calendar=calendar)
+    counts = {kind: len(violations) for kind, violations in report.items() if violations}
+    if counts:
+        logger.warning(f"Schedule check after {context} found violations: {counts}")
+    else:
+        logger.info(f"Schedule check after {context} passed")
+    return report
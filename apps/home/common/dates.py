@@ -0,0 +1,31 @@
+import re
+from datetime import date, datetime
+
+import pandas as pd
+from django.utils.dateparse import parse_date
+
+# 导入的 Excel 和历史数据里见过的日期写法：2024-01-05、2024/1/5、2024.1.5、20240105，可能带时间部分
+_SEPARATORS = re.compile(r'[/.年月]')
+
+
+def to_date(value):
+    """
+    把导入数据中的日期（date、datetime、pandas.Timestamp 或字符串）转换为 date，空值或无法解析的返回 None。
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    text = str(value).strip()
+    if not text:
+        return None
+    text = _SEPARATORS.sub('-', text.split()[0].split('T')[0]).rstrip('日-')
+    if len(text) == 8 and text.isdigit():
+        text = f'{text[:4]}-{text[4:6]}-{text[6:]}'
+    try:
+        return parse_date(text)
+    except ValueError:
+        # 格式对但日期不存在，例如 2024-02-30
+        return None
@@ -0,0 +1,84 @@
+import re
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from django.db import connections
+from django.utils import timezone
+
+from ..models import Order, OrderProduct, Process, Raw, Task
+
+# 一条热点查询的执行计划：plan 为数据库返回的原文，scans 为其中整表扫描的表名
+QueryPlan = namedtuple('QueryPlan', ['name', 'sql', 'plan', 'scans'])
+
+# 各数据库执行计划中整表扫描的写法（其他数据库只输出执行计划）；
+# SQLite 的 "SCAN t USING INDEX ..." 是按索引顺序扫描，不算整表扫描
+SCAN_PATTERNS = {
+    'sqlite': re.compile(r'\bSCAN (?:TABLE )?(\w+)(?! USING (?:COVERING )?INDEX)(?:\s|$)'),
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+}
+
+
+def _window():
+    start = timezone.make_aware(datetime.combine(date.today(), datetime.min.time()))
+    return start, start + timedelta(days=1)
+
+
+def _task_device_window():
+    start = _window()[0]
+    return Task.objects.filter(device_name='D0', task_start_time__gte=start).order_by('task_start_time')
+
+
+def _task_overlap_window():
+    start, end = _window()
+    return Task.objects.filter(task_start_time__lt=end, task_end_time__gt=start)
+
+
+def _task_order():
+    return Task.objects.filter(order_code='O0')
+
+
+def _task_process():
+    return Task.objects.filter(process_i=1, product_code='P0')
+
+
+def _process_route():
+    return Process.objects.filter(product_code='P0').order_by('process_i')
+
+
+def _order_open_lines():
+    return OrderProduct.objects.filter(order_id=1, is_done=False)
+
+
+def _raw_stock():
+    return Raw.objects.filter(raw_code='R0')
+
+
+def _open_orders():
+    return Order.objects.filter(is_done=False, order_start_date__lte=date.today()).order_by('order_start_date')
+
+
+def _order_due_dates():
+    return Order.objects.filter(order_end_date__range=(date.today(), date.today() + timedelta(days=30)))
+
+
+# 名称 -> 构造查询的函数，参数只是有代表性的值，EXPLAIN 不需要真实数据
+HOT_QUERIES = {
+    'task_device_window': _task_device_window,
+    'task_overlap_window': _task_overlap_window,
+    'task_order': _task_order,
+    'task_process': _task_process,
+    'process_route': _process_route,
+    'order_open_lines': _order_open_lines,
+    'raw_stock': _raw_stock,
+    'open_orders': _open_orders,
+    'order_due_dates': _order_due_dates,
+}
+
+
+def explain_query(name):
+    """对一条热点查询执行 EXPLAIN，找出其中的整表扫描"""
+    queryset = HOT_QUERIES[name]()
+    plan = queryset.explain()
+    pattern = SCAN_PATTERNS.get(connections[queryset.db].vendor)
+    scans = sorted(set(pattern.findall(plan))) if pattern else []
+    return QueryPlan(name, str(queryset.query), plan, scans)
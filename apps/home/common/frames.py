@@ -0,0 +1,17 @@
+import pandas as pd
+from django.db import connections
+
+
+def queryset_frame(queryset, fields, datetime_fields=()):
+    """
+    用一条 SQL 把 queryset 的指定字段读成 DataFrame。
+    直接取数据库游标的原始结果，不逐行构造模型对象；时间列统一转换为 UTC 时间。
+    """
+    sql, params = queryset.values_list(*fields).query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    frame = pd.DataFrame.from_records(rows, columns=list(fields))
+    for field in datetime_fields:
+        frame[field] = pd.to_datetime(frame[field], utc=True, format='ISO8601')
+    return frame
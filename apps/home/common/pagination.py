@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db.models import F, Q
+
+# 近似总数的缓存秒数：键集分页不做 COUNT(*)，总数只用于显示，允许滞后
+APPROXIMATE_COUNT_TTL = 300
+
+
+class KeysetPage:
+    """
+    键集（seek）分页的一页：按 keys 升序，用上一页最后一行（或下一页第一行）的键值定位，
+    不做 COUNT(*) 也不做 OFFSET，第 N 页与第一页的开销相同。
+    next_url / previous_url 为翻页链接的查询串（保留其余参数），没有时为 None。
+    """
+    is_keyset = True
+
+    def __init__(self, object_list, has_next, has_previous, next_url, previous_url, first_url, approximate_count):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_url = next_url
+        self.previous_url = previous_url
+        self.first_url = first_url
+        self.approximate_count = approximate_count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+def keyset_requested(request):
+    """请求带游标、指定 mode=keyset，或 settings.KEYSET_PAGINATION 打开时使用键集分页"""
+    if 'cursor' in request.GET:
+        return True
+    mode = request.GET.get('mode')
+    if mode in ('keyset', 'offset'):
+        return mode == 'keyset'
+    return getattr(settings, 'KEYSET_PAGINATION', False)
+
+
+def _field(model, path):
+    for name in path.split('__'):
+        field = model._meta.get_field(name)
+        model = field.related_model or model
+    return field
+
+
+def _key_value(row, key):
+    if isinstance(row, dict):
+        return row[key]
+    for name in key.split('__'):
+        row = getattr(row, name) if row is not None else None
+    return row
+
+
+def encode_cursor(direction, values):
+    payload = json.dumps([direction, [value.isoformat() if hasattr(value, 'isoformat') else value
+                                      for value in values]])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor, model, keys):
+    """游标 -> (方向, 键值)；游标无效时返回 None，从第一页开始"""
+    try:
+        direction, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if direction not in ('next', 'previous') or len(values) != len(keys):
+            return None
+        return direction, [None if value is None else _field(model, key).to_python(value)
+                           for key, value in zip(keys, values)]
+    except (ValueError, TypeError, ValidationError, FieldDoesNotExist):
+        return None
+
+
+def _nullable(model, keys):
+    return [_field(model, key).null for key in keys]
+
+
+def _beyond(keys, values, nullable, lookup):
+    """
+    键值严格在 values 之后（lookup='gt'）或之前（'lt'）的行。可为空的键排序时 NULL 在前，
+    所以 NULL 之后是所有非 NULL 值，非 NULL 值之前是更小的值和 NULL。
+    """
+    key, value = keys[0], values[0]
+    if value is None:
+        beyond = Q(**{f'{key}__isnull': False}) if lookup == 'gt' else Q(pk__in=[])
+        equal = Q(**{f'{key}__isnull': True})
+    else:
+        beyond = Q(**{f'{key}__{lookup}': value})
+        if lookup == 'lt' and nullable[0]:
+            beyond |= Q(**{f'{key}__isnull': True})
+        equal = Q(**{key: value})
+    if len(keys) == 1:
+        return beyond
+    return beyond | (equal & _beyond(keys[1:], values[1:], nullable[1:], lookup))
+
+
+def _ordering(keys, nullable, descending=False):
+    # 不可为空的键不加 NULLS FIRST/LAST，免得用不上索引
+    if descending:
+        return [F(key).desc(nulls_last=True) if null else F(key).desc() for key, null in zip(keys, nullable)]
+    return [F(key).asc(nulls_first=True) if null else F(key).asc() for key, null in zip(keys, nullable)]
+
+
+def approximate_count(queryset, ttl=APPROXIMATE_COUNT_TTL):
+    """COUNT(*) 的结果按 SQL 缓存 ttl 秒"""
+    sql, params = queryset.query.sql_with_params()
+    key = 'approximate_count:' + hashlib.md5(f'{sql}{params}'.encode()).hexdigest()
+    return cache.get_or_set(key, queryset.count, ttl)
+
+
+def _url(request, cursor):
+    params = request.GET.copy()
+    params.pop('page', None)
+    params.pop('cursor', None)
+    params['mode'] = 'keyset'
+    if cursor is not None:
+        params['cursor'] = cursor
+    return '?' + params.urlencode()
+
+
+def keyset_page(request, queryset, keys, per_page, count=True):
+    """
+    按 keys（最后一个键须唯一，通常是 id）取 request 中游标所指的一页，两条索引范围查询之一，不做 COUNT(*)。
+    count 为 True 时附带缓存的近似总数（见 approximate_count）。
+    """
+    per_page = int(per_page)
+    cursor = request.GET.get('cursor')
+    decoded = decode_cursor(cursor, queryset.model, keys) if cursor else None
+    direction, values = decoded or ('next', None)
+    nullable = _nullable(queryset.model, keys)
+
+    if direction == 'previous':
+        rows = list(queryset.filter(_beyond(keys, values, nullable, 'lt')).order_by(
+            *_ordering(keys, nullable, True))[:per_page + 1])
+        has_previous = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next = True
+    else:
+        page_queryset = queryset.filter(_beyond(keys, values, nullable, 'gt')) if values is not None else queryset
+        rows = list(page_queryset.order_by(*_ordering(keys, nullable))[:per_page + 1])
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_previous = values is not None
+
+    next_url = _url(request, encode_cursor('next', [_key_value(rows[-1], key) for key in keys])) \
+        if has_next and rows else None
+    previous_url = _url(request, encode_cursor('previous', [_key_value(rows[0], key) for key in keys])) \
+        if has_previous and rows else None
+    return KeysetPage(rows, has_next, has_previous, next_url, previous_url, _url(request, None),
+                      approximate_count(queryset) if count else None)
+
+
+def paginate(request, queryset, keys, per_page):
+    """
+    列表页分页：请求键集分页时（见 keyset_requested）返回 KeysetPage，否则按原来的页码分页。
+    两种方式都按 keys 排序。
+    """
+    if keyset_requested(request):
+        return keyset_page(request, queryset, keys, per_page)
+    return Paginator(queryset.order_by(*_ordering(keys, _nullable(queryset.model, keys))), per_page).get_page(
+        request.GET.get('page'))
@@ -0,0 +1,114 @@
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.db.models import OuterRef, Q, Subquery
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from ..models import Device, Order, OrderProduct, Process, Product, Raw, Task
+
+logger = logging.getLogger(__name__)
+
+# 按编码关联的外键：model.field 由 model.code_field 解析为 target 中 target_field 相同的记录。
+# 编码列保留（导入、排产都按编码读写），外键只是它的解析结果；同一毛坯编码有多条入库记录时指向 id 最小的一条
+Relation = namedtuple('Relation', ['model', 'field', 'code_field', 'target', 'target_field'])
+
+RELATIONS = (
+    Relation(Product, 'raw', 'raw_code', Raw, 'raw_code'),
+    Relation(Process, 'product', 'product_code', Product, 'product_code'),
+    Relation(OrderProduct, 'product', 'product_code', Product, 'product_code'),
+    Relation(Task, 'order', 'order_code', Order, 'order_code'),
+    Relation(Task, 'product', 'product_code', Product, 'product_code'),
+    Relation(Task, 'device', 'device_name', Device, 'device_name'),
+)
+
+# 批量导入的嵌套层数（按线程），大于 0 时逐行保存不解析外键，见 batch_resolution
+_batch = threading.local()
+
+
+def _target_ids(relation):
+    return relation.target.objects.filter(**{relation.target_field: OuterRef(relation.code_field)}).order_by(
+        'id').values('id')[:1]
+
+
+def _resolve(relation, rows):
+    return rows.update(**{relation.field: Subquery(_target_ids(relation))})
+
+
+def resolve_relations(model=None, queryset=None):
+    """
+    按编码重新解析外键，每个关系一条带关联子查询的 UPDATE，查询数与行数无关。
+    model 缺省时解析所有模型；queryset 给定时只解析其中的行（批量写入后调用）。返回更新的行数。
+    """
+    updated = 0
+    for relation in RELATIONS:
+        if model is None or relation.model is model:
+            updated += _resolve(relation, queryset if queryset is not None else relation.model.objects.all())
+    return updated
+
+
+@contextmanager
+def batch_resolution():
+    """
+    批量导入时使用：块内逐行保存、新增或删除目标记录都不解析外键，
+    块正常结束时按编码统一解析一次（resolve_relations），查询数与导入行数无关。可以嵌套，最外层结束时解析
+    """
+    depth = getattr(_batch, 'depth', 0)
+    _batch.depth = depth + 1
+    try:
+        yield
+    finally:
+        _batch.depth = depth
+    if depth == 0:
+        resolve_relations()
+
+
+def _in_batch():
+    return getattr(_batch, 'depth', 0) > 0
+
+
+def _resolve_instance(sender, instance, update_fields=None, **kwargs):
+    # 逐行保存时解析外键（网页上单条增改）；已缓存的关联对象编码一致时不再查询
+    if _in_batch():
+        return
+    for relation in RELATIONS:
+        if relation.model is not sender:
+            continue
+        if update_fields is not None and relation.code_field not in update_fields:
+            continue
+        code = getattr(instance, relation.code_field)
+        field = sender._meta.get_field(relation.field)
+        cached = field.get_cached_value(instance, None)
+        if cached is not None and getattr(cached, relation.target_field) == code:
+            continue
+        target_id = relation.target.objects.filter(**{relation.target_field: code}).order_by('id').values_list(
+            'id', flat=True).first() if code else None
+        setattr(instance, field.attname, target_id)
+
+
+def _target_changed(sender, instance, **kwargs):
+    """
+    目标记录新增、改编码或删除后重新解析受影响的行：同编码、还没解析到或指向 id 更大的同编码记录的行，
+    以及原来指向它、编码已对不上的行（目标改了编码）。删除时外键已置空，同编码的行改接其他记录
+    """
+    if _in_batch():
+        return
+    for relation in RELATIONS:
+        if relation.target is not sender:
+            continue
+        code = getattr(instance, relation.target_field)
+        rows = Q(**{relation.field: instance.pk}) & ~Q(**{relation.code_field: code})
+        if code:
+            rows |= Q(**{relation.code_field: code}) & (
+                Q(**{f'{relation.field}__isnull': True}) | Q(**{f'{relation.field}__gt': instance.pk}))
+        _resolve(relation, relation.model.objects.filter(rows))
+
+
+def connect_signals():
+    """按编码解析外键的信号，由 AppConfig.ready() 调用"""
+    for model in {relation.model for relation in RELATIONS}:
+        pre_save.connect(_resolve_instance, sender=model, dispatch_uid=f'relations_{model.__name__}_resolve')
+    for target in {relation.target for relation in RELATIONS}:
+        post_save.connect(_target_changed, sender=target, dispatch_uid=f'relations_{target.__name__}_save')
+        post_delete.connect(_target_changed, sender=target, dispatch_uid=f'relations_{target.__name__}_delete')
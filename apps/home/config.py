@@ -8,4 +8,12 @@ from django.apps import AppConfig
 
 class MyConfig(AppConfig):
     name = 'apps.home'
-    label = 'apps_home'
+    label = 'home'
+
+    def ready(self):
+        # 模型加载完后再注册信号，避免在 models.py 末尾循环导入
+        from .common import relations
+        from .reports import dashboard, eta
+        relations.connect_signals()
+        dashboard.connect_signals()
+        eta.connect_signals()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...common.explain import HOT_QUERIES, explain_query
+
+
+class Command(BaseCommand):
+    help = '对登记的热点查询执行 EXPLAIN，列出整表扫描，检查 Meta.indexes 中的索引是否被用上'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', help=f"只检查这些查询：{', '.join(HOT_QUERIES)}")
+        parser.add_argument('--sql', action='store_true', help='同时输出 SQL')
+        parser.add_argument('--strict', action='store_true', help='有整表扫描时以错误退出')
+
+    def handle(self, *args, **options):
+        unknown = set(options['queries']) - set(HOT_QUERIES)
+        if unknown:
+            raise CommandError(f"Unknown queries: {', '.join(sorted(unknown))}")
+        scanned = []
+        for name in options['queries'] or HOT_QUERIES:
+            plan = explain_query(name)
+            if plan.scans:
+                scanned.append(name)
+                self.stdout.write(self.style.WARNING(f"{name}: full scan of {', '.join(plan.scans)}"))
+            else:
+                self.stdout.write(f"{name}: ok")
+            if options['sql']:
+                self.stdout.write(f"  {plan.sql}")
+            for line in plan.plan.splitlines():
+                self.stdout.write(f"  {line}")
+        if scanned and options['strict']:
+            raise CommandError(f"Full scans in: {', '.join(scanned)}")
+        self.stdout.write(self.style.SUCCESS('Done'))
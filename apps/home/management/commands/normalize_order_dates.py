@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import CharField
+from django.db.models.functions import Cast
+
+from ...common.dates import to_date
+from ...models import Order
+from ...reports.dashboard import mark_dirty
+from ...reports.eta import refresh_order_etas
+
+DATE_FIELDS = ('order_start_date', 'order_end_date')
+
+
+def normalize_order_dates(batch_size=1000):
+    """
+    把订单表里历史遗留的日期字符串（2024/1/5、20240105、带时间部分等）改写为 date，无法解析的置空，
+    返回 (改写的订单数, 置空的日期数)。
+    日期列按字符串读出（Cast），不经过 DateField 的转换，旧值格式不对也不会报错；也可以在数据迁移的 RunPython 中调用。
+    """
+    rows = Order.objects.annotate(**{f'raw_{field}': Cast(field, CharField()) for field in DATE_FIELDS}).values_list(
+        'id', *(f'raw_{field}' for field in DATE_FIELDS))
+    orders = []
+    cleared = 0
+    for order_id, *values in rows.iterator():
+        dates = [to_date(value) for value in values]
+        if [day.isoformat() if day else None for day in dates] == [value or None for value in values]:
+            continue
+        cleared += sum(bool(value) and day is None for value, day in zip(values, dates))
+        orders.append(Order(id=order_id, **dict(zip(DATE_FIELDS, dates))))
+    with transaction.atomic():
+        Order.objects.bulk_update(orders, DATE_FIELDS, batch_size=batch_size)
+    return len(orders), cleared
+
+
+class Command(BaseCommand):
+    help = ('把订单的下单日期、交货日期统一为 YYYY-MM-DD（无法解析的置空）。'
+            '订单日期从字符串改为 DateField 后执行一次：SQLite 改字段类型时原样保留旧字符串')
+
+    def handle(self, *args, **options):
+        rewritten, cleared = normalize_order_dates()
+        if rewritten:
+            # bulk_update 不发信号，看板和预计完工跟着重算
+            mark_dirty(Order)
+            refresh_order_etas()
+        self.stdout.write(f"Rewrote {rewritten} orders, {cleared} unparseable dates cleared")
+        self.stdout.write(self.style.SUCCESS('Done'))
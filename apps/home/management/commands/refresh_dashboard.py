@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...reports.dashboard import SECTIONS, refresh_dashboard
+
+
+class Command(BaseCommand):
+    help = '重算首页看板的汇总数据（缺省全部部分）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sections', nargs='*', help=f"只重算这些部分：{', '.join(SECTIONS)}")
+
+    def handle(self, *args, **options):
+        unknown = set(options['sections']) - set(SECTIONS)
+        if unknown:
+            raise CommandError(f"Unknown sections: {', '.join(sorted(unknown))}")
+        started = time.time()
+        payloads = refresh_dashboard(options['sections'] or None)
+        self.stdout.write(f"Refreshed {', '.join(payloads)} in {time.time() - started:.2f}s")
+        self.stdout.write(self.style.SUCCESS('Done'))
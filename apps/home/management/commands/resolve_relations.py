@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...common.relations import RELATIONS, resolve_relations
+from ...reports.dashboard import mark_dirty
+
+
+class Command(BaseCommand):
+    help = '按编码解析外键（Product.raw、Process.product、OrderProduct.product、Task.order/product/device），缺省全部模型'
+
+    def add_arguments(self, parser):
+        models = sorted({relation.model.__name__ for relation in RELATIONS})
+        parser.add_argument('models', nargs='*', help=f"只解析这些模型：{', '.join(models)}")
+
+    def handle(self, *args, **options):
+        models = {relation.model.__name__: relation.model for relation in RELATIONS}
+        unknown = set(options['models']) - set(models)
+        if unknown:
+            raise CommandError(f"Unknown models: {', '.join(sorted(unknown))}")
+        started = time.time()
+        with transaction.atomic():
+            for name in options['models'] or sorted(models):
+                resolve_relations(models[name])
+                # UPDATE 不发信号
+                mark_dirty(models[name])
+        resolved = []
+        for relation in RELATIONS:
+            if not options['models'] or relation.model.__name__ in options['models']:
+                rows = relation.model.objects.exclude(**{relation.code_field: None}).exclude(
+                    **{relation.code_field: ''})
+                unresolved = rows.filter(**{relation.field: None}).count()
+                resolved.append(f"{relation.model.__name__}.{relation.field}: {unresolved} unresolved")
+        self.stdout.write('\n'.join(resolved))
+        self.stdout.write(f"Resolved in {time.time() - started:.2f}s")
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,164 @@
+import cProfile
+import io
+import pstats
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...arrange.durations import DURATION_STATS
+from ...arrange.engine import run_schedule
+from ...arrange.optimizer import optimize_schedule
+from ...arrange.publish import publish_schedule, task_writer
+from ...arrange.reschedule import reschedule
+from ...arrange.rules import DISPATCH_RULES
+from ...arrange.runs import ScheduleBusy, schedule_summary, single_flight
+from ...arrange.scenarios import Scenario, run_scenarios
+from ...arrange.shop_calendar import SHOP_CALENDAR
+from ...arrange.snapshot import load_snapshot
+from ...arrange.validator import validate_schedule
+from ...job_scheduler import STREAM_WINDOW_DAYS
+
+OUTPUT_COLUMNS = ['task_start_time', 'task_end_time', 'order_code', 'product_code', 'process_i', 'process_name',
+                  'device_name', 'product_num', 'is_changeover']
+
+
+class Command(BaseCommand):
+    help = '在命令行中排产（适合定时任务），默认把结果写入 Task 表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start-date', help='开始日期 YYYY-MM-DD，默认今天')
+        parser.add_argument('--horizon-days', type=int, help='只排开始日期起这么多天，默认排完')
+        parser.add_argument('--rule', action='append', dest='rules', choices=sorted(DISPATCH_RULES),
+                            help='派工规则，可重复给出多个，此时并行比较后取最好的方案')
+        parser.add_argument('--workers', type=int, help='比较多个规则时的进程数')
+        parser.add_argument('--optimize-seconds', type=float, default=0, help='写库后再做限时优化的秒数')
+        parser.add_argument('--stream', action='store_true', help='按交期分批读取订单行，结果分块写库')
+        parser.add_argument('--window-days', type=int, default=STREAM_WINDOW_DAYS, help='流式排产的接入视野（工作日）')
+        parser.add_argument('--durations', choices=('static',) + DURATION_STATS,
+                            help='加工时长来源：static 为工序表，其余为完工记录学到的统计量；默认取 LEARNED_DURATIONS 设置')
+        parser.add_argument('--reschedule', action='store_true',
+                            help='从现在起重排：保留已开工和已完工的任务，只改动有变化的 Task 行')
+        parser.add_argument('--output', help='把结果写到 .csv 或 .parquet 文件，而不是 Task 表')
+        parser.add_argument('--dry-run', action='store_true', help='只排产和统计，不写库也不写文件')
+        parser.add_argument('--profile', action='store_true', help='打印 cProfile 耗时统计')
+
+    def handle(self, *args, **options):
+        try:
+            day = datetime.strptime(options['start_date'], '%Y-%m-%d') if options['start_date'] else \
+                timezone.localtime().replace(tzinfo=None)
+        except ValueError:
+            raise CommandError('Invalid --start-date, please use YYYY-MM-DD')
+        start_date = timezone.make_aware(datetime.combine(day.date(), datetime.min.time()))
+        rules = options['rules'] or ['edd']
+        output = options['output']
+        if output and not output.endswith(('.csv', '.parquet')):
+            raise CommandError('--output must end with .csv or .parquet')
+        if options['stream'] and len(rules) > 1:
+            raise CommandError('--stream runs a single rule')
+        if options['reschedule'] and (len(rules) > 1 or options['stream'] or output or options['dry_run']):
+            raise CommandError('--reschedule runs a single rule and writes to the Task table')
+        to_db = not options['dry_run'] and not output
+
+        until = None
+        if options['horizon_days']:
+            until = SHOP_CALENDAR.offset_of(start_date + timedelta(days=options['horizon_days']))
+
+        window = options['window_days'] * SHOP_CALENDAR.day_minutes if options['stream'] else None
+        stream_from = start_date.strftime('%Y-%m-%d') if options['stream'] else None
+
+        profiler = cProfile.Profile() if options['profile'] else None
+        if profiler:
+            profiler.enable()
+        started = time.time()
+
+        def schedule():
+            if options['reschedule']:
+                result, changes = reschedule(rule=rules[0])
+                return None, dict(schedule_summary(result), **changes)
+            if len(rules) > 1:
+                scenarios = [Scenario(rule, start_date) for rule in rules]
+                results = run_scenarios(scenarios, workers=options['workers'], publish=to_db,
+                                        snapshot=load_snapshot(durations=options['durations']), until=until,
+                                        keep_rows=True)
+                for result in results:
+                    self.stdout.write(f"{result['scenario'].rule}: score {result['score']:.1f}, "
+                                      f"planned {result['planned']}, unscheduled {result['unscheduled']}, "
+                                      f"{result['seconds']}s")
+                best = results[0]
+                rows = best['rows']
+                summary = {'rule': best['scenario'].rule, 'planned': best['planned'],
+                           'unscheduled': best['unscheduled']}
+            elif options['stream'] and to_db:
+                snapshot = load_snapshot(stream_from=stream_from, durations=options['durations'])
+                with task_writer() as write:
+                    result = run_schedule(snapshot, start_date, rule=rules[0], until=until, window=window,
+                                          on_rows=write)
+                rows = None
+                summary = schedule_summary(result)
+            else:
+                snapshot = load_snapshot(stream_from=stream_from, durations=options['durations'])
+                result = run_schedule(snapshot, start_date, rule=rules[0], until=until, window=window)
+                rows = result.rows
+                if to_db:
+                    publish_schedule(rows)
+                summary = schedule_summary(result)
+            return rows, summary
+
+        def execute():
+            rows, summary = schedule()
+            if to_db and options['optimize_seconds']:
+                # 优化会重写 Task 表，和排产一起放在单飞锁里
+                optimize_schedule(SHOP_CALENDAR.day_start(start_date), options['optimize_seconds'],
+                                  workers=options['workers'], durations=options['durations'])
+            return rows, summary
+
+        if to_db:
+            # 和网页上的排产共用单飞锁
+            params = {'action': 'command', 'start_date': start_date, 'horizon_days': options['horizon_days'],
+                      'rules': rules, 'stream': options['stream'], 'window_days': options['window_days'],
+                      'reschedule': options['reschedule'], 'durations': options['durations'],
+                      'optimize_seconds': options['optimize_seconds']}
+            outcome = []
+            try:
+                run, attached = single_flight(params, lambda: outcome.append(execute()),
+                                              summarise=lambda _: outcome[0][1])
+            except ScheduleBusy as busy:
+                raise CommandError(f"Schedule run {busy.run.id} is in progress")
+            if attached:
+                self.stdout.write(f"Attached to schedule run {run.id}: {run.status} {run.summary}")
+                return
+            rows, summary = outcome[0]
+        else:
+            rows, summary = execute()
+        scheduled = time.time()
+
+        if output:
+            frame = pd.DataFrame(rows, columns=OUTPUT_COLUMNS)
+            if output.endswith('.parquet'):
+                try:
+                    frame.to_parquet(output, index=False)
+                except ImportError:
+                    raise CommandError('Writing parquet needs pyarrow or fastparquet installed')
+            else:
+                frame.to_csv(output, index=False)
+            self.stdout.write(f"Wrote {len(frame)} tasks to {output}")
+        finished = time.time()
+
+        if profiler:
+            profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(25)
+            self.stdout.write(stream.getvalue())
+
+        for key, value in summary.items():
+            self.stdout.write(f"{key}: {value}")
+        self.stdout.write(f"Scheduled in {scheduled - started:.2f}s, total {finished - started:.2f}s")
+
+        if to_db:
+            violations = {kind: len(items) for kind, items in validate_schedule().items() if items}
+            if violations:
+                raise CommandError(f"Schedule has violations: {violations}")
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...arrange.validator import VIOLATION_KINDS, validate_schedule
+
+
+class Command(BaseCommand):
+    help = '检查 Task 表中的排产结果：设备重叠、工序顺序、班次和产能'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help='每类违规最多打印多少条')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        report = validate_schedule()
+        seconds = time.time() - started
+
+        total = 0
+        for kind in VIOLATION_KINDS:
+            violations = report[kind]
+            total += len(violations)
+            self.stdout.write(f"{kind}: {len(violations)}")
+            for violation in violations[:options['limit']]:
+                self.stdout.write(f"  {violation}")
+        self.stdout.write(f"Checked in {seconds:.2f}s")
+        if total:
+            raise CommandError(f"Found {total} violations")
+        self.stdout.write(self.style.SUCCESS('Schedule is feasible'))
@@ -6,6 +6,8 @@ from django.utils import timezone
 
 from datetime import datetime
 
+from .common.dates import to_date
+
 
 class CustomUser(AbstractUser):
     """
@@ -44,6 +46,12 @@ class Raw(models.Model):
     raw_num = models.IntegerField(default=0)
     raw_weight = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            # 按毛坯编码查库存（排产毛坯台账、Product.raw 解析）
+            models.Index(fields=['raw_code']),
+        ]
+
     def __str__(self):
         return f"{self.raw_code} - {self.raw_date_add}"
 
@@ -57,8 +65,16 @@ class Product(models.Model):
     product_name = models.CharField(max_length=255, null=True, blank=True)
     product_kind = models.CharField(max_length=255, null=True, blank=True)
     raw_code = models.CharField(max_length=255, blank=True, null=True)
+    # 由 raw_code 解析（同一毛坯编码有多条入库记录时取 id 最小的一条），见 common/relations.py
+    raw = models.ForeignKey(Raw, on_delete=models.SET_NULL, related_name='products', null=True, blank=True)
     weight = models.FloatField(null=True, blank=True, default=0.0)
 
+    class Meta:
+        indexes = [
+            # 毛坯入库或改编码后按 raw_code 重新解析 Product.raw
+            models.Index(fields=['raw_code']),
+        ]
+
 
 class Device(models.Model):
     """
@@ -74,6 +90,8 @@ class Device(models.Model):
     start_time = models.DateTimeField(default=timezone.make_aware(datetime(1970, 1, 1)))
     end_time = models.DateTimeField(default=timezone.make_aware(datetime(1970, 1, 1)))
     is_fault = models.BooleanField(default=False)
+    # 最近一次报完工的时刻，下一个任务的实际时长从这里起算，见 arrange/durations.py
+    last_completed_at = models.DateTimeField(null=True, blank=True)
     efficiency = models.FloatField(default=1.0)  # 生产效率值，默认为1
 
     def __str__(self):
@@ -86,11 +104,17 @@ class Order(models.Model):
     """
     id = models.AutoField(primary_key=True)  # 默认行为是自动增长
     order_code = models.CharField(max_length=255, blank=True, unique=True)  # 确保 order_code 是唯一的
-    order_start_date = models.CharField(max_length=255, blank=True)
-    order_end_date = models.CharField(max_length=255, blank=True)
+    order_start_date = models.DateField(null=True, blank=True, db_index=True)
+    order_end_date = models.DateField(null=True, blank=True, db_index=True)
     is_done = models.BooleanField(default=False)
     order_custom_name = models.CharField(max_length=255, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # 未完成订单按下单日期取（排产快照、需求计划）
+            models.Index(fields=['is_done', 'order_start_date']),
+        ]
+
     def __str__(self):
         return self.order_code
 
@@ -98,8 +122,8 @@ class Order(models.Model):
     def from_dataframe_rows(cls, order_row, products_rows):
         order = cls(
             order_code=order_row['订单编号'],
-            order_start_date=order_row['订单日期'],
-            order_end_date=order_row['交货日期'],
+            order_start_date=to_date(order_row['订单日期']),
+            order_end_date=to_date(order_row['交货日期']),
             order_custom_name=order_row['客户']
         )
         order.save()  # 保存订单
@@ -114,6 +138,7 @@ class OrderProduct(models.Model):
     id = models.AutoField(primary_key=True)  # 默认行为是自动增长
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='products', null=True, blank=True)
     product_code = models.CharField(max_length=255, blank=True)
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, related_name='order_lines', null=True, blank=True)
     product_num_todo = models.IntegerField(default=0)
     product_num_done = models.IntegerField(default=0)
     cur_process_i = models.IntegerField(default=0)
@@ -121,6 +146,14 @@ class OrderProduct(models.Model):
     end_time = models.DateTimeField(default=timezone.make_aware(datetime(1970, 1, 1)))
     product_kind = models.CharField(max_length=255, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # 订单的未完成订单行（报完工时判断订单是否完成）
+            models.Index(fields=['order', 'is_done']),
+            # 商品新增或改编码后按 product_code 重新解析 OrderProduct.product
+            models.Index(fields=['product_code']),
+        ]
+
     def __str__(self):
         return f"{self.order.order_code} - {self.product_code}"
 
@@ -172,10 +205,17 @@ class Process(models.Model):
     process_capacity = models.IntegerField(null=True, blank=True, default=0)
     process_duration = models.FloatField(null=True, blank=True, default=0.0)
     product_code = models.CharField(max_length=255, null=True, blank=True)
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, related_name='processes', null=True, blank=True)
     device_name = models.CharField(max_length=255, null=True, blank=True)
     is_outside = models.BooleanField(default=False)
     is_last_process = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # 商品的工艺路线按工序号取
+            models.Index(fields=['product_code', 'process_i']),
+        ]
+
     def __str__(self):
         return f"{self.process_name}-{self.process_i}"
 
@@ -190,6 +230,10 @@ class Task(models.Model):
     process_i = models.PositiveIntegerField(default=0)
     process_name = models.CharField(max_length=100, default='')
     device_name = models.CharField(max_length=100, default='')
+    # 由上面三个编码解析的外键，批量写入后统一解析，见 common/relations.py
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, related_name='tasks', null=True, blank=True)
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, related_name='tasks', null=True, blank=True)
+    device = models.ForeignKey(Device, on_delete=models.SET_NULL, related_name='tasks', null=True, blank=True)
     completed = models.BooleanField(default=False)
     inspected = models.BooleanField(default=False)
     product_num = models.IntegerField(default=0, null=True)
@@ -199,6 +243,18 @@ class Task(models.Model):
     class Meta:
         verbose_name = 'Order Processing Result'
         verbose_name_plural = 'Order Processing Results'
+        indexes = [
+            # 按时间窗口取重叠任务（设备负载等）
+            models.Index(fields=['task_start_time', 'task_end_time']),
+            # 设备上的任务按时间顺序（我的任务、插单、按设备的时间线）
+            models.Index(fields=['device_name', 'task_start_time']),
+            # 订单的任务（局部刷新预计完工、解析 Task.order）
+            models.Index(fields=['order_code']),
+            # 某道工序某商品的任务
+            models.Index(fields=['process_i', 'product_code']),
+            # 商品新增或改编码后按 product_code 重新解析 Task.product
+            models.Index(fields=['product_code']),
+        ]
 
     def __str__(self):
         return f"Order {self.order_code}, Product {self.product_code}, Process {self.process_i}"
@@ -209,3 +265,101 @@ class Weight(models.Model):
 
     def __str__(self):
         return f"{self.weight}"
+
+
+class ScheduleRun(models.Model):
+    """
+    排产运行记录，兼作排产的单飞锁：运行中的记录 lock 为 'schedule'（唯一约束），结束后清空
+    """
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (RUNNING, '运行中'),
+        (DONE, '已完成'),
+        (FAILED, '失败'),
+    ]
+
+    id = models.AutoField(primary_key=True)  # 默认行为是自动增长
+    lock = models.CharField(max_length=20, unique=True, null=True, blank=True)
+    params = models.TextField(default='')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=RUNNING)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    summary = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return f"ScheduleRun {self.id} ({self.status})"
+
+
+class DurationStat(models.Model):
+    """
+    按 (商品编码, 工序号, 设备) 累计的实际加工时长（工作分钟/批），每次报完工增量更新，不回扫历史。
+    mean/m2 为 Welford 累计量；quantiles 为 P² 分位数估计器的标记（JSON），见 arrange/durations.py
+    """
+    id = models.AutoField(primary_key=True)  # 默认行为是自动增长
+    product_code = models.CharField(max_length=255)
+    process_i = models.IntegerField(default=1)
+    device_name = models.CharField(max_length=255)
+    count = models.IntegerField(default=0)
+    mean = models.FloatField(default=0.0)
+    m2 = models.FloatField(default=0.0)
+    quantiles = models.TextField(blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('product_code', 'process_i', 'device_name')
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def __str__(self):
+        return f"{self.product_code}-{self.process_i}@{self.device_name}: {self.mean:.1f} ({self.count})"
+
+
+class ScheduleVersion(models.Model):
+    """
+    发布新排产结果前的 Task 表存档，用于比较两次排产的差异（见 arrange/diff.py）。
+    tasks 为 zlib 压缩的列式 JSON
+    """
+    id = models.AutoField(primary_key=True)  # 默认行为是自动增长
+    created_at = models.DateTimeField(default=timezone.now)
+    source = models.CharField(max_length=20, default='')
+    task_count = models.IntegerField(default=0)
+    tasks = models.BinaryField()
+
+    def __str__(self):
+        return f"ScheduleVersion {self.id} ({self.source}, {self.task_count} tasks)"
+
+
+class DashboardAggregate(models.Model):
+    """
+    首页看板的汇总数据，每个部分一行（JSON）。相关数据表变化时标记为过期，下次读取时只重算过期部分，
+    见 reports/dashboard.py
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    payload = models.TextField(default='{}')
+    dirty = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}{' (dirty)' if self.dirty else ''}"
+
+
+class OrderEta(models.Model):
+    """
+    订单预计完工：排产结果中该订单最后一个任务的完工时间。发布排产时整表重算，插单、重排时只更新受影响的订单，
+    见 reports/eta.py
+    """
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='eta', primary_key=True)
+    order_code = models.CharField(max_length=255, unique=True)
+    end_date = models.DateField(null=True, blank=True)
+    estimated_delivery = models.DateTimeField(null=True, blank=True)
+    remaining_days = models.IntegerField(null=True, blank=True)  # computed_on 当天距交货日期的天数
+    is_late = models.BooleanField(default=False)
+    computed_on = models.DateField()
+
+    def __str__(self):
+        return f"{self.order_code}: {self.estimated_delivery}"
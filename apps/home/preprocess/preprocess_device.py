@@ -3,6 +3,7 @@ import logging
 import pandas as pd
 from django.db import transaction
 
+from ..common.relations import batch_resolution
 from ..common.utils import log_execution
 from ..models import Device
 
@@ -33,7 +34,8 @@ def process_file(file_path):
 
 @log_execution
 def preprocess_device(file_path='../data/换型时间_MES.xlsx'):
-    process_file(file_path)
+    with batch_resolution():
+        process_file(file_path)
 
 
 if __name__ == '__main__':
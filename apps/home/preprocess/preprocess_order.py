@@ -2,6 +2,7 @@ import logging
 
 import pandas as pd
 
+from ..common.relations import batch_resolution
 from ..models import Order, OrderProduct
 
 logger = logging.getLogger(__name__)
@@ -36,10 +37,11 @@ def preprocess_order(file_path='./data/销货订单导出_202306241022.xlsx'):
     df = pd.read_excel(file_path, header=4).ffill()
     df = df[~df['商品编码'].str.contains('合计', na=False)]
 
-    for order_id, group in df.groupby('订单编号'):
-        order_row = group.iloc[0]
-        products_rows = group
-        Order.from_dataframe_rows(order_row, products_rows)
+    with batch_resolution():
+        for order_id, group in df.groupby('订单编号'):
+            order_row = group.iloc[0]
+            products_rows = group
+            Order.from_dataframe_rows(order_row, products_rows)
 
 
 if __name__ == "__main__":
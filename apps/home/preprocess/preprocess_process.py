@@ -4,6 +4,7 @@ import pandas as pd
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 
+from ..common.relations import batch_resolution
 from ..common.utils import log_execution
 from ..models import Process
 
@@ -56,9 +57,10 @@ def insert_data(df):
 def preprocess_process(file_path='./data/产品加工用时统计进度表.xlsx'):
     data = load_data(file_path)
 
-    for sheet_name, df in data.items():
-        logger.info(f"Processing sheet: {sheet_name}")
-        insert_data(df)
+    with batch_resolution():
+        for sheet_name, df in data.items():
+            logger.info(f"Processing sheet: {sheet_name}")
+            insert_data(df)
 
     logger.info("Done inserting process table")
 
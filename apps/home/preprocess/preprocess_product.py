@@ -3,6 +3,7 @@ import logging
 import pandas as pd
 from django.db import transaction
 
+from ..common.relations import batch_resolution
 from ..models import Product
 
 logger = logging.getLogger(__name__)
@@ -12,7 +13,7 @@ logger.setLevel(logging.INFO)
 def preprocess_product(file_path):
     df = pd.read_excel(file_path)
 
-    with transaction.atomic():
+    with batch_resolution(), transaction.atomic():
         for index, row in df.iterrows():
             if pd.notna(row['净重（KG)']):
                 product_code = row['商品编码'].strip()
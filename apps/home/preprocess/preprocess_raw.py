@@ -3,6 +3,7 @@ import logging
 import pandas as pd
 from django.db import transaction, IntegrityError
 
+from ..common.relations import batch_resolution
 from ..common.utils import log_execution
 from ..models import Raw
 
@@ -32,7 +33,7 @@ def process_file(file_path):
 
 @log_execution
 def preprocess_raw(file_path=f"./data/毛坯和成品对应表.xlsx"):
-    with transaction.atomic():
+    with batch_resolution(), transaction.atomic():
         process_file(file_path)
     logger.info("Done processing raw and product data")
 
@@ -3,6 +3,7 @@ import logging
 import pandas as pd
 from django.db import transaction, IntegrityError
 
+from ..common.relations import batch_resolution
 from ..common.utils import log_execution
 from ..models import Raw
 
@@ -38,7 +39,7 @@ def process_file(file_path):
 
 @log_execution
 def preprocess_raw(file_path=f"../upload_data/毛坯表.xlsx"):
-    with transaction.atomic():
+    with batch_resolution(), transaction.atomic():
         process_file(file_path)
     logger.info("Done processing raw and product data")
 
@@ -0,0 +1,183 @@
+import json
+import logging
+import uuid
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models import Count
+
+from .device_load import device_load, load_window
+from .eta import order_etas
+from .queries import monthly_weights
+from ..arrange.kpi import TASK_FIELDS, schedule_kpis
+from ..arrange.mrp import raw_summary, run_mrp
+from ..models import DashboardAggregate, Device, Order, OrderProduct, Process, Product, Raw, Task
+
+logger = logging.getLogger(__name__)
+
+# 首页各部分 -> 计算函数，见文件末尾的 SECTIONS
+# 各部分依赖的数据表：表有变化时对应部分标记为过期，下次读取时只重算过期的部分
+SECTION_SOURCES = {
+    'counts': (Order, Product, Raw, Device, Process),
+    'order_dates': (Order,),
+    'monthly_weights': (Order, OrderProduct, Product, Raw),
+    'device_load': (Task, Device),
+    'raw_stock': (Raw, Product, Order, OrderProduct, Task),
+    'kpis': (Task, Order, Device),
+}
+
+# 各部分读到的 Task 列（排产结果）。只改完工、检验进度的保存（update_fields 不含这些列）不影响看板，
+# 不使看板过期；不带 update_fields 的 Task.save() 仍按排产结果有变化处理
+TASK_SOURCE_FIELDS = frozenset(TASK_FIELDS)
+
+# raw_stock 部分的版本号 -> MrpResult，只保留最新的一个
+_mrp_cache = {}
+
+
+def sections_for(*models):
+    return [name for name, sources in SECTION_SOURCES.items() if any(model in sources for model in models)]
+
+
+def _counts():
+    return {
+        'orders_count': Order.objects.count(),
+        'products_count': Product.objects.count(),
+        'raw_count': Raw.objects.count(),
+        'exchange_count': Device.objects.count(),
+        'process_count': Process.objects.count(),
+    }
+
+
+def _order_dates():
+    """订单开始日期和交付日期的分布，各用一条按日期分组计数的查询（走日期索引）"""
+    data = {}
+    for field, prefix in (('order_start_date', 'start'), ('order_end_date', 'end')):
+        counts = list(Order.objects.exclude(**{field: None}).values_list(field).annotate(n=Count('id')).order_by(field))
+        data[f'{prefix}_dates'] = [day.isoformat() for day, _ in counts]
+        data[f'{prefix}_date_counts'] = [n for _, n in counts]
+    return data
+
+
+def _monthly_weights():
+    """每个月下单的毛坯重量"""
+    months, weights = monthly_weights()
+    return {'months': months, 'weights': weights}
+
+
+def _device_load():
+    """今天各设备的负载"""
+    window_start, window_end = load_window('day')
+    return {'device_details': device_load(window_start, window_end), 'device_load_date': window_start.date().isoformat()}
+
+
+def _raw_stock():
+    """各毛坯排完所有未开工订单行后的预计结余（从少到多），以及各毛坯最大缺口之和"""
+    result = run_mrp()
+    version = uuid.uuid4().hex
+    _mrp_cache.clear()
+    _mrp_cache[version] = result
+    summary = raw_summary(result)
+    return {
+        'remaining_quantities': sorted(summary, key=lambda x: x['remaining_quantity']),
+        'shortage_raw_quantity': sum(raw['shortage'] for raw in summary),
+        'mrp_version': version,
+    }
+
+
+def _kpis():
+    return {'kpis': schedule_kpis()}
+
+
+SECTIONS = {
+    'counts': _counts,
+    'order_dates': _order_dates,
+    'monthly_weights': _monthly_weights,
+    'device_load': _device_load,
+    'raw_stock': _raw_stock,
+    'kpis': _kpis,
+}
+
+
+def mrp_plan():
+    """
+    当前的毛坯需求计划（见 arrange/mrp.py），与看板的 raw_stock 部分一起计算、一起过期。
+    结果按 raw_stock 的版本号缓存在进程内，别的进程重算过时本进程跟着重算一次。
+    """
+    aggregate = DashboardAggregate.objects.filter(name='raw_stock').first()
+    if aggregate is None or aggregate.dirty:
+        version = refresh_dashboard(['raw_stock'])['raw_stock']['mrp_version']
+    else:
+        version = json.loads(aggregate.payload).get('mrp_version')
+    if version not in _mrp_cache:
+        _mrp_cache.clear()
+        _mrp_cache[version] = run_mrp()
+    return _mrp_cache[version]
+
+
+def mark_dirty(*models):
+    """数据表有变化：依赖它们的部分标记为过期，一条 UPDATE"""
+    DashboardAggregate.objects.filter(name__in=sections_for(*models), dirty=False).update(dirty=True)
+
+
+def refresh_dashboard(sections=None):
+    """重算并保存指定部分（缺省全部），返回 名称 -> 数据"""
+    payloads = {}
+    for name in sections or SECTIONS:
+        payloads[name] = SECTIONS[name]()
+        DashboardAggregate.objects.update_or_create(
+            name=name, defaults={'payload': json.dumps(payloads[name], default=str), 'dirty': False})
+    logger.info(f"Refreshed dashboard sections: {', '.join(payloads)}")
+    return payloads
+
+
+def dashboard_data():
+    """读出所有部分（一条查询），缺失或过期的部分先重算"""
+    stored = DashboardAggregate.objects.in_bulk(list(SECTIONS), field_name='name')
+    payloads = {name: json.loads(aggregate.payload) for name, aggregate in stored.items()}
+    stale = [name for name in SECTIONS if name not in stored or stored[name].dirty]
+    # 设备负载按天统计，跨天后也要重算
+    today = load_window('day')[0].date().isoformat()
+    if 'device_load' not in stale and payloads.get('device_load', {}).get('device_load_date') != today:
+        stale.append('device_load')
+    if stale:
+        payloads.update(refresh_dashboard(stale))
+    data = {}
+    for name in SECTIONS:
+        data.update(payloads[name])
+
+    # 订单预计完工直接读 OrderEta 表
+    data['order_details_combined'] = [{
+        'order_code': eta.order_code,
+        'end_date': eta.end_date,
+        'remaining_days': eta.remaining_days,
+        'estimated_delivery_date': eta.estimated_delivery,
+        'is_late': eta.is_late,
+    } for eta in order_etas()]
+    return data
+
+
+def _changed(sender, **kwargs):
+    mark_dirty(sender)
+
+
+def _task_saved(sender, update_fields=None, **kwargs):
+    if update_fields is not None and TASK_SOURCE_FIELDS.isdisjoint(update_fields):
+        return
+    mark_dirty(Task)
+
+
+def _device_users_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        mark_dirty(Device)
+
+
+def connect_signals():
+    """
+    单行的增删改通过信号使看板过期，由 AppConfig.ready() 调用。Task 只接 post_save（接 post_delete 会让整表删除
+    退化为逐行删除），批量写 Task 的地方（发布、重排、插单、优化、清空）直接调用 mark_dirty 或 refresh_dashboard
+    """
+    for model in (Order, OrderProduct, Product, Raw, Device, Process):
+        post_save.connect(_changed, sender=model, dispatch_uid=f'dashboard_{model.__name__}_save')
+        post_delete.connect(_changed, sender=model, dispatch_uid=f'dashboard_{model.__name__}_delete')
+    post_save.connect(_task_saved, sender=Task, dispatch_uid='dashboard_Task_save')
+    m2m_changed.connect(_device_users_changed, sender=Device.operators.through, dispatch_uid='dashboard_operators')
+    m2m_changed.connect(_device_users_changed, sender=Device.inspectors.through, dispatch_uid='dashboard_inspectors')
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from ..arrange.shop_calendar import SHOP_CALENDAR
+from ..common.frames import queryset_frame
+from ..models import CustomUser, Device, Task
+
+LOAD_PERIODS = ('day', 'week', 'month')
+
+
+def load_window(period='day', day=None, calendar=SHOP_CALENDAR):
+    """
+    包含 day（缺省今天）的自然日、自然周（周一开始）或自然月，返回本地时区的 [开始, 结束)。
+    """
+    if period not in LOAD_PERIODS:
+        raise ValueError(f"Unknown period: {period}")
+    if day is None:
+        day = timezone.localtime(timezone.now(), calendar.get_tz()).date()
+    if period == 'day':
+        start, end = day, day + timedelta(days=1)
+    elif period == 'week':
+        start = day - timedelta(days=day.weekday())
+        end = start + timedelta(days=7)
+    else:
+        start = day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+    tz = calendar.get_tz()
+    return (timezone.make_aware(datetime.combine(start, datetime.min.time()), tz),
+            timezone.make_aware(datetime.combine(end, datetime.min.time()), tz))
+
+
+def device_load(window_start, window_end, calendar=SHOP_CALENDAR):
+    """
+    窗口内各设备的负载：任务占用的工作分钟 / 窗口内班次的工作分钟。
+    与窗口重叠的任务用一条按时间范围过滤的查询读出，重叠分钟按列向量计算；
+    设备及其操作员、质检员一共三条查询（prefetch），各取 id 最小的一位显示。
+    """
+    tasks = queryset_frame(
+        Task.objects.filter(task_start_time__lt=window_end, task_end_time__gt=window_start),
+        ('device_name', 'task_start_time', 'task_end_time'), ('task_start_time', 'task_end_time'))
+    start_minute = calendar.to_minute(window_start)
+    end_minute = calendar.to_minute(window_end)
+    busy_minutes = pd.Series(
+        calendar.overlap_minutes(calendar.to_minutes(tasks['task_start_time'], exact=True),
+                                 calendar.to_minutes(tasks['task_end_time'], exact=True),
+                                 start_minute, end_minute),
+        dtype=float).groupby(tasks['device_name'].to_numpy()).sum()
+    capacity = calendar.working_offset(end_minute) - calendar.working_offset(start_minute)
+
+    users = CustomUser.objects.order_by('id').only('id', 'username')
+    devices = Device.objects.order_by('id').prefetch_related(
+        Prefetch('operators', queryset=users), Prefetch('inspectors', queryset=users))
+    device_details = []
+    for device in devices:
+        operators = device.operators.all()
+        inspectors = device.inspectors.all()
+        busy = float(busy_minutes.get(device.device_name, 0.0))
+        device_details.append({
+            'device_name': device.device_name,
+            'operator': operators[0].username if operators else 'N/A',
+            'inspector': inspectors[0].username if inspectors else 'N/A',
+            'busy_minutes': round(busy, 2),
+            'load_percentage': busy / capacity * 100 if capacity else 0.0,
+        })
+    return device_details
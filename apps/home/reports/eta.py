@@ -0,0 +1,88 @@
+import json
+import logging
+
+from django.db import transaction
+from django.db.models import F, Max
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from ..arrange.shop_calendar import SHOP_CALENDAR
+from ..models import DashboardAggregate, Order, OrderEta, Task
+
+logger = logging.getLogger(__name__)
+
+# 最近一次整表重算的日期记在看板汇总表的这一行里（不是看板的部分，不会被标记过期）；
+# 没有订单时 OrderEta 为空，靠它判断今天是否已经算过
+REFRESH_MARKER = 'order_etas'
+
+
+def _today(calendar=SHOP_CALENDAR):
+    return timezone.localtime(timezone.now(), calendar.get_tz()).date()
+
+
+def refresh_order_etas(order_codes=None, calendar=SHOP_CALENDAR):
+    """
+    用一次分组 Max(task_end_time) 算出订单预计完工，连同剩余天数和是否延期写入 OrderEta。
+    order_codes 给定时只更新这些订单（插单、重排等局部修改），否则整表重算。
+    预计完工晚于交货日期，或还没排上而交货日期已过的未完成订单，记为延期。
+    """
+    today = _today(calendar)
+    orders = Order.objects.all()
+    tasks = Task.objects.all()
+    if order_codes is not None:
+        order_codes = sorted(set(order_codes))
+        orders = orders.filter(order_code__in=order_codes)
+        tasks = tasks.filter(order_code__in=order_codes)
+    etas = dict(tasks.values('order_code').annotate(eta=Max('task_end_time')).values_list('order_code', 'eta'))
+
+    rows = []
+    for order_id, order_code, order_end_date, is_done in orders.values_list(
+            'id', 'order_code', 'order_end_date', 'is_done'):
+        eta = etas.get(order_code)
+        remaining_days = (order_end_date - today).days if order_end_date else None
+        if eta is not None:
+            is_late = bool(order_end_date and timezone.localtime(eta, calendar.get_tz()).date() > order_end_date)
+        else:
+            is_late = bool(not is_done and remaining_days is not None and remaining_days < 0)
+        rows.append(OrderEta(order_id=order_id, order_code=order_code, end_date=order_end_date,
+                             estimated_delivery=eta, remaining_days=remaining_days, is_late=is_late,
+                             computed_on=today))
+
+    with transaction.atomic():
+        if order_codes is None:
+            OrderEta.objects.all().delete()
+            DashboardAggregate.objects.update_or_create(
+                name=REFRESH_MARKER, defaults={'payload': json.dumps({'computed_on': today.isoformat()})})
+        else:
+            OrderEta.objects.filter(order_id__in=[row.order_id for row in rows]).delete()
+        OrderEta.objects.bulk_create(rows, batch_size=1000)
+    logger.info(f"Refreshed ETA of {len(rows)} orders")
+    return len(rows)
+
+
+def order_etas(calendar=SHOP_CALENDAR):
+    """
+    读出所有订单的预计完工（一条查询），按剩余天数从少到多排序。
+    剩余天数随日期变化：表中的数据不是今天算的（表为空时看 REFRESH_MARKER，今天还没整表算过）时先整表重算一次。
+    """
+    etas = list(OrderEta.objects.order_by(F('remaining_days').asc(nulls_last=True), 'order_code'))
+    today = _today(calendar)
+    if etas:
+        stale = any(eta.computed_on != today for eta in etas)
+    else:
+        marker = DashboardAggregate.objects.filter(name=REFRESH_MARKER).values_list('payload', flat=True).first()
+        stale = marker is None or json.loads(marker).get('computed_on') != today.isoformat()
+    if stale:
+        refresh_order_etas(calendar=calendar)
+        etas = list(OrderEta.objects.order_by(F('remaining_days').asc(nulls_last=True), 'order_code'))
+    return etas
+
+
+def _order_saved(sender, instance, **kwargs):
+    # 交货日期可能改了
+    refresh_order_etas([instance.order_code])
+
+
+def connect_signals():
+    """订单保存后局部刷新其预计完工，由 AppConfig.ready() 调用"""
+    post_save.connect(_order_saved, sender=Order, dispatch_uid='order_eta_save')
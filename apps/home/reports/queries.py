@@ -0,0 +1,25 @@
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
+
+from ..models import Order, OrderProduct
+
+
+def monthly_weights():
+    """
+    每个月下单的毛坯重量：毛坯单重 × 待生产数量，按订单开始日期的月份汇总。
+    按月分组和求和都在 SQL 里完成（TruncMonth + 订单行 -> 商品 -> 毛坯的外键 JOIN），一条查询汇总订单行，
+    再加一条读出所有订单的月份，查询数与订单量无关。商品不存在或毛坯不存在的订单行重量为 0；
+    同一毛坯编码有多条入库记录时取最早的一条（外键的解析规则）；没有下单日期的订单不计入。
+    返回 (月份列表, 重量列表)。
+    """
+    by_month = dict(
+        OrderProduct.objects.filter(order__order_start_date__isnull=False).annotate(
+            month=TruncMonth('order__order_start_date')).values_list('month').annotate(
+            weight=Sum(Coalesce(F('product__raw__raw_weight'), Value(0)) * F('product_num_todo'))).order_by('month'))
+
+    # 没有订单行的订单所在月份也列出，重量为 0
+    months = set(Order.objects.filter(order_start_date__isnull=False).annotate(
+        month=TruncMonth('order_start_date')).values_list('month', flat=True).distinct()) | set(by_month)
+    months = sorted(months)
+    return [month.strftime('%Y-%m') for month in months], [round(float(by_month.get(month) or 0), 2)
+                                                          for month in months]
@@ -3,6 +3,828 @@
 Copyright (c) 2019 - present AppSeed.us
 """
 
-from django.test import TestCase
+import json
+import random
+import statistics
+import threading
+from datetime import date, datetime, timedelta
 
-# Create your tests here.
+from django.db import connection
+from django.db.models import F
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .arrange.diff import VERSIONS_KEPT, archive_schedule, current_schedule, diff_schedules, load_version
+from .arrange.durations import (MIN_SAMPLES, P2Quantile, load_learned_durations, record_completion,
+                                record_duration)
+from .arrange.engine import run_schedule
+from .arrange.evaluator import Operation, Plan, PlanEvaluator
+from .arrange.kpi import MAX_WIP_POINTS, schedule_kpis
+from .arrange.ledger import RawLedger
+from .arrange.mrp import raw_summary, run_mrp
+from .arrange.optimizer import load_plan, save_plan
+from .arrange.publish import publish_schedule
+from .arrange.reschedule import freeze, reschedule
+from .arrange.runs import LOCK_NAME, STALE_AFTER, ScheduleBusy, single_flight
+from .arrange.scenarios import UNSCHEDULED_PENALTY_MINUTES, Scenario, kpi_score, run_scenarios
+from .arrange.shop_calendar import SHOP_CALENDAR, LRUCache
+from .arrange.snapshot import load_snapshot
+from .arrange.timeline import insert_urgent_task
+from .arrange.validator import VIOLATION_KINDS, validate_schedule
+from .common.pagination import KeysetPage, keyset_page, paginate
+from .common.relations import batch_resolution
+from .models import (CustomUser, DashboardAggregate, Device, DurationStat, Order, OrderEta, OrderProduct, Process, Product,
+                     Raw, ScheduleRun, ScheduleVersion, Task)
+from .reports.dashboard import refresh_dashboard
+from .reports.eta import order_etas, refresh_order_etas
+
+START_DATE = timezone.make_aware(datetime(2024, 1, 8))
+
+
+def local_time(hour, minute=0, day=8):
+    return timezone.make_aware(datetime(2024, 1, day, hour, minute))
+
+
+def create_task(device_name, start, end, order_code='O1', product_code='P1', process_i=1, product_num=5):
+    return Task.objects.create(device_name=device_name, task_start_time=start, task_end_time=end,
+                               order_code=order_code, product_code=product_code, process_i=process_i,
+                               product_num=product_num)
+
+
+class EngineTests(TestCase):
+    """贪心排产：一个订单行，路线上有外协工序和没有对应设备的工序"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Device.objects.create(device_name='D1', changeover_time='0')
+        Device.objects.create(device_name='D2', changeover_time='0')
+        Product.objects.create(product_code='P1')
+        Process.objects.create(product_code='P1', process_i=1, process_name='车', process_duration=60,
+                               process_capacity=5, device_name='D1')
+        Process.objects.create(product_code='P1', process_i=2, process_name='热处理', process_duration=60,
+                               process_capacity=5, device_name='D1', is_outside=True)
+        Process.objects.create(product_code='P1', process_i=3, process_name='磨', process_duration=60,
+                               process_capacity=5, device_name='X9')
+        Process.objects.create(product_code='P1', process_i=4, process_name='铣', process_duration=30,
+                               process_capacity=5, device_name='D2')
+        order = Order.objects.create(order_code='O1', order_start_date=date(2024, 1, 1),
+                                     order_end_date=date(2024, 2, 1))
+        OrderProduct.objects.create(order=order, product_code='P1', product_num_todo=10)
+
+    def schedule(self):
+        return run_schedule(load_snapshot(durations='static'), START_DATE)
+
+    def test_outside_and_deviceless_steps_are_skipped(self):
+        result = self.schedule()
+        self.assertEqual(result.skipped_steps, 2)
+        self.assertEqual({row['process_i'] for row in result.rows}, {1, 4})
+        self.assertEqual(result.unscheduled, [])
+
+    def test_steps_are_split_into_batches(self):
+        rows = [row for row in self.schedule().rows if row['process_i'] == 1]
+        self.assertEqual([row['product_num'] for row in rows], [5, 5])
+        self.assertEqual({row['device_name'] for row in rows}, {'D1'})
+        self.assertEqual(rows[0]['task_end_time'], rows[1]['task_start_time'])
+
+    def test_next_step_waits_for_every_batch(self):
+        rows = self.schedule().rows
+        first = [row for row in rows if row['process_i'] == 1]
+        last = [row for row in rows if row['process_i'] == 4]
+        self.assertEqual(len(last), 2)
+        self.assertGreaterEqual(min(row['task_start_time'] for row in last),
+                                max(row['task_end_time'] for row in first))
+
+
+class EvaluatorTests(TestCase):
+    """局部改动的增量得分（propose）与完整解码（rebuild）一致"""
+
+    def setUp(self):
+        ops = []
+        for line in range(4):
+            for process_i in (1, 2):
+                for _ in range(2):
+                    ops.append(Operation(line, process_i, 10 + 5 * line, 'AB'[line % 2], (0, 1),
+                                         60 + 20 * line, 1.0 if process_i == 2 else 0.0))
+        self.plan = Plan(ops, list(range(len(ops))), [k % 2 for k in range(len(ops))], [15, 25], ['A', None],
+                         [0, 30], {3: 40}, 0)
+        self.random = random.Random(7)
+
+    def assertRebuilt(self, evaluator):
+        expected = PlanEvaluator(self.plan, evaluator.order, evaluator.assign, segment_size=evaluator.segment_size)
+        self.assertAlmostEqual(evaluator.score, expected.score)
+        self.assertEqual(evaluator.totals(), expected.totals())
+
+    def test_propose_matches_rebuild(self):
+        evaluator = PlanEvaluator(self.plan, segment_size=3)
+        n = len(evaluator.order)
+        for step in range(200):
+            i, j = sorted(self.random.sample(range(n), 2))
+            order, assign = list(evaluator.order), list(evaluator.assign)
+            evaluator.order[i], evaluator.order[j] = evaluator.order[j], evaluator.order[i]
+            k = evaluator.order[j]
+            evaluator.assign[k] = 1 - evaluator.assign[k]
+            score = evaluator.propose(i, j)
+            expected = PlanEvaluator(self.plan, evaluator.order, evaluator.assign, segment_size=3)
+            self.assertAlmostEqual(score, expected.score)
+            if step % 3:
+                evaluator.accept()
+                self.assertRebuilt(evaluator)
+            else:
+                evaluator.order[:], evaluator.assign[:] = order, assign
+                evaluator.reject()
+
+    def test_rejected_proposal_keeps_score(self):
+        evaluator = PlanEvaluator(self.plan, segment_size=3)
+        before = evaluator.score
+        evaluator.order[0], evaluator.order[-1] = evaluator.order[-1], evaluator.order[0]
+        evaluator.propose(0, len(evaluator.order) - 1)
+        evaluator.order[0], evaluator.order[-1] = evaluator.order[-1], evaluator.order[0]
+        evaluator.reject()
+        self.assertEqual(evaluator.score, before)
+        self.assertRebuilt(evaluator)
+
+
+class RawLedgerTests(TestCase):
+    """毛坯台账：期初库存、后续入库和缺料"""
+
+    def setUp(self):
+        self.origin = SHOP_CALENDAR.offset_of(SHOP_CALENDAR.day_start(date(2024, 1, 8)))
+        self.arrival = SHOP_CALENDAR.offset_of(SHOP_CALENDAR.day_start(date(2024, 1, 10)))
+        self.ledger = RawLedger([('R1', '2024-01-05', 10), ('R1', None, 5), ('R1', '2024-01-10', 20),
+                                 ('R2', 'not a date', 3)], self.origin)
+
+    def test_past_and_undated_receipts_are_opening_stock(self):
+        self.assertTrue(self.ledger.reserve('R1', 15, self.origin))
+        self.assertFalse(self.ledger.reserve('R1', 1, self.origin))
+        self.assertTrue(self.ledger.reserve('R2', 3, self.origin))
+
+    def test_failed_reservation_changes_nothing(self):
+        self.assertFalse(self.ledger.reserve('R1', 16, self.origin))
+        self.assertTrue(self.ledger.reserve('R1', 15, self.origin))
+
+    def test_future_receipt_arrives_at_first_shift(self):
+        self.assertEqual(self.ledger.next_available('R1', 30), self.arrival)
+        self.assertFalse(self.ledger.reserve('R1', 30, self.arrival - 1))
+        self.assertTrue(self.ledger.reserve('R1', 30, self.arrival))
+        self.assertTrue(self.ledger.reserve('R1', 5, self.arrival))
+        self.assertIsNone(self.ledger.next_available('R1', 1))
+
+    def test_shortage_counts_pending_receipts(self):
+        self.assertIsNone(self.ledger.next_available('R1', 36))
+        self.assertEqual(self.ledger.shortage('R1', 36), 1)
+        self.assertEqual(self.ledger.shortage('R1', 35), 0)
+
+    def test_untracked_raw_is_unconstrained(self):
+        self.assertFalse(self.ledger.tracks('R9'))
+        self.assertTrue(self.ledger.reserve('R9', 1000, self.origin))
+
+
+class ValidatorTests(TestCase):
+    """排产可行性检查：每种违规各一条"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Process.objects.create(product_code='P1', process_i=1, process_name='车', process_capacity=5)
+        Process.objects.create(product_code='P1', process_i=2, process_name='铣', process_capacity=5)
+        cls.first = create_task('D1', local_time(8), local_time(9))
+        cls.overlap = create_task('D1', local_time(8, 30), local_time(9, 30), order_code='O2')
+        cls.early = create_task('D2', local_time(8, 30), local_time(9), process_i=2)
+        cls.break_time = create_task('D2', local_time(11, 40), local_time(11, 50), order_code='O3')
+        cls.too_many = create_task('D2', local_time(13), local_time(14), order_code='O4', product_num=8)
+
+    def test_each_violation_is_reported(self):
+        report = validate_schedule()
+        self.assertEqual(set(report), set(VIOLATION_KINDS))
+        self.assertEqual([row['id'] for row in report['device_overlap']], [self.overlap.id])
+        self.assertEqual([(row['order_code'], row['process_i']) for row in report['precedence']], [('O1', 2)])
+        self.assertEqual([row['id'] for row in report['off_shift']], [self.break_time.id])
+        self.assertEqual([row['id'] for row in report['capacity']], [self.too_many.id])
+
+    def test_default_capacity_is_not_checked(self):
+        Process.objects.create(product_code='P2', process_i=1, process_name='车')
+        Process.objects.create(product_code='P3', process_i=1, process_name='车', process_capacity=None)
+        Task.objects.all().delete()
+        create_task('D1', local_time(8), local_time(9), product_code='P2', product_num=1)
+        create_task('D2', local_time(8), local_time(9), product_code='P3', product_num=3)
+        self.assertEqual(validate_schedule()['capacity'], [])
+
+    def test_feasible_schedule_passes(self):
+        Task.objects.exclude(id=self.first.id).delete()
+        create_task('D2', local_time(9), local_time(11, 30), process_i=2)
+        self.assertEqual(validate_schedule(), {kind: [] for kind in VIOLATION_KINDS})
+
+
+class DurationStatTests(TestCase):
+    """实际时长的在线统计：P² 分位数与 Welford 均值、方差"""
+
+    def setUp(self):
+        self.random = random.Random(3)
+
+    def test_p2_quantiles_track_the_sample(self):
+        samples = [self.random.uniform(0, 100) for _ in range(5000)]
+        cuts = statistics.quantiles(samples, n=10)
+        for p, exact in ((0.5, cuts[4]), (0.9, cuts[8])):
+            estimator = P2Quantile(p)
+            for x in samples:
+                estimator.add(x)
+            self.assertAlmostEqual(estimator.value(), exact, delta=2.0)
+
+    def test_p2_uses_the_samples_until_it_has_five(self):
+        estimator = P2Quantile(0.5)
+        self.assertIsNone(estimator.value())
+        for x in (30, 10, 20):
+            estimator.add(x)
+        self.assertEqual(estimator.value(), 20)
+
+    def test_welford_matches_batch_statistics(self):
+        samples = [self.random.gauss(60, 8) for _ in range(50)]
+        for minutes in samples:
+            stat = record_duration('P1', 1, 'D1', minutes)
+        stat = DurationStat.objects.get(id=stat.id)
+        self.assertEqual(stat.count, len(samples))
+        self.assertAlmostEqual(stat.mean, statistics.mean(samples))
+        self.assertAlmostEqual(stat.variance, statistics.variance(samples))
+
+    def test_stored_markers_resume_the_estimate(self):
+        samples = [self.random.uniform(20, 40) for _ in range(200)]
+        estimator = P2Quantile(0.9)
+        for minutes in samples:
+            record_duration('P1', 1, 'D1', minutes)
+            estimator.add(minutes)
+        learned = load_learned_durations('p90')
+        self.assertAlmostEqual(learned['P1', 1, 'D1'], estimator.value())
+
+    def test_too_few_samples_are_not_learned(self):
+        for _ in range(MIN_SAMPLES - 1):
+            record_duration('P1', 1, 'D1', 30.0)
+        self.assertEqual(load_learned_durations('mean'), {})
+
+    def test_completion_starts_after_the_previous_one_on_the_device(self):
+        Device.objects.create(device_name='D1')
+        first = create_task('D1', local_time(8), local_time(9))
+        second = create_task('D1', local_time(9), local_time(10), process_i=2)
+        self.assertEqual(record_completion(first, local_time(9, 30)).mean, 90.0)
+        # 第二个任务 9:30 才能开工，不是计划的 9:00
+        self.assertEqual(record_completion(second, local_time(10, 30)).mean, 60.0)
+
+    def test_overruns_are_not_recorded(self):
+        Device.objects.create(device_name='D1')
+        task = create_task('D1', local_time(8), local_time(9))
+        self.assertIsNone(record_completion(task, local_time(8, day=9)))
+        self.assertFalse(DurationStat.objects.exists())
+
+
+class ScheduleDiffTests(TestCase):
+    """存档的排产版本与当前 Task 表的差异"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.kept = create_task('D1', local_time(8), local_time(9))
+        cls.moved = create_task('D1', local_time(9), local_time(10), process_i=2)
+        cls.reassigned = create_task('D2', local_time(8), local_time(9), order_code='O2')
+        cls.removed = create_task('D2', local_time(9), local_time(10), order_code='O3')
+
+    def test_archive_is_skipped_for_an_empty_table(self):
+        Task.objects.all().delete()
+        self.assertIsNone(archive_schedule('publish'))
+
+    def test_only_recent_versions_are_kept(self):
+        versions = [archive_schedule('publish') for _ in range(VERSIONS_KEPT + 2)]
+        self.assertEqual(list(ScheduleVersion.objects.order_by('id').values_list('id', flat=True)),
+                         [version.id for version in versions[-VERSIONS_KEPT:]])
+        self.assertEqual(load_version(versions[-1]), current_schedule())
+
+    def test_changes_are_classified(self):
+        base = load_version(archive_schedule('publish'))
+        Task.objects.filter(id=self.moved.id).update(task_start_time=local_time(9, 30),
+                                                     task_end_time=local_time(10, 30))
+        Task.objects.filter(id=self.reassigned.id).update(device_name='D3')
+        Task.objects.filter(id=self.removed.id).delete()
+        create_task('D2', local_time(10), local_time(11), order_code='O4')
+
+        diff = diff_schedules(base, current_schedule())
+        self.assertEqual(diff['summary'], {
+            'base_tasks': 4, 'target_tasks': 4, 'unchanged': 1, 'moved': 1, 'reassigned': 1, 'added': 1,
+            'removed': 1, 'eta_changed': 3,
+        })
+        self.assertEqual(diff['moved'][0]['shift_minutes'], 30)
+        self.assertEqual((diff['reassigned'][0]['old']['device_name'], diff['reassigned'][0]['new']['device_name']),
+                         ('D2', 'D3'))
+        self.assertEqual(diff['added'][0]['order_code'], 'O4')
+        self.assertEqual(diff['removed'][0]['order_code'], 'O3')
+        self.assertEqual({item['order_code']: item['delta_minutes'] for item in diff['eta']},
+                         {'O1': 30, 'O3': None, 'O4': None})
+        self.assertEqual(diff['eta'][-1]['order_code'], 'O1')
+
+    def test_limit_truncates_details_only(self):
+        base = load_version(archive_schedule('publish'))
+        Task.objects.update(device_name='D9')
+        diff = diff_schedules(base, current_schedule(), limit=2)
+        self.assertEqual(diff['summary']['reassigned'], 4)
+        self.assertEqual(len(diff['reassigned']), 2)
+
+
+class MrpTests(TestCase):
+    """毛坯净需求：期初 10，三天后入库 20，三个未开工订单行依次需要 8、6、10"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.today = timezone.localdate()
+
+        def day(offset):
+            return cls.today + timedelta(days=offset)
+
+        Raw.objects.create(raw_code='R1', raw_name='圆钢', raw_date_add=day(-5).isoformat(), raw_num=10)
+        Raw.objects.create(raw_code='R1', raw_name='圆钢', raw_date_add=day(3).isoformat(), raw_num=20)
+        Product.objects.create(product_code='P1', raw_code='R1')
+        Product.objects.create(product_code='P2', raw_code='R2')
+
+        def line(order_code, start, product_code='P1', **fields):
+            order = Order.objects.create(order_code=order_code, order_start_date=day(start),
+                                         order_end_date=day(start + 5))
+            return OrderProduct.objects.create(order=order, product_code=product_code, **fields)
+
+        # 下单日期已过，按今天需要
+        cls.overdue = line('O1', -1, product_num_todo=8)
+        cls.later = line('O2', 2, product_num_todo=6)
+        # 已排产的订单行按最早任务的开工日期需要，数量扣掉已完成的
+        cls.scheduled = line('O3', 5, product_num_todo=12, product_num_done=2)
+        start = timezone.make_aware(datetime.combine(day(4), datetime.min.time()) + timedelta(hours=10))
+        create_task('D1', start, start + timedelta(hours=1), order_code='O3')
+        cls.untracked = line('O4', 0, product_code='P2', product_num_todo=5)
+        cls.started = line('O5', 0, product_num_todo=50, cur_process_i=1)
+
+    def test_projected_stock_and_shortage(self):
+        summary, = raw_summary(run_mrp())
+        self.assertEqual(summary['raw_code'], 'R1')
+        self.assertEqual((summary['on_hand'], summary['receipts'], summary['demand']), (10, 20, 24))
+        self.assertEqual(summary['remaining_quantity'], 6)
+        self.assertEqual(summary['shortage'], 4)
+        self.assertEqual(summary['shortage_date'], (self.today + timedelta(days=2)).isoformat())
+
+    def test_lines_are_netted_in_need_date_order(self):
+        lines = run_mrp().lines
+        self.assertEqual(lines.loc[self.overdue.id, 'need_date'].date(), self.today)
+        self.assertEqual(lines.loc[self.scheduled.id, 'need_date'].date(), self.today + timedelta(days=4))
+        self.assertEqual(lines.loc[self.scheduled.id, 'quantity'], 10)
+        self.assertEqual(lines.loc[[self.overdue.id, self.later.id, self.scheduled.id], 'remaining'].tolist(),
+                         [2, -4, 6])
+
+    def test_untracked_and_started_lines_are_left_out(self):
+        lines = run_mrp().lines
+        self.assertTrue(lines['remaining'].isna()[self.untracked.id])
+        self.assertNotIn(self.started.id, lines.index)
+
+
+class KeysetPaginationTests(TestCase):
+    """键集分页：可为空的键（订单的下单日期）排在最前，前后翻页与完整排序一致"""
+
+    KEYS = ('order__order_start_date', 'id')
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(11):
+            # 每三个订单一个没有下单日期，其余几个订单共用同一天
+            order = Order.objects.create(order_code=f'O{i}',
+                                         order_start_date=None if i % 3 == 0 else date(2024, 1, 1 + i % 4))
+            OrderProduct.objects.create(order=order, product_code='P1')
+            OrderProduct.objects.create(order=order, product_code='P2')
+        cls.expected = list(OrderProduct.objects.order_by(
+            F('order__order_start_date').asc(nulls_first=True), 'id').values_list('id', flat=True))
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def page(self, query='?mode=keyset'):
+        return keyset_page(self.factory.get('/orders/' + query), OrderProduct.objects.all(), self.KEYS, 4)
+
+    def ids(self, page):
+        return [line.id for line in page]
+
+    def test_forward_walk_matches_full_ordering(self):
+        page = self.page()
+        self.assertFalse(page.has_previous)
+        seen = self.ids(page)
+        while page.has_next:
+            page = self.page(page.next_url)
+            self.assertTrue(page.has_previous)
+            seen += self.ids(page)
+        self.assertEqual(seen, self.expected)
+
+    def test_backward_walk_matches_full_ordering(self):
+        page = self.page()
+        while page.has_next:
+            page = self.page(page.next_url)
+        seen = self.ids(page)
+        while page.has_previous:
+            page = self.page(page.previous_url)
+            self.assertTrue(page.has_next)
+            seen = self.ids(page) + seen
+        self.assertEqual(seen, self.expected)
+
+    def test_invalid_cursor_starts_over(self):
+        self.assertEqual(self.ids(self.page('?cursor=not-a-cursor')), self.expected[:4])
+
+    def test_offset_pages_use_the_same_ordering(self):
+        request = self.factory.get('/orders/', {'page': 2})
+        page = paginate(request, OrderProduct.objects.all(), self.KEYS, 4)
+        self.assertNotIsInstance(page, KeysetPage)
+        self.assertEqual(self.ids(page), self.expected[4:8])
+        keyset = paginate(self.factory.get('/orders/', {'mode': 'keyset'}), OrderProduct.objects.all(), self.KEYS, 4)
+        self.assertIsInstance(keyset, KeysetPage)
+        self.assertEqual(keyset.approximate_count, len(self.expected))
+
+
+class OptimizerPlanTests(TestCase):
+    """限时优化的初始解：与贪心排产同一份快照和时长，冻结的任务不动"""
+
+    @classmethod
+    def setUpTestData(cls):
+        # D1 上午 10 点前还在做别的活
+        Device.objects.create(device_name='D1', changeover_time='0', end_time=local_time(10))
+        Device.objects.create(device_name='D2', changeover_time='0')
+        Process.objects.create(product_code='P1', process_i=1, process_name='车', process_duration=60,
+                               process_capacity=5, device_name='D1/D2')
+        Process.objects.create(product_code='P1', process_i=2, process_name='铣', process_duration=30,
+                               process_capacity=5, device_name='D2')
+        for code in ('O1', 'O2', 'O3'):
+            order = Order.objects.create(order_code=code, order_end_date=date(2024, 1, 20))
+            OrderProduct.objects.create(order=order, product_code='P1', product_num_todo=5)
+        # 学到 D1 上车削要 90 分钟
+        for _ in range(MIN_SAMPLES):
+            record_duration('P1', 1, 'D1', 90.0)
+
+    def publish(self, durations):
+        publish_schedule(run_schedule(load_snapshot(durations=durations), START_DATE).rows)
+        return SHOP_CALENDAR.day_start(START_DATE)
+
+    def assertReproducesGreedy(self, durations):
+        start = self.publish(durations)
+        # 开班前取计划，没有任务已开工
+        plan, task_ids, _ = load_plan(start, now=start - timedelta(minutes=1), durations=durations)
+        record = PlanEvaluator(plan).schedule()
+        tasks = Task.objects.in_bulk(task_ids)
+        self.assertEqual(len(task_ids), Task.objects.count())
+        self.assertEqual([(record[k][0], record[k][1]) for k in range(len(task_ids))],
+                         [(SHOP_CALENDAR.offset_of(tasks[i].task_start_time),
+                           SHOP_CALENDAR.offset_of(tasks[i].task_end_time)) for i in task_ids])
+        return plan
+
+    def test_initial_plan_reproduces_greedy_schedule(self):
+        plan = self.assertReproducesGreedy('static')
+        self.assertEqual(plan.device_free[0], SHOP_CALENDAR.offset_of(local_time(10)))
+
+    def test_learned_durations_are_used(self):
+        plan = self.assertReproducesGreedy('mean')
+        self.assertTrue(any(op.durations == {0: 90.0} for op in plan.ops))
+
+    def test_started_tasks_stay_fixed(self):
+        start = self.publish('static')
+        done = Task.objects.order_by('task_start_time', 'id').first()
+        Task.objects.filter(id=done.id).update(completed=True)
+        plan, task_ids, device_names = load_plan(start, now=start - timedelta(minutes=1), durations='static')
+        self.assertNotIn(done.id, task_ids)
+
+        # 把所有工序都挪到 D2 上
+        evaluator = PlanEvaluator(plan, assign=[1] * len(plan.ops))
+        save_plan(evaluator, task_ids, device_names)
+        kept = Task.objects.get(id=done.id)
+        self.assertEqual((kept.task_start_time, kept.task_end_time, kept.device_name),
+                         (done.task_start_time, done.task_end_time, done.device_name))
+        self.assertEqual(Task.objects.count(), len(task_ids) + 1)
+        self.assertEqual(set(Task.objects.filter(id__in=task_ids).values_list('device_name', flat=True)), {'D2'})
+
+
+class RelationTests(TestCase):
+    """按编码解析的外键：目标改编码后重新关联，批量导入时统一解析"""
+
+    def test_code_change_relinks_rows(self):
+        old = Product.objects.create(product_code='P1')
+        process = Process.objects.create(product_code='P1', process_i=1, process_name='车')
+        self.assertEqual(Process.objects.get(id=process.id).product_id, old.id)
+
+        old.product_code = 'P9'
+        old.save()
+        self.assertIsNone(Process.objects.get(id=process.id).product_id)
+
+        new = Product.objects.create(product_code='P1')
+        self.assertEqual(Process.objects.get(id=process.id).product_id, new.id)
+
+        # 行自己改编码也重新解析
+        process.product_code = 'P9'
+        process.save()
+        self.assertEqual(Process.objects.get(id=process.id).product_id, old.id)
+
+    def test_batch_resolves_once_at_the_end(self):
+        with batch_resolution():
+            Process.objects.create(product_code='P1', process_i=1, process_name='车')
+            with CaptureQueriesContext(connection) as queries:
+                product = Product.objects.create(product_code='P1', raw_code='R1')
+            # 块内保存不查目标、不更新引用它的行
+            self.assertFalse([q['sql'] for q in queries if 'home_raw' in q['sql'] or 'home_process' in q['sql']])
+            self.assertIsNone(Process.objects.get().product_id)
+            raw = Raw.objects.create(raw_code='R1')
+        self.assertEqual(Process.objects.get().product_id, product.id)
+        self.assertEqual(Product.objects.get().raw_id, raw.id)
+
+
+class ScenarioTests(TestCase):
+    """多方案排产：不同开始日期的方案在同一批订单行上比较"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Device.objects.create(device_name='D1', changeover_time='0')
+        Process.objects.create(product_code='P1', process_i=1, process_name='车', process_duration=60,
+                               process_capacity=5, device_name='D1')
+        for code, start in (('O1', date(2024, 1, 5)), ('O2', date(2024, 1, 9))):
+            order = Order.objects.create(order_code=code, order_start_date=start, order_end_date=date(2024, 1, 20))
+            OrderProduct.objects.create(order=order, product_code='P1', product_num_todo=5)
+
+    def test_lines_left_out_are_penalised(self):
+        early = Scenario('edd', timezone.make_aware(datetime(2024, 1, 8)))
+        late = Scenario('edd', timezone.make_aware(datetime(2024, 1, 9)))
+        results = run_scenarios([early, late], workers=1, publish=False)
+        # 1 月 8 日开始的方案排不到 O2
+        self.assertEqual([(r['scenario'], r['planned'], r['missing']) for r in results], [(late, 2, 0), (early, 1, 1)])
+        self.assertEqual(results[1]['score'], kpi_score(results[1]['kpis'], missing=1))
+        self.assertGreaterEqual(results[1]['score'], UNSCHEDULED_PENALTY_MINUTES)
+
+
+class LRUCacheTests(TestCase):
+    """日历缓存由请求线程共用"""
+
+    def test_concurrent_access_with_evictions(self):
+        cache = LRUCache(maxsize=8)
+        errors = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(5000):
+                    key = rng.randrange(32)
+                    self.assertEqual(cache.get(key, lambda: key * 2), key * 2)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        info = cache.info()
+        self.assertEqual((info['hits'] + info['misses'], info['size']), (8 * 5000, 8))
+
+
+class RescheduleTests(TestCase):
+    """当天重排：冻结已开工的任务，只改动有变化的行"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Device.objects.create(device_name='D1', changeover_time='0')
+        Raw.objects.create(raw_code='R1', raw_num=10)
+        Product.objects.create(product_code='P1', raw_code='R1')
+        Process.objects.create(product_code='P1', process_i=1, process_name='车', process_duration=60,
+                               process_capacity=5, device_name='D1')
+        Process.objects.create(product_code='P1', process_i=2, process_name='铣', process_duration=30,
+                               process_capacity=5, device_name='D1')
+        order = Order.objects.create(order_code='O1', order_start_date=date(2024, 1, 1),
+                                     order_end_date=date(2024, 2, 1))
+        OrderProduct.objects.create(order=order, product_code='P1', product_num_todo=10)
+
+    def setUp(self):
+        # 车 7:30-8:30、8:30-9:30，铣 9:30-10:00、10:00-10:30
+        publish_schedule(run_schedule(load_snapshot(), START_DATE).rows)
+        self.tasks = list(Task.objects.order_by('task_start_time'))
+
+    def test_started_tasks_are_frozen(self):
+        first = self.tasks[0]
+        snapshot, frozen, movable = freeze(load_snapshot(), self.tasks, local_time(8))
+        self.assertEqual([task.id for task in frozen], [first.id])
+        self.assertEqual({task.id for task in movable}, {task.id for task in self.tasks[1:]})
+        self.assertEqual(snapshot.devices[0].end_time, first.task_end_time)
+        # 第一道工序冻结了一半，剩下的一批还从第一道工序排
+        line = snapshot.lines[0]
+        self.assertEqual((line.cur_process_i, line.started), (0, 5))
+        self.assertIn(('R1', None, -5), snapshot.receipts)
+
+    def test_unchanged_plan_writes_nothing(self):
+        _, changes = reschedule(now=local_time(8))
+        self.assertEqual(changes, {'frozen': 1, 'updated': 0, 'created': 0, 'deleted': 0, 'unchanged': 3})
+        self.assertFalse(ScheduleVersion.objects.exists())
+
+    def test_shifted_rows_are_updated_in_place(self):
+        # D1 上插进了别的活，9:00 前不可用
+        Device.objects.filter(device_name='D1').update(end_time=local_time(9))
+        _, changes = reschedule(now=local_time(8))
+        self.assertEqual((changes['updated'], changes['created'], changes['deleted']), (3, 0, 0))
+        after = list(Task.objects.order_by('task_start_time'))
+        self.assertEqual([task.id for task in after], [task.id for task in self.tasks])
+        self.assertEqual(after[0].task_start_time, self.tasks[0].task_start_time)
+        self.assertEqual([task.task_start_time for task in after[1:]],
+                         [local_time(9), local_time(10), local_time(10, 30)])
+
+    def test_frozen_batch_raw_is_counted_once(self):
+        # 冻结的一批用掉 5 件，剩下的 5 件刚好够
+        result, _ = reschedule(now=local_time(8))
+        self.assertEqual(result.raw_shortage, {})
+        self.assertEqual(Task.objects.count(), 4)
+
+        Raw.objects.update(raw_num=9)
+        result, _ = reschedule(now=local_time(8))
+        self.assertEqual(result.raw_shortage, {'R1': 1})
+
+
+class UrgentInsertTests(TestCase):
+    """紧急插单：同设备上的任务顺延，其他设备上的后续工序跟着顺延"""
+
+    def setUp(self):
+        Device.objects.create(device_name='D1')
+        Device.objects.create(device_name='D2')
+        self.running = create_task('D1', local_time(10), local_time(11), order_code='O1')
+        self.before_break = create_task('D1', local_time(11), local_time(11, 30), order_code='O2', product_code='P2')
+        self.downstream = create_task('D2', local_time(12), local_time(13), order_code='O2', product_code='P2',
+                                      process_i=2)
+        self.other = create_task('D2', local_time(11), local_time(11, 30), order_code='O1', process_i=2)
+
+    def test_insert_across_the_break_keeps_precedence(self):
+        task, shifted = insert_urgent_task('D1', local_time(10, 30), 60, order_code='U1', product_code='P9',
+                                           process_i=1, product_num=1)
+        # 10:30 正在加工的任务不打断；11:00 开始做 30 分钟，午休后 12:00 再做 30 分钟
+        self.assertEqual((task.task_start_time, task.task_end_time), (local_time(11), local_time(12, 30)))
+        self.assertEqual(shifted, 2)
+
+        tasks = Task.objects.in_bulk()
+        self.assertEqual(tasks[self.running.id].task_start_time, local_time(10))
+        self.assertEqual((tasks[self.before_break.id].task_start_time, tasks[self.before_break.id].task_end_time),
+                         (local_time(12, 30), local_time(13)))
+        self.assertEqual((tasks[self.downstream.id].task_start_time, tasks[self.downstream.id].task_end_time),
+                         (local_time(13), local_time(14)))
+        self.assertEqual(tasks[self.other.id].task_start_time, local_time(11))
+        self.assertEqual(validate_schedule(), {kind: [] for kind in VIOLATION_KINDS})
+
+
+class SingleFlightTests(TestCase):
+    """排产单飞锁：同参数共用结果，不同参数拒绝，超时的锁可以接管"""
+
+    params = {'action': 'schedule', 'fast': True}
+
+    def running(self, params, started_at=None, status=ScheduleRun.RUNNING):
+        return ScheduleRun.objects.create(lock=LOCK_NAME, params=json.dumps(params, sort_keys=True, default=str),
+                                          status=status, started_at=started_at or timezone.now())
+
+    def fail(self):
+        raise AssertionError('should not run')
+
+    def test_same_params_attach_to_the_running_one(self):
+        # 正在运行的那次刚好写完结果
+        other = self.running(self.params, status=ScheduleRun.DONE)
+        run, attached = single_flight(self.params, self.fail)
+        self.assertTrue(attached)
+        self.assertEqual(run.id, other.id)
+
+    def test_different_params_are_busy(self):
+        other = self.running(self.params)
+        with self.assertRaises(ScheduleBusy) as busy:
+            single_flight(dict(self.params, fast=False), self.fail)
+        self.assertEqual(busy.exception.run.id, other.id)
+
+    def test_stale_lock_is_taken_over(self):
+        stale = self.running(self.params, started_at=timezone.now() - STALE_AFTER - timedelta(minutes=1))
+        run, attached = single_flight(self.params, lambda: 'ok', summarise=lambda result: {'result': result})
+        self.assertFalse(attached)
+        self.assertEqual((run.status, run.lock, json.loads(run.summary)), (ScheduleRun.DONE, None, {'result': 'ok'}))
+        stale.refresh_from_db()
+        self.assertEqual((stale.status, stale.lock), (ScheduleRun.FAILED, None))
+
+    def test_taken_over_run_keeps_failed(self):
+        def taken_over():
+            # 运行期间被其他请求当作超时接管，锁已归新的运行
+            ScheduleRun.objects.filter(lock=LOCK_NAME).update(lock=None, status=ScheduleRun.FAILED, summary='stale')
+            self.newer = self.running({'action': 'other'})
+
+        run, _ = single_flight(self.params, taken_over)
+        self.assertEqual((run.status, run.summary), (ScheduleRun.FAILED, 'stale'))
+        self.newer.refresh_from_db()
+        self.assertEqual((self.newer.status, self.newer.lock), (ScheduleRun.RUNNING, LOCK_NAME))
+
+
+class KpiTests(TestCase):
+    """排产指标：都按车间日历的工作分钟计"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Device.objects.create(device_name='D1', changeover_time='10')
+        Device.objects.create(device_name='D2', changeover_time='20')
+        Order.objects.create(order_code='O1', order_end_date=date(2024, 1, 10))
+        Order.objects.create(order_code='O2', order_end_date=date(2024, 1, 7))
+        Task.objects.create(device_name='D1', task_start_time=local_time(7, 30), task_end_time=local_time(8, 30),
+                            order_code='O1', product_code='P1', process_i=1, is_changeover='1')
+        create_task('D2', local_time(8, 30), local_time(9, 30), process_i=2)
+        # 跨午休：11:00-11:30 和 12:00-13:00 共 90 工作分钟
+        create_task('D1', local_time(11), local_time(13), order_code='O2', product_code='P2')
+
+    def test_kpis(self):
+        kpis = schedule_kpis()
+        self.assertEqual(kpis['task_count'], 3)
+        self.assertEqual(kpis['makespan_minutes'], 300)
+        self.assertEqual((kpis['changeover_count'], kpis['changeover_minutes']), (1, 10.0))
+        self.assertEqual(kpis['device_utilisation'], {'D1': 0.5, 'D2': 0.2})
+        # O2 1 月 7 日交货：夜班 0:00-2:00、早班和午后的 60 分钟
+        self.assertEqual(kpis['order_tardiness'], {'O2': 420.0})
+        self.assertEqual((kpis['late_orders'], kpis['total_tardiness_minutes']), (1, 420.0))
+        self.assertEqual(kpis['wip_times'][0], '01-08 07:00')
+        self.assertEqual(kpis['wip_counts'], [0, 1, 1, 0, 1, 1, 0])
+
+    def test_long_spans_are_bucketed_by_day(self):
+        create_task('D2', local_time(8, day=1), local_time(9, day=1), order_code='O3')
+        # 按分钟取点会超过 MAX_WIP_POINTS，改为按天
+        kpis = schedule_kpis(wip_step=1)
+        self.assertLessEqual(len(kpis['wip_counts']), MAX_WIP_POINTS)
+        self.assertEqual(kpis['wip_times'][:2], ['2024-01-01', '2024-01-02'])
+
+    def test_empty_schedule(self):
+        Task.objects.all().delete()
+        self.assertEqual(schedule_kpis()['task_count'], 0)
+
+
+class DashboardDirtyTests(TestCase):
+    """数据表变化时只有依赖它的看板部分过期"""
+
+    def setUp(self):
+        self.task = create_task('D1', local_time(8), local_time(9))
+        refresh_dashboard(['counts', 'kpis'])
+
+    def dirty(self):
+        return set(DashboardAggregate.objects.filter(dirty=True).values_list('name', flat=True))
+
+    def test_progress_saves_keep_the_dashboard(self):
+        self.task.completed = True
+        self.task.product_num_completed = 5
+        self.task.save(update_fields=['completed', 'product_num_completed'])
+        self.assertEqual(self.dirty(), set())
+
+    def test_schedule_changes_mark_kpis(self):
+        self.task.task_end_time = local_time(10)
+        self.task.save()
+        self.assertEqual(self.dirty(), {'kpis'})
+
+    def test_other_tables_mark_their_sections(self):
+        Product.objects.create(product_code='P1')
+        self.assertEqual(self.dirty(), {'counts'})
+
+    def test_device_users_mark_device_sections(self):
+        device = Device.objects.create(device_name='D1')
+        refresh_dashboard(['counts', 'kpis'])
+        device.operators.add(CustomUser.objects.create(username='operator'))
+        self.assertEqual(self.dirty(), {'counts', 'kpis'})
+
+
+class OrderEtaTests(TestCase):
+    """订单预计完工：发布时整表重算，订单保存时局部刷新，跨天后重算"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Order.objects.create(order_code='O1', order_end_date=date(2024, 1, 10))
+        Order.objects.create(order_code='O2', order_end_date=date(2024, 1, 7))
+        Order.objects.create(order_code='O3', order_end_date=date(2024, 1, 5))
+        Order.objects.create(order_code='O4', order_end_date=date(2024, 1, 5), is_done=True)
+        create_task('D1', local_time(8), local_time(9), order_code='O1')
+        create_task('D1', local_time(9), local_time(13), order_code='O1', process_i=2)
+        create_task('D1', local_time(13), local_time(14), order_code='O2')
+
+    def etas(self):
+        return {eta.order_code: (eta.estimated_delivery, eta.is_late) for eta in OrderEta.objects.all()}
+
+    def test_refresh(self):
+        self.assertEqual(refresh_order_etas(), 4)
+        self.assertEqual(self.etas(), {
+            'O1': (local_time(13), False),
+            'O2': (local_time(14), True),
+            # 还没排上：未完成且交货日期已过的记为延期
+            'O3': (None, True),
+            'O4': (None, False),
+        })
+
+    def test_order_save_refreshes_its_row(self):
+        refresh_order_etas()
+        order = Order.objects.get(order_code='O1')
+        order.order_end_date = date(2024, 1, 7)
+        order.save()
+        self.assertEqual(self.etas()['O1'], (local_time(13), True))
+        self.assertEqual(OrderEta.objects.get(order_code='O1').end_date, date(2024, 1, 7))
+
+    def test_stale_rows_are_recomputed(self):
+        refresh_order_etas()
+        OrderEta.objects.update(computed_on=date(2024, 1, 1))
+        etas = order_etas()
+        self.assertEqual(len(etas), 4)
+        self.assertEqual({eta.computed_on for eta in etas}, {timezone.localdate()})
+
+    def test_no_orders_refresh_once_a_day(self):
+        Order.objects.all().delete()
+        self.assertEqual(order_etas(), [])
+        # 今天已经整表算过，表为空也不再重算
+        with self.assertNumQueries(2):
+            self.assertEqual(order_etas(), [])
@@ -16,10 +16,12 @@ urlpatterns = [
     path("logout/", LogoutView.as_view(), name="logout"),
 
     path('', views.index, name='home'),
+    path('device_load/', views.device_load_view, name='device_load'),
 
     path('upload', views.upload, name='upload'),
 
     path('orders/', views.order_list, name='order_list'),
+    path('orders/eta/', views.order_eta_list, name='order_eta_list'),
 
     path('device/', device_list, name='device_list'),
     path('device/<int:device_id>/get/', views.get_device, name='get_device'),
@@ -32,6 +34,7 @@ urlpatterns = [
     path('products/<int:product_id>/delete/', views.delete_product, name='delete_product'),
 
     path('raws/', views.raw_list, name='raw_list'),
+    path('raws/requirements/', views.raw_requirements, name='raw_requirements'),
     path('raws/<int:pk>/get/', views.raw_get, name='raw_get'),
     path('raws/<int:pk>/update/', views.raw_update, name='raw_update'),
     path('raws/<int:pk>/delete/', views.raw_delete, name='raw_delete'),
@@ -39,6 +42,9 @@ urlpatterns = [
     path('results/', views.result_list, name='result_list'),
     path('results/process_schedule_fast/', views.process_schedule_fast, name='process_orders_fast'),
     path('results/process_schedule/', views.process_schedule, name='process_orders'),
+    path('results/process_schedule_scenarios/', views.process_schedule_scenarios, name='process_orders_scenarios'),
+    path('results/process_reschedule/', views.process_reschedule, name='process_reschedule'),
+    path('results/diff/', views.schedule_diff, name='schedule_diff'),
     path('get_progress/', views.get_progress, name='get_progress'),
 
     path('users/', views.user_list_list, name='user_list_list'),
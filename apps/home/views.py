@@ -3,9 +3,11 @@
 Copyright (c) 2019 - present AppSeed.us
 """
 import csv
+import json
 import logging
+import math
 import os
-from datetime import datetime, time, timedelta
+from datetime import datetime, timedelta
 from io import BytesIO
 from itertools import groupby
 import pandas as pd
@@ -17,7 +19,7 @@ from django.contrib.auth.hashers import make_password
 from django.core.exceptions import ValidationError
 from django.core.files.storage import FileSystemStorage
 from django.core.paginator import Paginator
-from django.db.models import Q
+from django.db.models import OuterRef, Q, Subquery
 from django.db.models import Sum
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
@@ -27,7 +29,7 @@ from django.shortcuts import render
 from django.template import loader
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.dateparse import parse_date
+from django.utils.dateparse import parse_date, parse_datetime
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_http_methods
@@ -39,12 +41,21 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Spacer, PageBreak
 
+from .arrange.durations import record_completion
+from .arrange.runs import ScheduleBusy, schedule_summary, single_flight
+from .arrange.shop_calendar import SHOP_CALENDAR
+from .arrange.timeline import insert_urgent_task
+from .common.dates import to_date
+from .common.pagination import keyset_page, keyset_requested, paginate
 from .forms import CustomUserChangeForm, ProcessForm
 from .models import CustomUser
 from .models import Order, OrderProduct
 from .models import Process, Raw, Product
 from .models import Task, Device
-from .models import Weight
+from .models import ScheduleRun, ScheduleVersion, Weight
+from .reports.dashboard import dashboard_data, mark_dirty, mrp_plan
+from .reports.device_load import device_load, load_window
+from .reports.eta import order_etas, refresh_order_etas
 from .preprocess import preprocess_order, preprocess_product, preprocess_process, preprocess_device, preprocess_raw
 from .views_login import login_view, register_user
 
@@ -56,6 +67,9 @@ logger = logging.getLogger(__name__)
 font_path = 'apps/static/assets/fonts/SourceHanSansCN-Medium.ttf'
 pdfmetrics.registerFont(TTFont('SourceHanSansCN', font_path))
 
+# 报工、检验只改这些列，按 update_fields 保存，不使看板过期（见 reports/dashboard.py 的 TASK_SOURCE_FIELDS）
+TASK_PROGRESS_FIELDS = ['completed', 'inspected', 'product_num_completed', 'product_num_inspected']
+
 
 @login_required(login_url="/login/")
 def user_list_list(request):
@@ -133,293 +147,73 @@ def user_list_create(request):
 
 @login_required(login_url="/login/")
 def index(request):
-    from collections import Counter
-    # 获取各个模型的数量
-    orders_count = Order.objects.count()
-    products_count = Product.objects.count()
-    raw_count = Raw.objects.count()
-    exchange_count = Device.objects.count()
-    process_count = Process.objects.count()
-
-    # 获取最新的 weight 数据
-    # weight = Weight.objects.latest('id').weight
-
-    # 统计订单的开始日期和交付日期
-    orders = Order.objects.all()
-
-    start_date_counts = Counter()
-    end_date_counts = Counter()
-
-    for order in orders:
-        start_date = parse_date(order.order_start_date)
-        end_date = parse_date(order.order_end_date)
-
-        if start_date:
-            start_date_counts[start_date] += 1
-        if end_date:
-            end_date_counts[end_date] += 1
-
-    # 准备数据用于传递给模板
-    start_dates = list(start_date_counts.keys())
-    start_date_counts_list = list(start_date_counts.values())
-    end_dates = list(end_date_counts.keys())
-    end_date_counts_list = list(end_date_counts.values())
-
-    # 设定日期和工作时间范围
-    selected_date = timezone.make_aware(datetime(2024, 1, 10))
-    morning_start_time = timezone.make_aware(datetime.combine(selected_date, time(9, 0, 0)))
-    morning_end_time = timezone.make_aware(datetime.combine(selected_date, time(12, 0, 0)))
-    afternoon_start_time = timezone.make_aware(datetime.combine(selected_date, time(13, 0, 0)))
-    afternoon_end_time = timezone.make_aware(datetime.combine(selected_date, time(18, 0, 0)))
-
-    # 计算工作总时长
-    morning_duration = (morning_end_time - morning_start_time).total_seconds()
-    afternoon_duration = (afternoon_end_time - afternoon_start_time).total_seconds()
-    total_work_duration = morning_duration + afternoon_duration
-
-    # 订单重量信息
-    # 获取所有订单
-    orders = Order.objects.all()
-
-    # 创建一个字典来存储每个月的总重量
-    monthly_weights = {}
-
-    for order in orders:
-        # 解析订单的开始日期
-        order_date = datetime.strptime(order.order_start_date, '%Y-%m-%d')
-        month_str = order_date.strftime('%Y-%m')  # 获取订单的年月
-
-        # 初始化该月份的重量为0
-        if month_str not in monthly_weights:
-            monthly_weights[month_str] = 0
-
-        # 获取该订单的所有 OrderProduct 记录
-        order_products = OrderProduct.objects.filter(order=order)
-
-        # 计算该订单的总重量
-        order_weight = 0
-        for order_product in order_products:
-            # 初始化 raw_weight 为 0
-            raw_weight = 0
-
-            try:
-                product = Product.objects.get(product_code=order_product.product_code)
-            except Product.DoesNotExist:
-                # 如果产品未找到，则重量为 0 并继续下一个产品的处理
-                logger.error(f"Product with code {order_product.product_code} does not exist.")
-                continue
-
-            try:
-                raw_code = product.raw_code
-                raw = Raw.objects.get(raw_code=raw_code)
-                raw_weight = raw.raw_weight
-            except Raw.DoesNotExist:
-                # 如果原材料未找到，则重量为 0
-                logger.error(f"Raw with code {raw_code} does not exist.")
-                # 可以在这里选择是否继续处理其他产品或中断循环
-
-            # 计算该产品的总重量并累加
-            order_weight += round(float(raw_weight) * int(order_product.product_num_todo), 2)
-
-        # 累加到该月的总重量
-        monthly_weights[month_str] += round(order_weight, 2)
-
-    # 将结果转换为按月份排序的列表
-    months = sorted(monthly_weights.keys())
-    weights = [round(monthly_weights[month], 2) for month in months]
-
-    # 设备负载信息
-    devices = Device.objects.all()
-    device_details = []
-
-    for device in devices:
-        # 过滤出指定日期和工作时间范围内的任务
-        tasks = Task.objects.filter(
-            device_name=device.device_name,
-            task_start_time__gte=morning_start_time,
-            task_end_time__lte=afternoon_end_time
-        )
-
-        total_task_time = 0
-
-        for task in tasks:
-            # 计算每个任务的有效工作时间（考虑分段工作时间）
-            task_start = max(task.task_start_time, morning_start_time)
-            task_end = min(task.task_end_time, afternoon_end_time)
-
-            if task_start < morning_end_time:
-                morning_task_time = min(task_end, morning_end_time) - task_start
-            else:
-                morning_task_time = timedelta(0)
-
-            if task_end > afternoon_start_time:
-                afternoon_task_time = task_end - max(task_start, afternoon_start_time)
-            else:
-                afternoon_task_time = timedelta(0)
-
-            total_task_time += morning_task_time.total_seconds() + afternoon_task_time.total_seconds()
-
-        # 计算设备负载情况
-        load_percentage = (total_task_time / total_work_duration) * 100 if total_work_duration > 0 else 0
-
-        device_details.append({
-            'device_name': device.device_name,
-            'operator': device.operators.first().username if device.operators.exists() else 'N/A',
-            'inspector': device.inspectors.first().username if device.inspectors.exists() else 'N/A',
-            'load_percentage': load_percentage
-        })
-
-    # 获取当前日期
-    current_date = timezone.now().date()
-
-    # 获取两周后的日期
-    two_weeks_later = current_date + timedelta(weeks=2)
-
-    # 查询所有交付日期在两周之内的订单
-    orders = Order.objects.filter(
-        order_end_date__gte=current_date,
-        order_end_date__lte=two_weeks_later
-    )
-
-    # 获取所有订单
-    orders = Order.objects.all()
-
-    # 存储订单详情
-    order_details_combined = []
-
-    for order in orders:
-        end_date = datetime.strptime(order.order_end_date, '%Y-%m-%d').date()
-        remaining_days = (end_date - current_date).days
-
-        # 查找该订单的所有 task，按 task_end_time 排序并获取最后一个 task
-        tasks = Task.objects.filter(order_code=order.order_code).order_by('-task_end_time')
-
-        if tasks.exists():
-            estimated_delivery_date = tasks.first().task_end_time
-        else:
-            estimated_delivery_date = None
-
-        # 将订单详情添加到列表中
-        order_details_combined.append({
-            'order_code': order.order_code,
-            'end_date': order.order_end_date,
-            'remaining_days': remaining_days,
-            'estimated_delivery_date': estimated_delivery_date,
-        })
-
-    # 按剩余天数从低到高排序
-    order_details_combined.sort(key=lambda x: x['remaining_days'])
-
-    # 统计每个毛坯编码的总数量
-    raw_quantities = Raw.objects.values('raw_code', 'raw_name').annotate(total_quantity=Sum('raw_num'))
-
-    # 统计所有 process_i 为 1 的任务中对应毛坯的消耗数量
-    task_consumptions = Task.objects.filter(process_i=1).values('product_code').annotate(
-        total_consumption=Sum('product_num')
+    # 看板数据来自汇总表，只有过期的部分才会重算（见 reports/dashboard.py）
+    data = dashboard_data()
+    context = dict(
+        data,
+        segment='index',
+        weight=10,
+        remaining_quantities=data['remaining_quantities'][:29],
     )
 
-    # 创建一个字典来存储每个 raw_code 的消耗数量
-    consumption_dict = {}
-
-    for task in task_consumptions:
-        # 获取对应的产品
-        product_code = task['product_code']
-        product = Product.objects.filter(product_code=product_code).first()
-        if product and product.raw_code:
-            # 将产品的消耗数量加到对应的 raw_code 上
-            raw_code = product.raw_code
-            if raw_code in consumption_dict:
-                consumption_dict[raw_code] += task['total_consumption']
-            else:
-                consumption_dict[raw_code] = task['total_consumption']
-
-    # 计算剩余数量并排序
-    remaining_quantities = []
-    for raw in raw_quantities:
-        raw_code = raw['raw_code']
-        raw_name = raw['raw_name']
-        total_quantity = raw['total_quantity']
-        consumed_quantity = consumption_dict.get(raw_code, 0)
-        remaining_quantity = total_quantity - consumed_quantity
-
-        remaining_quantities.append({
-            'raw_code': raw_code,
-            'raw_name': raw_name,
-            'remaining_quantity': remaining_quantity
-        })
-
-    # 按剩余数量从低到高排序
-    remaining_quantities.sort(key=lambda x: x['remaining_quantity'])
-
-    # 统计每个毛坯编码的总数量
-    raw_quantities = Raw.objects.values('raw_code', 'raw_name').annotate(total_quantity=Sum('raw_num'))
-
-    # 统计所有 process_i 为 1 的任务中对应毛坯的消耗数量
-    task_consumptions = Task.objects.filter(process_i=1).values('product_code').annotate(
-        total_consumption=Sum('product_num')
-    )
-
-    # 创建一个字典来存储每个 raw_code 的消耗数量
-    consumption_dict = defaultdict(int)
-
-    for task in task_consumptions:
-        # 获取对应的产品
-        product_code = task['product_code']
-        product = Product.objects.filter(product_code=product_code).first()
-        if product and product.raw_code:
-            # 将产品的消耗数量加到对应的 raw_code 上
-            raw_code = product.raw_code
-            consumption_dict[raw_code] += task['total_consumption']
-
-    # 创建一个字典来存储每个 raw_code 的订单总需求数量
-    order需求_dict = defaultdict(int)
-
-    # 遍历所有订单产品，累加每个毛坯的需求数量
-    for order_product in OrderProduct.objects.all():
-        product = Product.objects.filter(product_code=order_product.product_code).first()
-        if product and product.raw_code:
-            raw_code = product.raw_code
-            order需求_dict[raw_code] += order_product.product_num_todo
-
-    # 计算缺货毛坯数量
-    shortage_raw_quantity = 0
-    for raw in raw_quantities:
-        raw_code = raw['raw_code']
-        total_quantity = raw['total_quantity']
-        consumed_quantity = consumption_dict.get(raw_code, 0)
-        ordered_quantity = order需求_dict.get(raw_code, 0)
-        total_demand = consumed_quantity + ordered_quantity
-        shortage = total_demand - total_quantity
-        if shortage > 0:
-            shortage_raw_quantity += shortage
-
-    context = {
-        'segment': 'index',
-        'orders_count': orders_count,
-        'products_count': products_count,
-        'raw_count': raw_count,
-        'exchange_count': exchange_count,
-        'process_count': process_count,
-        'weight': 10,
-        'start_dates': start_dates,
-        'start_date_counts': start_date_counts_list,
-        'end_dates': end_dates,
-        'end_date_counts': end_date_counts_list,
+    html_template = loader.get_template('home/index.html')
+    return HttpResponse(html_template.render(context, request))
 
-        'months': months,
-        'weights': weights,
 
-        'device_details': device_details,
+@login_required(login_url="/login/")
+def device_load_view(request):
+    """设备负载 JSON：period 为 day/week/month，date 为窗口内任一天（YYYY-MM-DD，缺省今天）"""
+    period = request.GET.get('period', 'day')
+    date_str = request.GET.get('date')
+    try:
+        day = parse_date(date_str) if date_str else None
+        if date_str and day is None:
+            raise ValueError('Invalid date format, please use YYYY-MM-DD')
+        window_start, window_end = load_window(period, day)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    return JsonResponse({
+        'success': True,
+        'period': period,
+        'start': window_start.isoformat(),
+        'end': window_end.isoformat(),
+        'devices': device_load(window_start, window_end),
+    })
 
-        'order_details_combined': order_details_combined,
 
-        'remaining_quantities': remaining_quantities[:29],
+@login_required(login_url="/login/")
+def order_eta_list(request):
+    """订单预计完工 JSON，直接读 OrderEta 表；late=1 时只返回延期订单，order_code 可重复给出"""
+    etas = order_etas()
+    order_codes = set(request.GET.getlist('order_code'))
+    if order_codes:
+        etas = [eta for eta in etas if eta.order_code in order_codes]
+    if request.GET.get('late') == '1':
+        etas = [eta for eta in etas if eta.is_late]
+    return JsonResponse({'success': True, 'orders': [{
+        'order_code': eta.order_code,
+        'end_date': eta.end_date,
+        'estimated_delivery': eta.estimated_delivery.isoformat() if eta.estimated_delivery else None,
+        'remaining_days': eta.remaining_days,
+        'is_late': eta.is_late,
+    } for eta in etas]})
 
-        'shortage_raw_quantity': shortage_raw_quantity,  # 添加缺货毛坯数量
-    }
 
-    html_template = loader.get_template('home/index.html')
-    return HttpResponse(html_template.render(context, request))
+@login_required(login_url="/login/")
+def raw_requirements(request):
+    """毛坯需求计划 JSON：各毛坯汇总，以及按天的需求、入库、预计库存和缺口数组；shortage=1 时只返回会缺料的毛坯"""
+    from .arrange.mrp import raw_summary
+    result = mrp_plan()
+    raws = []
+    for i, summary in enumerate(raw_summary(result)):
+        if request.GET.get('shortage') == '1' and not summary['shortage']:
+            continue
+        raws.append(dict(summary,
+                         demand_by_date=result.demand[i].tolist(),
+                         receipts_by_date=result.receipts[i].tolist(),
+                         projected_by_date=result.projected[i].tolist(),
+                         shortage_by_date=result.shortage[i].tolist()))
+    return JsonResponse({'success': True, 'dates': [day.date().isoformat() for day in result.dates], 'raws': raws})
 
 
 @login_required(login_url="/login/")
@@ -511,73 +305,40 @@ def upload(request):
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
 
 
-from collections import defaultdict
-
 @login_required(login_url="/login/")
 def order_list(request):
     search_query = request.GET.get('search', '')  # 获取用户输入的搜索关键词
 
     # 如果存在搜索关键词，过滤订单产品列表
     if search_query:
-        order_products = OrderProduct.objects.select_related('order').filter(
+        order_products = OrderProduct.objects.select_related('order', 'product').filter(
             Q(order__order_code__icontains=search_query) |
             Q(product_code__icontains=search_query) |
             Q(product_kind__icontains=search_query)
-        ).order_by('order__order_start_date')
+        )
     else:
         # 如果没有搜索关键词，则获取所有订单产品
-        order_products = OrderProduct.objects.select_related('order').all().order_by('order__order_start_date')
+        order_products = OrderProduct.objects.select_related('order', 'product').all()
 
     per_page = request.GET.get('per_page', 50)  # 获取用户自定义的每页数量
-    paginator = Paginator(order_products, per_page)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-
-    # 获取当前页面的所有 product_code
-    product_codes = [op.product_code for op in page_obj]
-
-    # 仅获取当前页面需要的 Products
-    products = Product.objects.filter(product_code__in=product_codes)
-    product_dict = {product.product_code: product for product in products}
-
-    # 获取这些 Products 所涉及到的所有 raw_code
-    raw_codes = [product.raw_code for product in products if product.raw_code]
-    raws = Raw.objects.filter(raw_code__in=raw_codes)
-    raw_dict = {raw.raw_code: raw for raw in raws}
+    # 按下单日期排序，键集分页时以 (下单日期, id) 定位
+    page_obj = paginate(request, order_products, ('order__order_start_date', 'id'), per_page)
 
-    # 使用 defaultdict 来跟踪每个 raw_code 的累计使用量
-    raw_usage = defaultdict(int)  # key: raw_code, value: total product_num_todo used so far
+    # 剩余原料数量来自毛坯需求计划：同一毛坯按需用日期依次分配后的预计结余
+    remaining = mrp_plan().lines['remaining']
 
     # 处理产品列表，添加原料代码和剩余原料数量
     orders_content = []
     for order_product in page_obj:
-        product_code = order_product.product_code
         product_num_todo = order_product.product_num_todo
 
-        # 获取对应的 Product 对象
-        product = product_dict.get(product_code)
+        # 对应的 Product 对象随订单行一起 JOIN 读出
+        product = order_product.product
         product_name = product.product_name if product else "未知商品"  # 获取商品名称或默认为"未知商品"
 
-        raw_code = product.raw_code if product else None
-
-        # 获取对应的 Raw 对象并计算剩余原料数量
-        if raw_code:
-            raw = raw_dict.get(raw_code)
-            if raw:
-                initial_raw_num = raw.raw_num  # 初始的原料数量
-
-                # 累计使用量：之前的使用量加上当前的 product_num_todo
-                used_raw_num = raw_usage[raw_code] + product_num_todo
-
-                # 计算剩余原料数量
-                remain_raw_num = initial_raw_num - used_raw_num
-
-                # 更新累计使用量
-                raw_usage[raw_code] = used_raw_num
-            else:
-                remain_raw_num = 0
-        else:
-            remain_raw_num = 0
+        # 已开工、已完成或没有毛坯数据的订单行不占用毛坯，显示 0
+        remain_raw_num = remaining.get(order_product.id)
+        remain_raw_num = 0 if remain_raw_num is None or pd.isna(remain_raw_num) else int(remain_raw_num)
 
         orders_content.append({
             'order_code': order_product.order.order_code,
@@ -618,7 +379,7 @@ def get_order(request, order_id):
 def update_order(request, order_id):
     if request.method == 'POST':
         order = get_object_or_404(Order, order_id=order_id)
-        order.order_start_date = request.POST.get('order_date')
+        order.order_start_date = to_date(request.POST.get('order_date'))
         order.customer = request.POST.get('customer')
         order.sale_amount = request.POST.get('sale_amount')
         order.order_state = request.POST.get('order_state')
@@ -660,8 +421,13 @@ def create_order(request):
             }, status=400)
 
         # 现在可以安全地解析日期字符串，因为已经检查过它们不为 None 且不为空
-        order_start_date = datetime.strptime(order_start_date, '%Y-%m-%d').date()
-        order_end_date = datetime.strptime(order_end_date, '%Y-%m-%d').date()
+        order_start_date = to_date(order_start_date)
+        order_end_date = to_date(order_end_date)
+        if order_start_date is None or order_end_date is None:
+            return JsonResponse({
+                'success': False,
+                'message': '订单日期格式不正确。'
+            }, status=400)
 
         # 确保 product_num_todo 和 product_num_done 是整数
         product_num_todo = int(product_num_todo)
@@ -772,30 +538,20 @@ def product_list(request):
 
     # 如果存在搜索关键词，过滤产品列表
     if search_query:
-        products = Product.objects.filter(
+        products = Product.objects.select_related('raw').filter(
             Q(product_code__icontains=search_query) |
             Q(product_name__icontains=search_query)
         )
     else:
-        products = Product.objects.all()
+        products = Product.objects.select_related('raw').all()
 
-    paginator = Paginator(products, per_page)
-
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = paginate(request, products, ('id',), per_page)
 
     # 处理产品列表，添加原料代码
     product_list = []
     for product in page_obj:
-        if product.raw_code:
-            raws = Raw.objects.filter(raw_code=product.raw_code)
-            if raws.exists():
-                raw = raws.first()
-                raw_weight = raw.raw_weight
-            else:
-                raw_weight = None  # 或者设置一个默认值
-        else:
-            raw_weight = None  # 或者设置一个默认值
+        # 毛坯随产品一起 JOIN 读出，没有对应毛坯时为 None
+        raw_weight = product.raw.raw_weight if product.raw else None
         product_list.append({
             'product_code': product.product_code,
             'product_name': product.product_name,
@@ -819,7 +575,7 @@ def get_product(request, product_id):
     data = {
         'product_code': product.product_code,
         'product_category': product.product_category,
-        'raw': product.raw_code.raw_code if product.raw_code else None,
+        'raw': product.raw_code,
     }
     return JsonResponse(data)
 
@@ -832,7 +588,9 @@ def update_product(request, product_id):
         product.product_category = request.POST.get('product_category')
         raw_code = request.POST.get('raw')
         if raw_code:
-            product.raw_code = get_object_or_404(Raw, raw_code=raw_code)
+            if not Raw.objects.filter(raw_code=raw_code).exists():
+                return HttpResponse(status=404)
+            product.raw_code = raw_code  # 保存时解析 product.raw
         else:
             product.raw_code = None
         product.save()
@@ -861,17 +619,15 @@ def raw_list(request):
             Q(raw_name__icontains=search_query)
         ).values('raw_code', 'raw_name', 'raw_weight').annotate(
             raw_num=Sum('raw_num')
-        ).order_by('raw_name')
+        )
     else:
         # 如果没有搜索关键词，则获取所有毛坯，并按名称合并
         raws = Raw.objects.values('raw_code', 'raw_name', 'raw_weight').annotate(
             raw_num=Sum('raw_num')
-        ).order_by('raw_name')
+        )
 
-    # 分页处理
-    paginator = Paginator(raws, per_page)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # 分页处理：按名称排序，合并后的每行由 (名称, 编码, 单重) 唯一确定，键集分页以此定位
+    page_obj = paginate(request, raws, ('raw_name', 'raw_code', 'raw_weight'), per_page)
 
     # 传递数据给模板
     context = {
@@ -910,36 +666,34 @@ def raw_delete(request, pk):
         return JsonResponse({'success': True})
 
 
+def enrich_results(tasks):
+    """
+    排产结果连同订单、产品（外键 JOIN）和订单行的商品类别（关联子查询）一起读出，
+    先分页再求值时每页只有一条查询，不再逐行查询。
+    """
+    product_kinds = OrderProduct.objects.filter(
+        order_id=OuterRef('order_id'), product_code=OuterRef('product_code')).order_by('id').values('product_kind')[:1]
+    return tasks.select_related('order', 'product').annotate(line_product_kind=Subquery(product_kinds))
+
+
 @login_required(login_url="/login/")
 def result_list(request):
-    results = Task.objects.all()
-
-    # 为每个 task 对象添加对应的 product_name, customer_name 和 product_kind
-    for result in results:
-        # 获取 Product 对象，添加 product_name
-        product = Product.objects.filter(product_code=result.product_code).first()
-        result.product_name = product.product_name if product else '⚠️ 未知产品'
-
-        # 获取 OrderProduct 对象
-        order_product = OrderProduct.objects.filter(product_code=result.product_code).first()
-        if order_product:
-            # 添加 customer_name 和 product_kind
-            if order_product.order:
-                result.customer_name = order_product.order.order_custom_name
-                result.product_kind = order_product.product_kind
-            else:
-                result.customer_name = '⚠️ 未知客户 2'
-                result.product_kind = '⚠️ 未知类别 2'
+    results = enrich_results(Task.objects.all())
+
+    # 分页处理：先分页，只有当前页的任务会被读出；按 (开始时间, id) 排序
+    per_page = request.GET.get('per_page', 50)  # 获取用户自定义的每页数量，默认为50
+    page_obj = paginate(request, results, ('task_start_time', 'id'), per_page)
+
+    # 为当前页的 task 对象添加对应的 product_name, customer_name 和 product_kind
+    for result in page_obj:
+        result.product_name = result.product.product_name if result.product else '⚠️ 未知产品'
+        if result.order:
+            result.customer_name = result.order.order_custom_name
+            result.product_kind = result.line_product_kind or '⚠️ 未知类别 2'
         else:
             result.customer_name = '⚠️ 未知客户 1 '
             result.product_kind = '⚠️ 未知类别 1 '
 
-    # 分页处理
-    per_page = request.GET.get('per_page', 50)  # 获取用户自定义的每页数量，默认为50
-    paginator = Paginator(results, per_page)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-
     return render(request, 'home/result_list.html', {'results': page_obj, 'page_obj': page_obj, 'per_page': per_page})
 
 
@@ -959,6 +713,8 @@ def delete_result(request, result_id):
     if request.method == 'POST':
         result = Task.objects.get(id=result_id)
         result.delete()
+        mark_dirty(Task)
+        refresh_order_etas([result.order_code])
         return JsonResponse({'success': True})
     return JsonResponse({'success': False})
 
@@ -967,19 +723,128 @@ def delete_result(request, result_id):
 def process_schedule_fast(request):
     from .job_scheduler import schedule_production
     if request.method == 'POST':
-        Task.objects.all().delete()  # 清空 OrderProcessingResult 表
-        schedule_production(fast=True)  # 重新计算排产结果
-        return JsonResponse({'success': True})
+        try:
+            # 与 process_schedule 共用单飞锁；Task 表由 task_writer 在事务中整体替换，不需要先清空
+            run, attached = single_flight(
+                {'action': 'schedule', 'fast': True},
+                lambda: schedule_production(fast=True),  # 重新计算排产结果
+                summarise=schedule_summary,
+            )
+        except ScheduleBusy as busy:
+            return JsonResponse({'success': False, 'busy': True, 'run_id': busy.run.id}, status=409)
+        return JsonResponse({'success': run.status == ScheduleRun.DONE, 'run_id': run.id, 'attached': attached})
     return JsonResponse({'success': False})
 
 
 @login_required(login_url="/login/")
 def process_schedule(request):
+    from .arrange.optimizer import MAX_OPTIMIZE_SECONDS
     from .job_scheduler import schedule_production
     if request.method == 'POST':
-        Task.objects.all().delete()  # 清空 OrderProcessingResult 表
-        schedule_production()  # 重新计算排产结果
-        return JsonResponse({'success': True})
+        # 限时优化秒数，0 表示只做贪心排产；超过上限的按上限算
+        try:
+            optimize_seconds = float(request.POST.get('optimize_seconds', 0) or 0)
+        except ValueError:
+            optimize_seconds = None
+        if optimize_seconds is None or not math.isfinite(optimize_seconds) or optimize_seconds < 0:
+            return JsonResponse({'success': False, 'message': 'Invalid optimize_seconds'}, status=400)
+        optimize_seconds = min(optimize_seconds, MAX_OPTIMIZE_SECONDS)
+        try:
+            # 同一时间只跑一次排产；参数相同的并发请求等这次跑完并共用结果
+            run, attached = single_flight(
+                {'action': 'schedule', 'optimize_seconds': optimize_seconds},
+                lambda: schedule_production(optimize_seconds=optimize_seconds),  # 重新计算排产结果
+                summarise=schedule_summary,
+            )
+        except ScheduleBusy as busy:
+            return JsonResponse({'success': False, 'busy': True, 'run_id': busy.run.id}, status=409)
+        return JsonResponse({'success': run.status == ScheduleRun.DONE, 'run_id': run.id, 'attached': attached})
+    return JsonResponse({'success': False})
+
+
+@login_required(login_url="/login/")
+def process_reschedule(request):
+    """当天重排：保留已开工和已完工的任务，只重排剩下的工序"""
+    from .arrange.reschedule import reschedule
+    from .arrange.rules import DISPATCH_RULES
+    if request.method == 'POST':
+        rule = request.POST.get('rule', 'edd')
+        if rule not in DISPATCH_RULES:
+            return JsonResponse({'success': False, 'message': f'Unknown rule: {rule}'}, status=400)
+        try:
+            run, attached = single_flight(
+                {'action': 'reschedule', 'rule': rule},
+                lambda: reschedule(rule=rule),
+                summarise=lambda outcome: dict(schedule_summary(outcome[0]), **outcome[1]),
+            )
+        except ScheduleBusy as busy:
+            return JsonResponse({'success': False, 'busy': True, 'run_id': busy.run.id}, status=409)
+        return JsonResponse({'success': run.status == ScheduleRun.DONE, 'run_id': run.id, 'attached': attached,
+                             'summary': json.loads(run.summary or '{}')})
+    return JsonResponse({'success': False})
+
+
+@login_required(login_url="/login/")
+def schedule_diff(request):
+    """
+    比较两个排产版本，返回 JSON。
+    base 为版本 id，默认最近一次存档（即上一次排产）；target 为版本 id 或 current（默认，当前 Task 表）。
+    """
+    from .arrange.diff import DIFF_LIMIT, current_schedule, diff_schedules, load_version
+    try:
+        limit = int(request.GET.get('limit', DIFF_LIMIT))
+        base_id = request.GET.get('base')
+        base = ScheduleVersion.objects.get(id=int(base_id)) if base_id else ScheduleVersion.objects.latest('id')
+        target_id = request.GET.get('target', 'current')
+        target = None if target_id == 'current' else ScheduleVersion.objects.get(id=int(target_id))
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Invalid version id or limit'}, status=400)
+    except ScheduleVersion.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'Schedule version not found'}, status=404)
+    diff = diff_schedules(load_version(base), load_version(target) if target else current_schedule(), limit=limit)
+    return JsonResponse(dict(diff, success=True, base=base.id, target=target.id if target else 'current'))
+
+
+@login_required(login_url="/login/")
+def process_schedule_scenarios(request):
+    from .arrange.rules import DISPATCH_RULES
+    from .arrange.scenarios import Scenario, run_scenarios
+    if request.method == 'POST':
+        rules = request.POST.getlist('rules') or ['edd', 'spt', 'least_changeover']
+        start_dates = request.POST.getlist('start_dates') or [timezone.localdate().strftime('%Y-%m-%d')]
+        try:
+            scenarios = [
+                Scenario(rule, timezone.make_aware(datetime.strptime(start_date, '%Y-%m-%d')))
+                for rule in rules for start_date in start_dates if rule in DISPATCH_RULES
+            ]
+        except ValueError:
+            return JsonResponse({'success': False, 'message': 'Invalid date format, please use YYYY-MM-DD'},
+                                status=400)
+        if not scenarios:
+            return JsonResponse({'success': False, 'message': 'No valid scenario'}, status=400)
+
+        try:
+            run, attached = single_flight(
+                {'action': 'scenarios', 'scenarios': scenarios},
+                lambda: run_scenarios(scenarios),
+                summarise=lambda results: [{
+                    'rule': result['scenario'].rule,
+                    'start_date': result['scenario'].start_date.strftime('%Y-%m-%d'),
+                    'score': round(result['score'], 1),
+                    'planned': result['planned'],
+                    'unscheduled': result['unscheduled'],
+                    'late_orders': result['kpis']['late_orders'],
+                    'total_tardiness_minutes': result['kpis']['total_tardiness_minutes'],
+                    'changeover_count': result['kpis']['changeover_count'],
+                    'makespan_minutes': result['kpis']['makespan_minutes'],
+                } for result in results],
+            )
+        except ScheduleBusy as busy:
+            return JsonResponse({'success': False, 'busy': True, 'run_id': busy.run.id}, status=409)
+        if run.status != ScheduleRun.DONE:
+            return JsonResponse({'success': False, 'run_id': run.id}, status=500)
+        return JsonResponse({'success': True, 'run_id': run.id, 'attached': attached,
+                             'results': json.loads(run.summary)})
     return JsonResponse({'success': False})
 
 
@@ -987,6 +852,8 @@ def process_schedule(request):
 def clear_schedule(request):
     if request.method == 'POST':
         Task.objects.all().delete()
+        mark_dirty(Task)
+        refresh_order_etas()
         return JsonResponse({'success': True})
     return JsonResponse({'success': False})
 
@@ -1016,7 +883,7 @@ def filter_by_date(request):
 def mark_complete(request, id):
     task = Task.objects.get(pk=id)
     task.completed = True
-    task.save()
+    task.save(update_fields=TASK_PROGRESS_FIELDS)
     return JsonResponse({'success': True})
 
 
@@ -1025,7 +892,7 @@ def mark_not_complete(request, id):
     task = Task.objects.get(pk=id)
     if task:
         task.completed = False
-        task.save()
+        task.save(update_fields=TASK_PROGRESS_FIELDS)
         return JsonResponse({'success': True})
     return JsonResponse({'success': False}, status=400)
 
@@ -1034,7 +901,7 @@ def mark_not_complete(request, id):
 def mark_inspected(request, id):
     task = Task.objects.get(pk=id)
     task.inspected = True
-    task.save()
+    task.save(update_fields=TASK_PROGRESS_FIELDS)
     return JsonResponse({'success': True})
 
 
@@ -1043,7 +910,7 @@ def mark_not_inspected(request, id):
     task = Task.objects.get(pk=id)
     if task:
         task.inspected = False
-        task.save()
+        task.save(update_fields=TASK_PROGRESS_FIELDS)
         return JsonResponse({'success': True})
     return JsonResponse({'success': False}, status=400)
 
@@ -1052,27 +919,68 @@ def mark_not_inspected(request, id):
 @csrf_exempt
 @login_required(login_url="/login/")
 def add_urgent_task(request):
-    task_start_time = request.POST.get('task_start_time')
-    task_end_time = request.POST.get('task_end_time')
-    order_code = request.POST.get('order_code')
-    product_code = request.POST.get('product_code')
-    process_i = request.POST.get('process_i')
-    process_name = request.POST.get('process_name')
+    """
+    插入紧急任务：执行时间为最早开始时间，执行到完成时间之间的工作时长为任务时长。
+    设备上被挤到的任务以及它们订单行的后续工序自动顺延。
+    """
+    task_start_time = parse_datetime(request.POST.get('task_start_time', ''))
+    task_end_time = parse_datetime(request.POST.get('task_end_time', ''))
+    if not task_start_time or not task_end_time:
+        return JsonResponse({'success': False, 'error': '时间格式错误'}, status=400)
     device_name = request.POST.get('device_name')
-
-    task = Task.objects.create(
-        task_start_time=task_start_time,
-        task_end_time=task_end_time,
-        order_code=order_code,
-        product_code=product_code,
+    if not device_name or not Device.objects.filter(device_name=device_name).exists():
+        return JsonResponse({'success': False, 'error': '设备不存在'}, status=400)
+    try:
+        process_i = int(request.POST.get('process_i') or 0)
+    except ValueError:
+        process_i = -1
+    if process_i < 0:
+        return JsonResponse({'success': False, 'error': '工序号应为非负整数'}, status=400)
+    duration = max(0, SHOP_CALENDAR.offset_of(task_end_time) - SHOP_CALENDAR.offset_of(task_start_time))
+
+    task, shifted = insert_urgent_task(
+        device_name,
+        task_start_time,
+        duration,
+        order_code=request.POST.get('order_code', ''),
+        product_code=request.POST.get('product_code', ''),
         process_i=process_i,
-        process_name=process_name,
-        device_name=device_name,
-        completed=False,
-        inspected=False
+        process_name=request.POST.get('process_name', ''),
     )
 
-    return JsonResponse({'success': True, 'task_id': task.id})
+    return JsonResponse({
+        'success': True,
+        'task_id': task.id,
+        'task_start_time': task.task_start_time,
+        'task_end_time': task.task_end_time,
+        'shifted': shifted,
+    })
+
+
+def merge_adjacent_tasks(tasks):
+    """任务合并处理：按执行时间顺序合并相邻的相同商品编号的任务"""
+    merged_tasks = []
+    current_task = None
+
+    for task in tasks:
+        if current_task and task.product_code == current_task.product_code and (
+                task.task_start_time - current_task.task_end_time) <= timedelta(minutes=5):
+            # 合并相邻的相同商品编号的任务
+            current_task.grouped_tasks.append(task)
+            current_task.task_end_time = task.task_end_time  # 更新结束时间为最新任务的结束时间
+            current_task.product_num += task.product_num  # 更新生产数量
+        else:
+            # 完成当前合并任务，添加到列表
+            if current_task:
+                merged_tasks.append(current_task)
+            # 初始化新的合并任务
+            current_task = task
+            current_task.grouped_tasks = [task]
+
+    # 添加最后一个合并任务
+    if current_task:
+        merged_tasks.append(current_task)
+    return merged_tasks
 
 
 # My tasks
@@ -1106,34 +1014,16 @@ def my_tasks(request):
     if selected_device:
         tasks = tasks.filter(device_name=selected_device)
 
-    # 任务合并处理：按执行时间顺序合并相邻的相同商品编号的任务
-    merged_tasks = []
-    current_task = None
-
-    for task in tasks:
-        if current_task and task.product_code == current_task.product_code and (
-                task.task_start_time - current_task.task_end_time) <= timedelta(minutes=5):
-            # 合并相邻的相同商品编号的任务
-            current_task.grouped_tasks.append(task)
-            current_task.task_end_time = task.task_end_time  # 更新结束时间为最新任务的结束时间
-            current_task.product_num += task.product_num  # 更新生产数量
-        else:
-            # 完成当前合并任务，添加到列表
-            if current_task:
-                merged_tasks.append(current_task)
-            # 初始化新的合并任务
-            current_task = task
-            current_task.grouped_tasks = [task]
-
-    # 添加最后一个合并任务
-    if current_task:
-        merged_tasks.append(current_task)
-
     # 分页
     per_page = request.GET.get('per_page', 50)
-    paginator = Paginator(merged_tasks, per_page)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    if keyset_requested(request):
+        # 键集分页按任务翻页，只合并当前页内的任务，不再把全部任务读进内存
+        page_obj = keyset_page(request, tasks, ('task_start_time', 'id'), per_page)
+        page_obj.object_list = merge_adjacent_tasks(page_obj.object_list)
+    else:
+        paginator = Paginator(merge_adjacent_tasks(tasks), per_page)
+        page_number = request.GET.get('page')
+        page_obj = paginator.get_page(page_number)
 
     # 生成二维码（保持原样）
     current_url = request.build_absolute_uri()
@@ -1192,11 +1082,11 @@ def my_tasks_done(request):
     if selected_device:
         tasks = tasks.filter(device_name=selected_device)
 
+    # 订单和产品随任务一起 JOIN 读出
+    tasks = tasks.select_related('order', 'product')
     for task in tasks:
-        order_product = OrderProduct.objects.filter(product_code=task.product_code).first()
-        task.customer_name = order_product.order.order_custom_name if order_product else '未知客户'
-        product = Product.objects.filter(product_code=task.product_code).first()
-        task.product_name = product.product_name if product else '⚠️ 未知产品'
+        task.customer_name = task.order.order_custom_name if task.order else '未知客户'
+        task.product_name = task.product.product_name if task.product else '⚠️ 未知产品'
 
     # 生成二维码
     current_url = request.build_absolute_uri()
@@ -1254,11 +1144,15 @@ def my_tasks_operator_complete_task(request):
 
         product_code = task.product_code
         order_product = OrderProduct.objects.filter(product_code=product_code, order=order).last()
+        was_completed = task.completed
         task.product_num_completed += int(product_num)
         if task.product_num_completed >= task.product_num:
             task.completed = 1
 
-        task.save()
+        task.save(update_fields=TASK_PROGRESS_FIELDS)
+        if task.completed and not was_completed:
+            # 实际时长反馈给排产
+            record_completion(task)
 
         if is_max_process(order_product):
             order_product.product_num_done += product_num
@@ -1299,7 +1193,7 @@ def my_tasks_operator_rework_task(request):
             task.product_num_inspected -= rework_product_num
             task.completed = 0
             task.inspected = 0
-            task.save()
+            task.save(update_fields=TASK_PROGRESS_FIELDS)
             order_code = task.order_code
             order = get_object_or_404(Order, order_code=order_code)
 
@@ -1372,7 +1266,7 @@ def my_tasks_inspector_complete_task(request):
         task.product_num_inspected += num_inspected
         if task.product_num_inspected >= task.product_num:
             task.inspected = 1
-        task.save()
+        task.save(update_fields=TASK_PROGRESS_FIELDS)
 
         return JsonResponse({'success': True,
                              'product_num': task.product_num, })
@@ -1390,7 +1284,7 @@ def my_tasks_inspector_complete_tasks(request):
             for task in tasks:
                 task.inspected = True
                 task.product_num_inspected = task.product_num_completed
-                task.save()
+                task.save(update_fields=TASK_PROGRESS_FIELDS)
             return JsonResponse({'status': 'success', 'message': 'Tasks updated successfully'})
         else:
             return JsonResponse({'status': 'error', 'message': 'Invalid action'})
@@ -1411,10 +1305,13 @@ def my_tasks_operator_one_btn_complete_tasks(request):
 
             product_code = task.product_code
             order_product = OrderProduct.objects.filter(product_code=product_code, order=order).last()
+            was_completed = task.completed
             task.product_num_completed = int(task.product_num)
             task.completed = 1
 
-            task.save()
+            task.save(update_fields=TASK_PROGRESS_FIELDS)
+            if not was_completed:
+                record_completion(task)
 
             if is_max_process(order_product):
                 order_product.product_num_done += task.product_num
@@ -1482,9 +1379,6 @@ def my_tasks_inspector_scrap_tasks(request):
 
 @login_required(login_url="/login/")
 def generate_pdf(request):
-    # 上海时区
-    shanghai_tz = pytz.timezone('Asia/Shanghai')
-
     # 获取当前用户及其角色
     user = request.user
     if user.role == 'admin':
@@ -1498,6 +1392,12 @@ def generate_pdf(request):
     else:
         related_device_names = Device.objects.filter(operator=user).values_list('device_name', flat=True)
         tasks = Task.objects.filter(device_name__in=related_device_names).order_by('task_start_time')
+    tasks = list(tasks.values_list('device_name', 'task_start_time', 'is_changeover', 'product_code', 'process_i',
+                                   'process_name', 'product_num'))
+
+    # 开始时间整列按车间日历的时区换算为本地时间再格式化
+    start_times = pd.to_datetime(SHOP_CALENDAR.to_minutes([task[1] for task in tasks]), unit='m').strftime(
+        '%m-%d %H:%M')
 
     # 创建PDF缓冲区
     buffer = BytesIO()
@@ -1510,27 +1410,13 @@ def generate_pdf(request):
 
     # 按设备名称对任务进行分组
     tasks_by_device = {}
-    for task in tasks:
-        device_name = task.device_name
-        if device_name not in tasks_by_device:
-            tasks_by_device[device_name] = []
-        tasks_by_device[device_name].append(task)
+    for task, start_time in zip(tasks, start_times):
+        tasks_by_device.setdefault(task[0], []).append([task[0], start_time, *task[2:]])
 
     # 为每个设备创建一个表格
     for device_name, device_tasks in tasks_by_device.items():
         # 表格数据
-        data = [['设备', '开始时间', '是否换型', '商品', '工序号', '工序名', '数量']]
-        for task in device_tasks:
-            start_time = task.task_start_time.astimezone(shanghai_tz)
-            data.append([
-                task.device_name,
-                start_time.strftime('%m-%d %H:%M'),
-                task.is_changeover,
-                task.product_code,
-                task.process_i,
-                task.process_name,
-                task.product_num
-            ])
+        data = [['设备', '开始时间', '是否换型', '商品', '工序号', '工序名', '数量']] + device_tasks
 
         # 创建表格并设置样式
         table = Table(data, colWidths=[doc.width / len(data[0])] * len(data[0]), repeatRows=1)
@@ -33,7 +33,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'apps.home'  # Enable the inner home (home)
+    'apps.home.config.MyConfig'  # Enable the inner home (home)
 ]
 
 MIDDLEWARE = [
@@ -135,4 +135,12 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
 # 默认文件存储系统
-DEFAULT_FILE_STORAGE = 'apps.home.custom_storage.CustomFileSystemStorage'
\ No newline at end of file
+DEFAULT_FILE_STORAGE = 'apps.home.custom_storage.CustomFileSystemStorage'
+# 排产派工规则 customer_priority 使用的客户等级：客户名称 -> 等级，数字越小越优先，未列出的客户排最后
+CUSTOMER_PRIORITY = {}
+# 排产使用的加工时长：None/'static' 用工序表里的 process_duration；'mean'/'p50'/'p90' 用完工记录学到的时长
+# （样本不足的工序和设备仍用 process_duration），见 apps/home/arrange/durations.py
+LEARNED_DURATIONS = None
+# 大列表页（订单、排产结果、产品、毛坯、我的任务）缺省使用键集分页：不做 COUNT(*) 和 OFFSET，
+# 只能逐页前后翻，总数为缓存的近似值；请求中的 mode=keyset/offset 可以临时切换，见 apps/home/common/pagination.py
+KEYSET_PAGINATION = False